@@ -1,4 +1,5 @@
 import datetime
+import json
 
 def convert_ms_to_datetime(timestamp_ms):
     """將毫秒時間戳轉換為 datetime 物件 (UTC)。"""
@@ -3,6 +3,7 @@ import json
 import logging
 from google.cloud import firestore
 from google.cloud import pubsub_v1
+import numpy as np
 import pandas as pd
 # from sklearn.ensemble import RandomForestRegressor # 假設用於模型優化
 # from sklearn.model_selection import train_test_split
@@ -32,6 +33,9 @@ TRADE_REPORTS_COLLECTION = os.environ.get("TRADE_REPORTS_COLLECTION", "trade_rep
 STRATEGY_CONFIG_COLLECTION = os.environ.get("STRATEGY_CONFIG_COLLECTION", "strategy_config")
 # MODEL_ARTIFACTS_BUCKET = os.environ.get("MODEL_ARTIFACTS_BUCKET", f"{GCP_PROJECT_ID}-model-artifacts") # GCS bucket for models
 
+# 評估表現時實際用到的交易報告欄位
+TRADE_REPORT_FIELDS = ['timestamp', 'action', 'status', 'executed_price', 'executed_quantity']
+
 def fetch_trade_reports(days_ago=7):
     """
     從 Firestore 獲取最近的交易報告。
@@ -44,15 +48,24 @@ def fetch_trade_reports(days_ago=7):
     utc_now = datetime.now(timezone.utc)
     start_time = utc_now - timedelta(days=days_ago)
     
-    reports = []
     try:
-        query = db.collection(TRADE_REPORTS_COLLECTION).where('timestamp', '>=', int(start_time.timestamp() * 1000)).stream()
-        for doc in query:
-            reports.append(doc.to_dict())
+        query = db.collection(TRADE_REPORTS_COLLECTION)\
+            .where('timestamp', '>=', int(start_time.timestamp() * 1000))\
+            .select(TRADE_REPORT_FIELDS)\
+            .stream()
+
+        # 逐筆產生欄位值 tuple，直接建構 DataFrame，不先累積成 dict 列表
+        def _rows():
+            for doc in query:
+                report = doc.to_dict()
+                yield tuple(report.get(field) for field in TRADE_REPORT_FIELDS)
+
+        reports = pd.DataFrame.from_records(_rows(), columns=TRADE_REPORT_FIELDS)
         logging.info(f"Fetched {len(reports)} trade reports.")
+        return reports
     except Exception as e:
         logging.error(f"Error fetching trade reports from Firestore: {e}", exc_info=True)
-    return pd.DataFrame(reports)
+        return pd.DataFrame(columns=TRADE_REPORT_FIELDS)
 
 
 def evaluate_performance(trade_df):
@@ -67,15 +80,19 @@ def evaluate_performance(trade_df):
     # 實際需要根據 'executed_price' 和後續平倉價格計算 PnL
     
     # 簡化範例：假設所有成功的交易都帶來少量利潤，失敗的則虧損
-    trade_df['pnl'] = trade_df.apply(lambda row: 
-                                     (row['executed_price'] * row['executed_quantity'] * 0.005 if row['status'] == 'FILLED' and row['action'] == 'BUY' else 
-                                      -row['executed_price'] * row['executed_quantity'] * 0.005 if row['status'] == 'FILLED' and row['action'] == 'SELL' else 0), axis=1) # 這裡簡化為固定百分比
+    # 以整欄向量運算計算，避免 apply(axis=1) 逐行建立 Series
+    filled = trade_df['status'].to_numpy() == 'FILLED'
+    action = trade_df['action'].to_numpy()
+    side = np.where(action == 'BUY', 1.0, np.where(action == 'SELL', -1.0, 0.0)) * filled
+    executed_price = trade_df['executed_price'].to_numpy(dtype=np.float64, na_value=np.nan)
+    executed_quantity = trade_df['executed_quantity'].to_numpy(dtype=np.float64, na_value=np.nan)
+    pnl = np.where(side != 0, side * executed_price * executed_quantity * 0.005, 0.0) # 這裡簡化為固定百分比
+    trade_df['pnl'] = pnl
 
     # 實際 PnL 計算需要結合平倉價格
-    total_pnl = trade_df['pnl'].sum()
-    win_trades = trade_df[trade_df['pnl'] > 0]
-    num_trades = len(trade_df[trade_df['status'] == 'FILLED'])
-    win_rate = len(win_trades) / num_trades if num_trades > 0 else 0
+    total_pnl = float(np.nansum(pnl)) # 與 pandas Series.sum() 相同，跳過缺少成交價/數量的行 (NaN)
+    num_trades = int(filled.sum())
+    win_rate = int((pnl > 0).sum()) / num_trades if num_trades > 0 else 0
     avg_profit_per_trade = total_pnl / num_trades if num_trades > 0 else 0
 
     performance_metrics = {
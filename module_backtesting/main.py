@@ -1,11 +1,21 @@
 import os
-import json
+import functools
+import orjson
 import logging
+import numpy as np
 import pandas as pd
 from google.cloud import firestore
-import matplotlib.pyplot as plt
 import datetime # 為了日期處理
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import pubsub_v1
+try:
+    from numba import njit
+except ImportError: # numba 為選用依賴；未安裝時以純 Python 執行相同的函式
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
 
 # 配置日誌
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -13,29 +23,97 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # 從環境變數獲取 GCP 專案 ID
 GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID")
 PUBSUB_TOPIC_BACKTEST_REPORTS = os.environ.get("PUBSUB_TOPIC_BACKTEST_REPORTS", "backtest-reports") # 發布回測報告
+FIRESTORE_API_ENDPOINT = os.environ.get("FIRESTORE_API_ENDPOINT") # 可選：指定與服務同區域的 Firestore 端點
 
 if not GCP_PROJECT_ID:
     logging.error("GCP_PROJECT_ID environment variable not set. Exiting.")
     exit(1)
 
-# 初始化 Firestore 客戶端
-db = firestore.Client(project=GCP_PROJECT_ID)
+# Firestore / Pub/Sub 客戶端在第一次使用時才建立 (建立時需要刷新憑證並建立 gRPC 通道)，
+# 之後在同一實例的多次觸發之間重用；只讀 Parquet 的回測不會建立 Firestore 客戶端。
+@functools.lru_cache(maxsize=1)
+def get_firestore_client():
+    """初始化 Firestore 客戶端"""
+    client_options = {"api_endpoint": FIRESTORE_API_ENDPOINT} if FIRESTORE_API_ENDPOINT else None
+    return firestore.Client(project=GCP_PROJECT_ID, client_options=client_options)
 
-# 初始化 Pub/Sub Publisher 客戶端
-publisher = pubsub_v1.PublisherClient()
-backtest_reports_topic_path = publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_BACKTEST_REPORTS)
+@functools.lru_cache(maxsize=1)
+def get_publisher():
+    """初始化 Pub/Sub Publisher 客戶端"""
+    return pubsub_v1.PublisherClient()
+
+backtest_reports_topic_path = pubsub_v1.PublisherClient.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_BACKTEST_REPORTS)
 
 
 # Firestore Collection 名稱
 KLINE_DATA_COLLECTION = os.environ.get("KLINE_DATA_COLLECTION", "historical_kline_data")
 # 假設您有一個資料庫儲存歷史K線數據，或者使用數據獲取模組的數據
 # 在實際應用中，可能需要從 BigQuery 或 Cloud Storage 獲取大量歷史數據
+KLINE_FIELDS = ['open_time', 'open', 'high', 'low', 'close', 'volume'] # 回測實際用到的 K 線字段
+KLINE_FETCH_SHARDS = int(os.environ.get("KLINE_FETCH_SHARDS", "8")) # 將時間範圍切成多段並行查詢
+# 價格/成交量欄位的存儲精度，預設 float64。設為 float32 可使 K 線數據佔用減半，
+# 但只有約 7 位有效數字 (高價幣種的小數位與大成交量會被捨入)，僅在內存受限時選用
+KLINE_PRICE_DTYPE = os.environ.get("KLINE_PRICE_DTYPE", "float64")
+# 若設定，改從 Parquet 數據集讀取 K 線 (例如 gs://bucket/klines，按 symbol=/interval= 分區)，不再查詢 Firestore
+KLINE_PARQUET_PATH = os.environ.get("KLINE_PARQUET_PATH")
+# 若設定，交易明細寫入 gs://{BACKTEST_REPORTS_BUCKET}/reports/ 下的 Parquet 檔，報告只攜帶 URI (Pub/Sub 訊息上限 10 MB)
+BACKTEST_REPORTS_BUCKET = os.environ.get("BACKTEST_REPORTS_BUCKET")
+
+
+def _fetch_kline_range(symbol, interval, start_ts_ms, end_ts_ms):
+    """
+    查詢單一時間區段內的 K 線，只取回測需要的字段。
+    以列式 (每個字段一個緊湊的 array 緩衝區) 收集，返回 {字段: NumPy 陣列}，避免每根 K 線一個 dict。
+    """
+    # 假設您的 K 線數據是每個條目一個文檔，並且有 'symbol', 'interval', 'open_time' 等字段
+    query = get_firestore_client().collection(KLINE_DATA_COLLECTION)\
+        .where('symbol', '==', symbol)\
+        .where('interval', '==', interval)\
+        .where('open_time', '>=', start_ts_ms)\
+        .where('open_time', '<=', end_ts_ms)\
+        .select(KLINE_FIELDS)\
+        .order_by('open_time')\
+        .stream()
+
+    open_time, open_, high, low, close, volume = array('q'), array('d'), array('d'), array('d'), array('d'), array('d')
+    for doc in query:
+        kline = doc.to_dict()
+        open_time.append(int(kline.get('open_time')))
+        open_.append(float(kline.get('open')))
+        high.append(float(kline.get('high')))
+        low.append(float(kline.get('low')))
+        close.append(float(kline.get('close')))
+        volume.append(float(kline.get('volume')))
+        # 添加其他需要的 K 線數據字段 (同時加入 KLINE_FIELDS)
+
+    return {
+        'open_time': np.frombuffer(open_time, dtype=np.int64),
+        'open': np.frombuffer(open_, dtype=np.float64),
+        'high': np.frombuffer(high, dtype=np.float64),
+        'low': np.frombuffer(low, dtype=np.float64),
+        'close': np.frombuffer(close, dtype=np.float64),
+        'volume': np.frombuffer(volume, dtype=np.float64),
+    }
 
+def _fetch_kline_parquet(symbol, interval, start_ts_ms, end_ts_ms):
+    """從 Parquet 數據集讀取 K 線，分區與 open_time 過濾條件由 pyarrow 下推，只讀取需要的列。"""
+    df = pd.read_parquet(
+        KLINE_PARQUET_PATH,
+        columns=KLINE_FIELDS,
+        filters=[
+            ('symbol', '==', symbol),
+            ('interval', '==', interval),
+            ('open_time', '>=', start_ts_ms),
+            ('open_time', '<=', end_ts_ms),
+        ],
+    )
+    return df.sort_values('open_time', ignore_index=True).astype({field: KLINE_PRICE_DTYPE for field in KLINE_FIELDS[1:]})
 
 def fetch_historical_kline_data(symbol, interval, start_date, end_date):
     """
-    從 Firestore 獲取歷史 K 線數據。
+    獲取歷史 K 線數據。設定 KLINE_PARQUET_PATH 時從 Parquet (列式存儲) 讀取，否則從 Firestore 獲取。
     在實際的回測中，您需要足夠且乾淨的歷史數據。
+    Firestore 查詢時，時間範圍會切成 KLINE_FETCH_SHARDS 個互不重疊的區段並行查詢，以縮短網路等待時間。
     """
     logging.info(f"Fetching historical kline data for {symbol}@{interval} from {start_date} to {end_date}...")
     
@@ -43,37 +121,83 @@ def fetch_historical_kline_data(symbol, interval, start_date, end_date):
     start_ts_ms = int(start_date.timestamp() * 1000)
     end_ts_ms = int(end_date.timestamp() * 1000)
 
-    klines = []
+    if KLINE_PARQUET_PATH:
+        try:
+            df = _fetch_kline_parquet(symbol, interval, start_ts_ms, end_ts_ms)
+            logging.info(f"Fetched {len(df)} historical klines from Parquet.")
+            return df
+        except Exception as e:
+            logging.error(f"Error reading historical kline data from Parquet: {e}", exc_info=True)
+            return pd.DataFrame()
+
+    # 切分為互不重疊的閉區間 [lo, hi]，依時間先後排列
+    step = (end_ts_ms - start_ts_ms) // max(KLINE_FETCH_SHARDS, 1) + 1
+    ranges = [(lo, min(lo + step - 1, end_ts_ms)) for lo in range(start_ts_ms, end_ts_ms + 1, step)]
+
     try:
-        # 查詢 Firestore 中的歷史數據
-        # 假設您的 K 線數據是每個條目一個文檔，並且有 'symbol', 'interval', 'open_time' 等字段
-        query = db.collection(KLINE_DATA_COLLECTION)\
-            .where('symbol', '==', symbol)\
-            .where('interval', '==', interval)\
-            .where('open_time', '>=', start_ts_ms)\
-            .where('open_time', '<=', end_ts_ms)\
-            .order_by('open_time')\
-            .stream()
-        
-        for doc in query:
-            kline = doc.to_dict()
-            klines.append({
-                'open_time': kline.get('open_time'),
-                'open': float(kline.get('open')),
-                'high': float(kline.get('high')),
-                'low': float(kline.get('low')),
-                'close': float(kline.get('close')),
-                'volume': float(kline.get('volume'))
-                # 添加其他需要的 K 線數據字段
-            })
-        logging.info(f"Fetched {len(klines)} historical klines.")
-        return pd.DataFrame(klines)
+        get_firestore_client() # 先在主線程建立客戶端，避免多個查詢線程同時初始化
+        # Firestore 查詢是 I/O 密集 (gRPC 會釋放 GIL)，使用線程並行
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            chunks = list(executor.map(lambda r: _fetch_kline_range(symbol, interval, r[0], r[1]), ranges))
+
+        # 每段已按 open_time 排序，且區段本身依時間先後排列，直接串接即為整體順序
+        columns = {field: np.concatenate([chunk[field] for chunk in chunks]) for field in KLINE_FIELDS}
+        for field in KLINE_FIELDS[1:]:
+            columns[field] = columns[field].astype(KLINE_PRICE_DTYPE, copy=False)
+        logging.info(f"Fetched {len(columns['open_time'])} historical klines.")
+        return pd.DataFrame(columns, copy=False)
 
     except Exception as e:
         logging.error(f"Error fetching historical kline data from Firestore: {e}", exc_info=True)
         return pd.DataFrame()
 
 
+# fastmath 不含 nnan / ninf (與訂單簿模組相同)：K 線收盤價可能缺失 (NaN)，編譯器若假設不存在 NaN，
+# 滾動總和與均線比較的結果未定義；不含這兩個標記時 NaN 按 IEEE 規則傳播，信號比較為 False
+SMA_FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+# 指定類型簽名：模組導入時即完成編譯 (或從 cache 載入)，避免第一次回測時的 JIT 延遲
+@njit('Tuple((float64[:], float64[:], int8[:], int8[:]))(float64[:], int64, int64)', cache=True, fastmath=SMA_FASTMATH)
+def _sma_crossover(close, short_window, long_window):
+    """
+    單次掃描計算短/長期 SMA (min_periods=1)、交叉信號與倉位。
+    SMA 以滾動總和更新，每根 K 線的計算量與窗口大小無關。
+    """
+    n = close.shape[0]
+    sma_short = np.empty(n, dtype=np.float64)
+    sma_long = np.empty(n, dtype=np.float64)
+    signal = np.zeros(n, dtype=np.int8)
+    position = np.zeros(n, dtype=np.int8)
+
+    short_sum = 0.0
+    long_sum = 0.0
+    current_position = 0
+    for i in range(n):
+        short_sum += close[i]
+        long_sum += close[i]
+        if i >= short_window:
+            short_sum -= close[i - short_window]
+        if i >= long_window:
+            long_sum -= close[i - long_window]
+        sma_short[i] = short_sum / min(i + 1, short_window)
+        sma_long[i] = long_sum / min(i + 1, long_window)
+
+        # 0: 持倉, 1: 買入 (金叉), -1: 賣出 (死叉)
+        if sma_short[i] > sma_long[i]:
+            signal[i] = 1
+        elif sma_short[i] < sma_long[i]:
+            signal[i] = -1
+
+        # 金叉時持有多頭、死叉時平倉，均線相等時沿用上一根 K 線的倉位；第一根 K 線固定無倉位。
+        if i > 0:
+            if signal[i] == 1:
+                current_position = 1
+            elif signal[i] == -1:
+                current_position = 0
+        position[i] = current_position
+
+    return sma_short, sma_long, signal, position
+
 def simple_moving_average_strategy(df, short_window=5, long_window=20):
     """
     簡單移動平均線交叉策略。
@@ -83,37 +207,96 @@ def simple_moving_average_strategy(df, short_window=5, long_window=20):
         logging.warning("Not enough data for SMA strategy.")
         return pd.DataFrame()
 
-    df['SMA_Short'] = df['close'].rolling(window=short_window, min_periods=1).mean()
-    df['SMA_Long'] = df['close'].rolling(window=long_window, min_periods=1).mean()
-
-    df['Signal'] = 0 # 0: 持倉, 1: 買入, -1: 賣出
-    df['Position'] = 0 # 倉位狀態 (0: 無倉位, 1: 持有多頭)
-
-    # 生成買入信號 (金叉)
-    df.loc[df['SMA_Short'] > df['SMA_Long'], 'Signal'] = 1
-    # 生成賣出信號 (死叉)
-    df.loc[df['SMA_Short'] < df['SMA_Long'], 'Signal'] = -1
-    
-    # 實現倉位邏輯
-    current_position = 0
-    for i in range(1, len(df)):
-        if df['Signal'].iloc[i] == 1 and current_position == 0: # 金叉且無倉位 -> 買入
-            df.loc[i, 'Position'] = 1
-            current_position = 1
-        elif df['Signal'].iloc[i] == -1 and current_position == 1: # 死叉且持有多頭 -> 賣出
-            df.loc[i, 'Position'] = 0 # 平倉
-            current_position = 0
-        else: # 否則保持當前倉位
-            df.loc[i, 'Position'] = df['Position'].iloc[i-1]
+    # copy=True 確保得到可寫陣列 (pandas Copy-on-Write 下返回唯讀視圖，不符合 _sma_crossover 的簽名)
+    close = df['close'].to_numpy(dtype=np.float64, copy=True)
+    # 實現倉位邏輯 (0: 無倉位, 1: 持有多頭)
+    sma_short, sma_long, signal, position = _sma_crossover(close, short_window, long_window)
+    df[['SMA_Short', 'SMA_Long']] = np.column_stack((sma_short, sma_long))
+    df['Signal'] = signal
 
     # 處理最後一筆交易如果仍有倉位
-    if current_position == 1: # 如果回測結束時仍持有倉位，則平倉
-        df.loc[len(df)-1, 'Position'] = 0 # 強制平倉
+    if position[-1] == 1: # 如果回測結束時仍持有倉位，則平倉
+        position[-1] = 0 # 強制平倉
         logging.info("Forced close position at end of backtest.")
 
+    df['Position'] = position
 
     return df
 
+@njit(cache=True)
+def _simulate(close, position, initial_balance):
+    """
+    回測的逐 K 線事件迴圈 (以 Numba 編譯為機器碼)。
+    只操作 NumPy 陣列與純量，交易紀錄寫入預先配置的陣列，前 num_trades 筆為有效資料。
+    trade_action: 0 = BUY, 1 = SELL
+    """
+    n = close.shape[0]
+    equity = np.empty(n, dtype=np.float64)
+    trade_idx = np.empty(n, dtype=np.int64)
+    trade_action = np.empty(n, dtype=np.int8)
+    trade_qty = np.empty(n, dtype=np.float64)
+    trade_pnl = np.zeros(n, dtype=np.float64)
+    trade_balance = np.empty(n, dtype=np.float64)
+    trade_equity = np.empty(n, dtype=np.float64)
+
+    balance = initial_balance
+    current_position_qty = 0.0
+    entry_price = 0.0
+    num_trades = 0
+
+    for i in range(n):
+        price = close[i]
+
+        # 買入
+        if position[i] == 1 and current_position_qty == 0:
+            # 簡化：投入固定比例的資金
+            buy_amount_usd = balance * 0.99 # 幾乎所有資金
+            buy_quantity = buy_amount_usd / price
+
+            balance -= buy_amount_usd
+            current_position_qty += buy_quantity
+            entry_price = price
+
+            equity[i] = balance + current_position_qty * price
+            trade_idx[num_trades] = i
+            trade_action[num_trades] = 0
+            trade_qty[num_trades] = buy_quantity
+            trade_balance[num_trades] = balance
+            trade_equity[num_trades] = equity[i]
+            num_trades += 1
+
+        # 賣出/平倉
+        elif position[i] == 0 and current_position_qty > 0:
+            sell_amount_usd = current_position_qty * price
+            pnl = (price - entry_price) * current_position_qty
+
+            balance += sell_amount_usd
+            current_position_qty = 0.0 # 清零倉位
+            entry_price = 0.0 # 清零入場價格
+
+            equity[i] = balance
+            trade_idx[num_trades] = i
+            trade_action[num_trades] = 1
+            trade_qty[num_trades] = sell_amount_usd / price
+            trade_pnl[num_trades] = pnl
+            trade_balance[num_trades] = balance
+            trade_equity[num_trades] = balance
+            num_trades += 1
+
+        # 更新持倉價值
+        else: # 持倉中或無倉位
+            equity[i] = balance + current_position_qty * price
+
+    return (equity, trade_idx, trade_action, trade_qty, trade_pnl, trade_balance, trade_equity,
+            num_trades, balance, current_position_qty)
+
+def store_trades_log(symbol, interval, start_date, end_date, trades):
+    """將交易明細以 Parquet (zstd 壓縮) 寫入 GCS，返回檔案 URI。"""
+    run_id = f"{interval}-{start_date.strftime('%Y%m%d')}-{end_date.strftime('%Y%m%d')}-{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}"
+    uri = f"gs://{BACKTEST_REPORTS_BUCKET}/reports/{symbol}/{run_id}.parquet"
+    pd.DataFrame(trades).to_parquet(uri, compression='zstd', index=False)
+    return uri
+
 def run_backtest(symbol, interval, start_date, end_date):
     """
     執行回測並生成報告。
@@ -126,80 +309,60 @@ def run_backtest(symbol, interval, start_date, end_date):
         return None
 
     # 運行交易策略 (這裡使用 SMA 策略作為範例)
-    df_with_signals = simple_moving_average_strategy(df.copy())
+    # 策略只會在 df 上新增欄位，且之後不再使用原始 df，因此不需要先複製整個 DataFrame
+    df_with_signals = simple_moving_average_strategy(df)
     
     if df_with_signals.empty:
         logging.error("Strategy did not generate any signals or positions.")
         return None
 
     initial_balance = float(os.environ.get("BACKTEST_INITIAL_BALANCE", "10000.0"))
-    balance = initial_balance
-    trades = []
-    current_position_qty = 0.0
-    entry_price = 0.0
 
-    for i in range(len(df_with_signals)):
-        row = df_with_signals.iloc[i]
-        
-        # 買入
-        if row['Position'] == 1 and current_position_qty == 0:
-            # 簡化：投入固定比例的資金
-            buy_amount_usd = balance * 0.99 # 幾乎所有資金
-            buy_quantity = buy_amount_usd / row['close']
-            
-            balance -= buy_amount_usd
-            current_position_qty += buy_quantity
-            entry_price = row['close']
-            
+    # 事先取出需要的欄位為 NumPy 陣列，交給編譯後的事件迴圈執行
+    close = df_with_signals['close'].to_numpy(dtype=np.float64)
+    position = df_with_signals['Position'].to_numpy(dtype=np.int8)
+    open_time = df_with_signals['open_time'].to_numpy(dtype=np.int64)
+
+    (equity, trade_idx, trade_action, trade_qty, trade_pnl, trade_balance, trade_equity,
+     num_trade_records, balance, current_position_qty) = _simulate(close, position, initial_balance)
+
+    df_with_signals['equity'] = equity
+
+    # 在編譯函式之外組裝交易紀錄 (轉為 Python 原生型別，方便 JSON 序列化)
+    trades = []
+    for k in range(num_trade_records):
+        i = trade_idx[k]
+        if trade_action[k] == 0:
             trades.append({
-                'timestamp': row['open_time'],
+                'timestamp': int(open_time[i]),
                 'action': 'BUY',
-                'price': row['close'],
-                'quantity': buy_quantity,
-                'balance': balance,
-                'equity': balance + current_position_qty * row['close']
+                'price': float(close[i]),
+                'quantity': float(trade_qty[k]),
+                'balance': float(trade_balance[k]),
+                'equity': float(trade_equity[k])
             })
-            logging.debug(f"BUY at {row['close']:.4f}, Qty: {buy_quantity:.6f}, Balance: {balance:.2f}")
-
-        # 賣出/平倉
-        elif row['Position'] == 0 and current_position_qty > 0:
-            sell_amount_usd = current_position_qty * row['close']
-            pnl = (row['close'] - entry_price) * current_position_qty
-            
-            balance += sell_amount_usd
-            current_position_qty = 0.0 # 清零倉位
-            entry_price = 0.0 # 清零入場價格
-
+            logging.debug(f"BUY at {close[i]:.4f}, Qty: {trade_qty[k]:.6f}, Balance: {trade_balance[k]:.2f}")
+        else:
             trades.append({
-                'timestamp': row['open_time'],
+                'timestamp': int(open_time[i]),
                 'action': 'SELL',
-                'price': row['close'],
-                'quantity': sell_amount_usd / row['close'],
-                'pnl': pnl,
-                'balance': balance,
-                'equity': balance
+                'price': float(close[i]),
+                'quantity': float(trade_qty[k]),
+                'pnl': float(trade_pnl[k]),
+                'balance': float(trade_balance[k]),
+                'equity': float(trade_equity[k])
             })
-            logging.debug(f"SELL at {row['close']:.4f}, PnL: {pnl:.2f}, Balance: {balance:.2f}")
-
-        # 更新持倉價值
-        else: # 持倉中或無倉位
-            if current_position_qty > 0:
-                # 更新 equity
-                df_with_signals.loc[i, 'equity'] = balance + current_position_qty * row['close']
-            else:
-                df_with_signals.loc[i, 'equity'] = balance
+            logging.debug(f"SELL at {close[i]:.4f}, PnL: {trade_pnl[k]:.2f}, Balance: {trade_balance[k]:.2f}")
     
     # 計算回測結果
-    final_equity = balance + current_position_qty * df_with_signals.iloc[-1]['close'] if current_position_qty > 0 else balance
+    final_equity = balance + current_position_qty * close[-1] if current_position_qty > 0 else balance
     profit_loss = final_equity - initial_balance
     
-    # 統計交易次數和勝率
-    buy_trades = [t for t in trades if t['action'] == 'BUY']
-    sell_trades = [t for t in trades if t['action'] == 'SELL']
-    
-    num_trades = len(sell_trades) # 假設每次賣出都是平倉
-    winning_trades = [t for t in sell_trades if t.get('pnl', 0) > 0]
-    win_rate = len(winning_trades) / num_trades if num_trades > 0 else 0
+    # 統計交易次數和勝率 (直接在 _simulate 返回的陣列上計算)
+    sell_mask = trade_action[:num_trade_records] == 1
+    num_trades = int(sell_mask.sum()) # 假設每次賣出都是平倉
+    winning_trades = int((trade_pnl[:num_trade_records][sell_mask] > 0).sum())
+    win_rate = winning_trades / num_trades if num_trades > 0 else 0
 
     backtest_report = {
         "symbol": symbol,
@@ -212,8 +375,21 @@ def run_backtest(symbol, interval, start_date, end_date):
         "return_percentage": (profit_loss / initial_balance) * 100,
         "num_trades": num_trades,
         "win_rate": win_rate,
-        "trades_log": trades # 可以將每筆交易的詳細信息包含在內
+        "num_trade_records": len(trades)
     }
+
+    # 交易明細可能多達數萬筆：有設定 bucket 時寫入 GCS，報告中只放 URI，下游需要時再 pd.read_parquet
+    trades_uri = None
+    if BACKTEST_REPORTS_BUCKET and trades:
+        try:
+            trades_uri = store_trades_log(symbol, interval, start_date, end_date, trades)
+            logging.info(f"Trades log written to {trades_uri}")
+        except Exception as e:
+            logging.error(f"Error writing trades log to GCS, embedding it in the report instead: {e}", exc_info=True)
+    if trades_uri:
+        backtest_report["trades_uri"] = trades_uri
+    else:
+        backtest_report["trades_log"] = trades # 可以將每筆交易的詳細信息包含在內
     
     logging.info(f"Backtest completed for {symbol}. PnL: {profit_loss:.2f}, Return: {backtest_report['return_percentage']:.2f}%")
     
@@ -238,8 +414,9 @@ def main(event=None, context=None):
 
     if report:
         # 將回測報告發布到 Pub/Sub
-        message_data = json.dumps(report).encode('utf-8')
-        future = publisher.publish(backtest_reports_topic_path, message_data)
+        # 報告中可能含有 NumPy 純量 (例如 final_equity)，由 OPT_SERIALIZE_NUMPY 處理
+        message_data = orjson.dumps(report, option=orjson.OPT_SERIALIZE_NUMPY)
+        future = get_publisher().publish(backtest_reports_topic_path, message_data)
         future.add_done_callback(lambda f: logging.debug(f"Backtest report published with ID: {f.result()}"))
         logging.info("Backtest report published successfully.")
     else:
@@ -251,8 +428,8 @@ if __name__ == '__main__':
     # 用於本地測試
     # 您需要確保 Firestore 中有足夠的歷史K線數據
     # 例如：
-    # db.collection(KLINE_DATA_COLLECTION).add({'symbol': 'BTCUSDT', 'interval': '1h', 'open_time': 1678886400000, 'open': 20000, 'high': 20100, 'low': 19900, 'close': 20050, 'volume': 100})
-    # db.collection(KLINE_DATA_COLLECTION).add({'symbol': 'BTCUSDT', 'interval': '1h', 'open_time': 1678890000000, 'open': 20050, 'high': 20200, 'low': 20000, 'close': 20150, 'volume': 120})
+    # get_firestore_client().collection(KLINE_DATA_COLLECTION).add({'symbol': 'BTCUSDT', 'interval': '1h', 'open_time': 1678886400000, 'open': 20000, 'high': 20100, 'low': 19900, 'close': 20050, 'volume': 100})
+    # get_firestore_client().collection(KLINE_DATA_COLLECTION).add({'symbol': 'BTCUSDT', 'interval': '1h', 'open_time': 1678890000000, 'open': 20050, 'high': 20200, 'low': 20000, 'close': 20150, 'volume': 120})
     # ...
     main()
 
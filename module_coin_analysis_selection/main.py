@@ -1,9 +1,16 @@
 import os
-import json
+import orjson
 import logging
+import threading
+from collections import deque
 import pandas as pd
 from google.cloud import pubsub_v1
-from concurrent.futures import TimeoutError
+from google.api_core.exceptions import AlreadyExists, NotFound
+from concurrent.futures import TimeoutError, ThreadPoolExecutor
+try:
+    import redis
+except ImportError: # redis 為選用依賴；未安裝時只使用進程內緩存
+    redis = None
 
 # 配置日誌
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -12,6 +19,15 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID")
 PUBSUB_TOPIC_KLINE_UPDATES = os.environ.get("PUBSUB_TOPIC_KLINE_UPDATES", "kline-updates") # 訂閱 K 線更新
 PUBSUB_TOPIC_COIN_SELECTION_SIGNALS = os.environ.get("PUBSUB_TOPIC_COIN_SELECTION_SIGNALS", "coin-selection-signals") # 發布選幣信號
+# 設定 REDIS_HOST 後，K 線收盤價窗口保存在 Redis，多個實例共享狀態，重啟也不會丟失
+REDIS_HOST = os.environ.get("REDIS_HOST")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", "6379"))
+# 訂閱端流量控制與回調並行度
+SUBSCRIBER_MAX_MESSAGES = int(os.environ.get("SUBSCRIBER_MAX_MESSAGES", "500")) # 同時未確認的最大訊息數
+SUBSCRIBER_MAX_WORKERS = int(os.environ.get("SUBSCRIBER_MAX_WORKERS", "16")) # 處理回調的線程數
+# 訂閱已由 Terraform / gcloud 預先建立時，設 CREATE_SUBSCRIPTIONS_ON_START=0 跳過啟動時的管理 API 調用
+CREATE_SUBSCRIPTIONS_ON_START = os.environ.get("CREATE_SUBSCRIPTIONS_ON_START", "1") == "1"
+SUBSCRIPTION_SENTINEL_FILE = os.environ.get("SUBSCRIPTION_SENTINEL_FILE", "/tmp/.sub_ok") # 已確認存在的訂閱路徑，每行一個
 
 if not GCP_PROJECT_ID:
     logging.error("GCP_PROJECT_ID environment variable not set. Exiting.")
@@ -25,6 +41,14 @@ publisher = pubsub_v1.PublisherClient()
 subscription_path = subscriber.subscription_path(GCP_PROJECT_ID, f"{PUBSUB_TOPIC_KLINE_UPDATES}-sub-coin-selector")
 signals_topic_path = publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_COIN_SELECTION_SIGNALS)
 
+# 初始化 Redis 客戶端 (可選)
+redis_client = None
+if REDIS_HOST:
+    if redis is None:
+        logging.error("REDIS_HOST is set but the redis package is not installed. Exiting.")
+        exit(1)
+    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+
 
 # -------------------------------------------------------------------
 # 簡化範例：基於簡單移動平均線交叉的選幣邏輯
@@ -37,14 +61,48 @@ signals_topic_path = publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_COIN_SELE
 
 # 模擬一個簡單的策略狀態（實際中可能會存儲在資料庫或 Redis 中）
 # 這裡用於演示，但真正的 AI 模型會更複雜，可能需要加載預訓練模型
-coin_data_buffer = {} # {symbol: list of kline_data}
+coin_data_buffer = {} # {symbol: {'short': sma_state, 'long': sma_state}}
+coin_buffer_locks = {} # {symbol: threading.Lock}，回調並行執行時，同一交易對的緩存更新需串行
+
+# 範例：短期 SMA 和長期 SMA 的窗口大小
+SMA_SHORT_WINDOW = 5
+SMA_LONG_WINDOW = 10
 
-def calculate_sma(data, window):
-    """計算簡單移動平均線"""
-    if len(data) < window:
+def new_sma_state(window):
+    """建立滾動 SMA 狀態：固定長度的收盤價窗口及其總和"""
+    return {'window': deque(maxlen=window), 'sum': 0.0}
+
+def update_sma(state, close_price):
+    """
+    將新收盤價推入窗口並以滾動總和 O(1) 更新 SMA。
+    窗口未滿時返回 None (與逐次 sum(data[-window:]) 的行為一致)。
+    """
+    window = state['window']
+    if len(window) == window.maxlen:
+        state['sum'] -= window[0] # 即將被 append 淘汰的最舊收盤價
+    window.append(close_price)
+    state['sum'] += close_price
+    if len(window) < window.maxlen:
         return None
-    # 假設 data 是 K 線收盤價列表
-    return sum(data[-window:]) / window
+    return state['sum'] / window.maxlen
+
+def update_sma_redis(symbol, close_price):
+    """
+    將新收盤價寫入 Redis 中該交易對的收盤價列表，並返回 (短期 SMA, 長期 SMA)。
+    RPUSH/LTRIM/LRANGE 在同一個 MULTI/EXEC 管道中執行，多個實例同時更新也保持一致。
+    窗口未滿時對應的 SMA 為 None。
+    """
+    key = f"coin_selector:closes:{symbol}"
+    pipe = redis_client.pipeline()
+    pipe.rpush(key, close_price)
+    pipe.ltrim(key, -SMA_LONG_WINDOW, -1)
+    pipe.lrange(key, 0, -1)
+    _, _, values = pipe.execute()
+
+    closes = [float(v) for v in values]
+    sma_short = sum(closes[-SMA_SHORT_WINDOW:]) / SMA_SHORT_WINDOW if len(closes) >= SMA_SHORT_WINDOW else None
+    sma_long = sum(closes) / SMA_LONG_WINDOW if len(closes) >= SMA_LONG_WINDOW else None
+    return sma_short, sma_long
 
 def generate_simple_coin_selection_signal(kline_data):
     """
@@ -56,20 +114,21 @@ def generate_simple_coin_selection_signal(kline_data):
     close_price = float(kline_data['k']['c']) # K線收盤價
     
     # 為了演示，我們假設這個模組維護一個簡單的 K 線歷史
-    if symbol not in coin_data_buffer:
-        coin_data_buffer[symbol] = []
-    
-    # 只保留足夠計算 SMA 的 K 線數據
-    coin_data_buffer[symbol].append(close_price)
-    if len(coin_data_buffer[symbol]) > 20: # 例如，保留 20 根 K 線用於計算 SMA
-        coin_data_buffer[symbol].pop(0)
-
-    # 範例：計算短期 SMA 和長期 SMA
-    short_window = 5
-    long_window = 10
+    if redis_client is not None:
+        sma_short, sma_long = update_sma_redis(symbol, close_price)
+    else:
+        if symbol not in coin_data_buffer:
+            # 只保留足夠計算 SMA 的 K 線數據；deque 達到 maxlen 後 append 會自動以 O(1) 淘汰最舊的一根
+            # setdefault 為原子操作，並行回調不會互相覆蓋已建立的緩存
+            coin_data_buffer.setdefault(symbol, {
+                'short': new_sma_state(SMA_SHORT_WINDOW),
+                'long': new_sma_state(SMA_LONG_WINDOW),
+            })
 
-    sma_short = calculate_sma(coin_data_buffer[symbol], short_window)
-    sma_long = calculate_sma(coin_data_buffer[symbol], long_window)
+        buffer = coin_data_buffer[symbol]
+        with coin_buffer_locks.setdefault(symbol, threading.Lock()):
+            sma_short = update_sma(buffer['short'], close_price)
+            sma_long = update_sma(buffer['long'], close_price)
 
     signal_strength = 0.0
     recommendation = "NEUTRAL"
@@ -95,12 +154,27 @@ def generate_simple_coin_selection_signal(kline_data):
     }
 
 
+def log_publish_failure(future):
+    """Pub/Sub 發布完成的回調函數，只在發布失敗時記錄日誌"""
+    e = future.exception()
+    if e is not None:
+        logging.error(f"Failed to publish message: {e}")
+
+
 def process_kline_update(message: pubsub_v1.subscriber.message.Message):
     """
     處理接收到的 K 線更新訊息。
     """
     try:
-        kline_data = json.loads(message.data.decode('utf-8'))
+        # 先在原始 bytes 中查找 K 線閉合標記，未閉合的 K 線直接確認並跳過，無需解析整個 JSON
+        # (上游以緊湊格式序列化，不含空格；同時兼容帶空格的格式)
+        raw = message.data
+        if b'"x":true' not in raw and b'"x": true' not in raw:
+            logging.debug("Received incomplete kline. Skipping analysis.")
+            message.ack()
+            return
+
+        kline_data = orjson.loads(raw) # orjson 直接解析 bytes，無需先 decode
         
         # 確保 K 線是閉合的，避免處理不完整的 K 線
         if not kline_data['k']['x']: # 'x' 欄位表示 K 線是否閉合
@@ -120,16 +194,16 @@ def process_kline_update(message: pubsub_v1.subscriber.message.Message):
             logging.info(f"Generated signal for {symbol}: {selection_signal['recommendation']} (Strength: {selection_signal['signal_strength']:.2f})")
             
             # 發布選幣信號到 Pub/Sub
-            message_data = json.dumps(selection_signal).encode('utf-8')
+            message_data = orjson.dumps(selection_signal) # orjson 直接輸出 bytes
             future = publisher.publish(signals_topic_path, message_data)
-            future.add_done_callback(lambda f: logging.debug(f"Coin selection signal published with ID: {f.result()}"))
+            future.add_done_callback(log_publish_failure)
         else:
             logging.info(f"No strong signal for {symbol}@{interval}.")
 
         message.ack() # 確認訊息已處理
         logging.debug(f"Processed kline update for {symbol}@{interval}.")
 
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logging.error(f"Error decoding JSON message: {e} - Data: {message.data.decode('utf-8')}")
         message.nack() # 負確認訊息，稍後會重新投遞
     except Exception as e:
@@ -137,21 +211,51 @@ def process_kline_update(message: pubsub_v1.subscriber.message.Message):
         message.nack()
 
 
+def ensure_subscription(sub_path, topic_path):
+    """
+    確保訂閱存在。先以 get_subscription 檢查 (一次輕量讀取)，只有 NotFound 時才創建；
+    確認成功後記錄在 SUBSCRIPTION_SENTINEL_FILE，同一容器內重啟時直接跳過管理 API 調用。
+    注意：在生產環境中，通常會透過 Terraform 或手動在 GCP 控制台創建訂閱。
+    """
+    try:
+        with open(SUBSCRIPTION_SENTINEL_FILE) as f:
+            if sub_path in f.read().splitlines():
+                return
+    except OSError:
+        pass
+
+    try:
+        subscriber.get_subscription(subscription=sub_path)
+        logging.info(f"Subscription {sub_path} already exists.")
+    except NotFound:
+        try:
+            subscriber.create_subscription(name=sub_path, topic=topic_path)
+            logging.info(f"Subscription {sub_path} created.")
+        except AlreadyExists: # 其他實例同時啟動並已創建
+            logging.info(f"Subscription {sub_path} already exists.")
+
+    try:
+        with open(SUBSCRIPTION_SENTINEL_FILE, "a") as f:
+            f.write(sub_path + "\n")
+    except OSError as e:
+        logging.warning(f"Could not record subscription in {SUBSCRIPTION_SENTINEL_FILE}: {e}")
+
+
 def main():
     logging.info("Starting Coin Analysis & Selection Module...")
     
-    # 創建訂閱 (如果不存在)
-    try:
-        subscriber.create_subscription(name=subscription_path, topic=publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_KLINE_UPDATES))
-        logging.info(f"Subscription {subscription_path} created (if it didn't exist).")
-    except Exception as e:
-        if "AlreadyExists" in str(e):
-            logging.info(f"Subscription {subscription_path} already exists.")
-        else:
-            logging.error(f"Error creating subscription {subscription_path}: {e}")
+    # 確保訂閱存在（如果不存在則創建）；訂閱必須在開始拉取前存在，因此同步完成
+    if CREATE_SUBSCRIPTIONS_ON_START:
+        try:
+            ensure_subscription(subscription_path, publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_KLINE_UPDATES))
+        except Exception as e:
+            logging.error(f"Error ensuring subscription {subscription_path}: {e}")
             exit(1)
 
-    streaming_pull_future = subscriber.subscribe(subscription_path, callback=process_kline_update)
+    # 明確設定流量控制與回調線程池，高負載時避免訊息在客戶端無限堆積
+    flow_control = pubsub_v1.types.FlowControl(max_messages=SUBSCRIBER_MAX_MESSAGES, max_bytes=100 * 1024 * 1024)
+    scheduler = pubsub_v1.subscriber.scheduler.ThreadScheduler(executor=ThreadPoolExecutor(max_workers=SUBSCRIBER_MAX_WORKERS))
+    streaming_pull_future = subscriber.subscribe(subscription_path, callback=process_kline_update, flow_control=flow_control, scheduler=scheduler)
     logging.info(f"Listening for kline updates on {subscription_path}...")
 
     try:
@@ -1,5 +1,7 @@
 import os
 import json
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import secretmanager_v1beta1 as secretmanager
 from google.cloud import firestore
 import logging
@@ -16,6 +18,12 @@ if not GCP_PROJECT_ID:
     logging.error("GCP_PROJECT_ID environment variable not set.")
     exit(1)
 
+@functools.lru_cache(maxsize=32)
+def _access_secret(secret_resource_name):
+    """讀取秘密版本並緩存結果；失敗時拋出異常 (異常不會被 lru_cache 緩存，下次會重試)。"""
+    response = secret_client.access_secret_version(name=secret_resource_name)
+    return response.payload.data.decode("UTF-8")
+
 def get_secret(secret_name_env_var):
     """
     從 Secret Manager 獲取秘密值。
@@ -28,8 +36,7 @@ def get_secret(secret_name_env_var):
         return None
 
     try:
-        response = secret_client.access_secret_version(name=secret_resource_name)
-        secret_value = response.payload.data.decode("UTF-8")
+        secret_value = _access_secret(secret_resource_name)
         logging.info(f"Successfully accessed secret: {secret_name_env_var}")
         return secret_value
     except Exception as e:
@@ -46,10 +53,15 @@ def initialize_system_config():
     logging.info("Initializing system configuration...")
 
     # --- 從 Secret Manager 獲取敏感資訊 ---
-    config['BINANCE_API_KEY'] = get_secret("BINANCE_API_KEY_SECRET_NAME")
-    config['BINANCE_SECRET_KEY'] = get_secret("BINANCE_SECRET_KEY_SECRET_NAME")
-    config['TELEGRAM_BOT_TOKEN'] = get_secret("TELEGRAM_BOT_TOKEN_SECRET_NAME")
-    config['TELEGRAM_CHAT_ID'] = get_secret("TELEGRAM_CHAT_ID_SECRET_NAME") # 可以是一個ID或多個ID的列表（json string）
+    # 各秘密互不依賴，並行讀取以縮短冷啟動時間 (gRPC 呼叫期間會釋放 GIL)
+    secret_env_vars = {
+        'BINANCE_API_KEY': "BINANCE_API_KEY_SECRET_NAME",
+        'BINANCE_SECRET_KEY': "BINANCE_SECRET_KEY_SECRET_NAME",
+        'TELEGRAM_BOT_TOKEN': "TELEGRAM_BOT_TOKEN_SECRET_NAME",
+        'TELEGRAM_CHAT_ID': "TELEGRAM_CHAT_ID_SECRET_NAME", # 可以是一個ID或多個ID的列表（json string）
+    }
+    with ThreadPoolExecutor(max_workers=len(secret_env_vars)) as executor:
+        config.update(zip(secret_env_vars, executor.map(get_secret, secret_env_vars.values())))
     if config['TELEGRAM_CHAT_ID']:
         try:
             config['TELEGRAM_CHAT_ID'] = json.loads(config['TELEGRAM_CHAT_ID']) # 如果是JSON字串
@@ -1,8 +1,17 @@
 import os
-import json
+import orjson
 import logging
-from binance import ThreadedWebsocketManager
+import asyncio
+import functools
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from binance import AsyncClient, BinanceSocketManager
+try:
+    import uvloop
+except ImportError: # uvloop 為選用依賴；未安裝時使用標準 asyncio 事件循環
+    uvloop = None
 from google.cloud import pubsub_v1
+from google.cloud.pubsub_v1.types import LimitExceededBehavior
 from google.cloud import secretmanager_v1beta1 as secretmanager # 引入 Secret Manager 客戶端
 
 # 配置日誌
@@ -22,11 +31,49 @@ if not GCP_PROJECT_ID:
 secret_client = secretmanager.SecretManagerServiceClient()
 
 # 初始化 Pub/Sub Publisher 客戶端
-publisher = pubsub_v1.PublisherClient()
+# 深度/K 線流每秒可達數百條訊息，放大批次以攤薄每次 gRPC 請求的開銷 (預設僅 10 條 / 10ms)
+batch_settings = pubsub_v1.types.BatchSettings(
+    max_messages=int(os.environ.get("PUBSUB_BATCH_MAX_MESSAGES", "1000")),
+    max_bytes=1024 * 1024, # 1 MB
+    max_latency=float(os.environ.get("PUBSUB_BATCH_MAX_LATENCY", "0.05")), # 秒
+)
+# 發布積壓過多時阻塞發布調用 (在專用的發布線程池中，見 consume_socket)，而不是無限佔用內存
+publisher_options = pubsub_v1.types.PublisherOptions(
+    flow_control=pubsub_v1.types.PublishFlowControl(
+        message_limit=10000,
+        byte_limit=100 * 1024 * 1024, # 100 MB
+        limit_exceeded_behavior=LimitExceededBehavior.BLOCK,
+    ),
+)
+publisher = pubsub_v1.PublisherClient(batch_settings=batch_settings, publisher_options=publisher_options)
 kline_topic_path = publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_KLINE_UPDATES)
 order_book_topic_path = publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_ORDER_BOOK_UPDATES)
 account_topic_path = publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_ACCOUNT_UPDATES)
 
+# 深度更新的二進制幀 (須與 module_order_book_analysis 的解析保持一致)：
+# 標頭 <QHHB3x> (事件時間, 買單層數, 賣單層數, 交易對長度, 3 位元組填充)
+# | float64[2*買單層數] | float64[2*賣單層數] | 交易對 (ASCII)
+# 價格/數量以 [price, quantity] 交錯排列；填充讓浮點區段保持 8 位元組對齊，接收端可零拷貝讀取
+# 設為 json 時改回發布原始 JSON (接收端兩種格式都能處理)
+ORDER_BOOK_FRAME_FORMAT = os.environ.get("ORDER_BOOK_FRAME_FORMAT", "binary").lower()
+DEPTH_FRAME_ENCODING = "depth-f64-v1" # 以訊息屬性 'encoding' 標示幀格式
+DEPTH_FRAME_HEADER = struct.Struct("<QHHB3x")
+
+def pack_depth_frame(msg):
+    """將幣安 depthUpdate 訊息打包為二進制幀。"""
+    symbol = msg['s'].encode("ascii")
+    bids = msg['b']
+    asks = msg['a']
+    levels = [float(v) for level in bids for v in level]
+    levels.extend(float(v) for level in asks for v in level)
+    return DEPTH_FRAME_HEADER.pack(msg['E'], len(bids), len(asks), len(symbol)) + struct.pack(f"<{len(levels)}d", *levels) + symbol
+
+
+@functools.lru_cache(maxsize=32)
+def _access_secret(secret_resource_name):
+    """讀取秘密版本並緩存結果；失敗時拋出異常 (異常不會被 lru_cache 緩存，下次會重試)。"""
+    response = secret_client.access_secret_version(name=secret_resource_name)
+    return response.payload.data.decode("UTF-8")
 
 def get_secret(secret_name_env_var):
     """
@@ -37,67 +84,109 @@ def get_secret(secret_name_env_var):
         logging.warning(f"Environment variable '{secret_name_env_var}' for secret not set.")
         return None
     try:
-        response = secret_client.access_secret_version(name=secret_resource_name)
-        return response.payload.data.decode("UTF-8")
+        return _access_secret(secret_resource_name)
     except Exception as e:
         logging.error(f"Error accessing secret '{secret_resource_name}' via '{secret_name_env_var}': {e}")
         return None
 
 def get_binance_keys():
     """獲取幣安 API 金鑰和秘密金鑰"""
-    api_key = get_secret("BINANCE_API_KEY_SECRET_NAME")
-    secret_key = get_secret("BINANCE_SECRET_KEY_SECRET_NAME")
+    # 兩個秘密並行讀取，縮短冷啟動時間
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        api_key, secret_key = executor.map(get_secret, ["BINANCE_API_KEY_SECRET_NAME", "BINANCE_SECRET_KEY_SECRET_NAME"])
     return api_key, secret_key
 
 def handle_kline_message(msg):
-    """處理接收到的 K 線 WebSocket 訊息"""
-    logging.info(f"Received kline: {msg['s']}@{msg['k']['i']}")
+    """處理接收到的 K 線 WebSocket 訊息，返回要發布的 (topic_path, data, attributes)；不需要發布時返回 None"""
     # 這裡可以根據需要對訊息進行過濾或處理
     # msg 結構：{'e': 'kline', 'E': 1678886400000, 's': 'BTCUSDT', ...}
     # 確保只發布已關閉的K線 (即is_final_bar為True) 或根據需求發布實時K線
-    if msg['k']['x']: # 'x' 代表這根 K 線是否已關閉 (is_final_bar)
-        try:
-            # 將 K 線數據轉換為 JSON 字符串並發布到 Pub/Sub
-            message_data = json.dumps(msg).encode('utf-8')
-            future = publisher.publish(kline_topic_path, message_data)
-            future.add_done_callback(callback_pubsub_publish)
-            logging.debug(f"Published kline for {msg['s']}@{msg['k']['i']}")
-        except Exception as e:
-            logging.error(f"Error publishing kline message: {e}")
+    # 絕大多數推送都是未關閉的 K 線，先做判斷並直接返回，不做日誌格式化與序列化
+    k = msg['k']
+    if not k['x']: # 'x' 代表這根 K 線是否已關閉 (is_final_bar)
+        return None
+    logging.info(f"Received closed kline: {msg['s']}@{k['i']}")
+    # 將 K 線數據序列化為 JSON bytes 並發布到 Pub/Sub
+    return kline_topic_path, orjson.dumps(msg), {}
 
 def handle_depth_message(msg):
-    """處理接收到的訂單簿深度 WebSocket 訊息"""
+    """處理接收到的訂單簿深度 WebSocket 訊息，返回要發布的 (topic_path, data, attributes)"""
     # 這裡的 msg 結構會是 'depthUpdate' 類型
-    logging.info(f"Received depth update for {msg['s']}")
-    try:
-        message_data = json.dumps(msg).encode('utf-8')
-        future = publisher.publish(order_book_topic_path, message_data)
-        future.add_done_callback(callback_pubsub_publish)
-        logging.debug(f"Published depth update for {msg['s']}")
-    except Exception as e:
-        logging.error(f"Error publishing depth update message: {e}")
+    logging.debug("Received depth update for %s", msg['s']) # 每則深度更新一條，使用 DEBUG 與延遲格式化
+    if ORDER_BOOK_FRAME_FORMAT == "binary":
+        return order_book_topic_path, pack_depth_frame(msg), {"encoding": DEPTH_FRAME_ENCODING}
+    return order_book_topic_path, orjson.dumps(msg), {}
 
 def handle_user_data_message(msg):
-    """處理接收到的用戶數據（帳戶餘額、訂單更新）WebSocket 訊息"""
+    """處理接收到的用戶數據（帳戶餘額、訂單更新）WebSocket 訊息，返回要發布的 (topic_path, data, attributes)"""
     # msg 結構會包含 'e': 'outboundAccountPosition' 或 'e': 'executionReport' 等
     logging.info(f"Received user data: {msg['e']}")
+    return account_topic_path, orjson.dumps(msg), {}
+
+def publish_message(topic_path, data, attributes):
+    """發布一則訊息到 Pub/Sub。發布積壓時 publisher.publish 會阻塞 (LimitExceededBehavior.BLOCK)，因此在 publish_executor 中執行。"""
     try:
-        message_data = json.dumps(msg).encode('utf-8')
-        future = publisher.publish(account_topic_path, message_data)
+        future = publisher.publish(topic_path, data, **attributes)
         future.add_done_callback(callback_pubsub_publish)
-        logging.debug(f"Published user data: {msg['e']}")
     except Exception as e:
-        logging.error(f"Error publishing user data message: {e}")
+        logging.error(f"Error publishing message to {topic_path}: {e}")
 
 def callback_pubsub_publish(future):
-    """Pub/Sub 發布完成的回調函數"""
-    try:
-        message_id = future.result()
-        logging.debug(f"Message published with ID: {message_id}")
-    except Exception as e:
+    """Pub/Sub 發布完成的回調函數，只在發布失敗時記錄日誌"""
+    e = future.exception()
+    if e is not None:
         logging.error(f"Failed to publish message: {e}")
 
 
+async def consume_socket(socket, handler, publish_executor):
+    """
+    持續讀取單一 WebSocket 流，並將每條訊息交給對應的處理函數。
+    過濾與序列化在事件循環上完成 (未關閉的 K 線直接丟棄，不切換線程)，只有需要發布的訊息
+    才交給 publish_executor 發布。publish_executor 每條流一個線程：發布積壓而阻塞時只暫停
+    這一條流的讀取，不會佔用其他流的線程，事件循環仍能回應幣安的 ping。
+    每條流等待上一條訊息發布調用返回後才處理下一條，保持流內順序。
+    """
+    loop = asyncio.get_running_loop()
+    async with socket as stream:
+        while True:
+            msg = await stream.recv()
+            try:
+                publish_args = handler(msg)
+                if publish_args is not None:
+                    await loop.run_in_executor(publish_executor, publish_message, *publish_args)
+            except Exception as e: # 單條異常訊息 (例如錯誤事件) 不應中斷整條流
+                logging.error(f"Error handling websocket message: {e} - Message: {msg}")
+
+async def run_streams(api_key, secret_key, trade_symbols, kline_intervals):
+    """在單一 asyncio 事件循環中維護所有 WebSocket 流"""
+    client = await AsyncClient.create(api_key=api_key, api_secret=secret_key)
+    bsm = BinanceSocketManager(client)
+
+    logging.info(f"Subscribing to kline streams for symbols: {trade_symbols}, intervals: {kline_intervals}")
+    streams = []
+    for symbol in trade_symbols:
+        for interval in kline_intervals:
+            streams.append((bsm.kline_socket(symbol=symbol, interval=interval), handle_kline_message))
+        # 訂閱訂單簿深度流 (您可以選擇訂閱不同的深度級別，例如 @depth5, @depth10, @depth20)
+        streams.append((bsm.depth_socket(symbol=symbol), handle_depth_message))
+
+    # 訂閱用戶數據流 (帳戶餘額、訂單更新等)
+    # 啟動用戶數據流之前，確保您的API金鑰有讀取帳戶的權限
+    logging.info("Subscribing to user data stream...")
+    streams.append((bsm.user_socket(), handle_user_data_message))
+
+    # 專用的發布線程池，線程數等於流的數量 (預設線程池只有 min(32, CPU+4) 個線程，少於流的數量)
+    publish_executor = ThreadPoolExecutor(max_workers=len(streams), thread_name_prefix="publish")
+    tasks = [asyncio.create_task(consume_socket(socket, handler, publish_executor)) for socket, handler in streams]
+
+    logging.info("WebSocket streams started. Keeping service alive...")
+    # Cloud Run 服務需要保持運行來維護 WebSocket 連線；任一條流異常結束時拋出並退出，由平台重啟
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        publish_executor.shutdown(wait=False)
+        await client.close_connection()
+
 def main():
     api_key, secret_key = get_binance_keys()
 
@@ -105,43 +194,20 @@ def main():
         logging.error("Binance API keys not available. Cannot start WebSocket manager.")
         exit(1)
 
-    logging.info("Starting Binance ThreadedWebsocketManager...")
-    twm = ThreadedWebsocketManager(api_key=api_key, secret_key=secret_key)
-    twm.start()
-
     # 從環境變數獲取訂閱的交易對和K線間隔
     trade_symbols_str = os.environ.get("TRADE_SYMBOLS", "BTCUSDT,ETHUSDT").upper()
     trade_symbols = [s.strip() for s in trade_symbols_str.split(',')]
     kline_intervals_str = os.environ.get("KLINE_INTERVALS", "1m").lower()
     kline_intervals = [i.strip() for i in kline_intervals_str.split(',')]
 
-    logging.info(f"Subscribing to kline streams for symbols: {trade_symbols}, intervals: {kline_intervals}")
-    for symbol in trade_symbols:
-        for interval in kline_intervals:
-            twm.start_kline_socket(callback=handle_kline_message, symbol=symbol, interval=interval)
-        # 訂閱訂單簿深度流 (您可以選擇訂閱不同的深度級別，例如 @depth5, @depth10, @depth20)
-        twm.start_depth_socket(callback=handle_depth_message, symbol=symbol)
-
-    # 訂閱用戶數據流 (帳戶餘額、訂單更新等)
-    # 啟動用戶數據流之前，確保您的API金鑰有讀取帳戶的權限
-    logging.info("Subscribing to user data stream...")
-    twm.start_user_socket(callback=handle_user_data_message)
+    if uvloop is not None:
+        uvloop.install()
 
-
-    logging.info("WebSocket manager started. Keeping service alive...")
-    # Cloud Run 服務需要保持運行來維護 WebSocket 連線
-    # 這裡使用一個無限循環來防止服務終止
+    logging.info("Starting Binance WebSocket streams...")
     try:
-        while True:
-            # 可以添加一些健康檢查或心跳邏輯
-            import time
-            time.sleep(60) # 每分鐘檢查一次，防止過度消耗CPU
+        asyncio.run(run_streams(api_key, secret_key, trade_symbols, kline_intervals))
     except KeyboardInterrupt:
-        logging.info("Stopping WebSocket manager...")
-        twm.stop()
         logging.info("Service terminated.")
 
 if __name__ == '__main__':
     main()
-
-
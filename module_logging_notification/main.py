@@ -1,11 +1,21 @@
 import os
-import json
+import orjson
 import logging
+import threading
+import time
+import functools
+import queue
+from collections import deque
 from google.cloud import pubsub_v1
+from google.api_core.exceptions import AlreadyExists, NotFound
 from google.cloud import logging as cloud_logging
+from google.cloud.logging.handlers import CloudLoggingHandler
+from google.cloud.logging.handlers.transports import BackgroundThreadTransport
 from google.cloud import secretmanager_v1beta1 as secretmanager
 import requests # 用於發送 Telegram 訊息
-from concurrent.futures import TimeoutError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import TimeoutError, ThreadPoolExecutor, wait, FIRST_EXCEPTION
 
 # 配置日誌
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,10 +33,30 @@ if not GCP_PROJECT_ID:
 
 # 初始化 Google Cloud Logging 客戶端
 cloud_logger_client = cloud_logging.Client(project=GCP_PROJECT_ID)
-logger = cloud_logger_client.logger("trading-bot-logs") # 設定日誌名稱
+# 事件日誌經由 CloudLoggingHandler + BackgroundThreadTransport 寫入：條目先進入內存隊列，
+# 由背景線程按批次 (最多 CLOUD_LOGGING_BATCH_SIZE 條) 發送，而不是每則訊息一次同步 RPC
+CLOUD_LOGGING_BATCH_SIZE = int(os.environ.get("CLOUD_LOGGING_BATCH_SIZE", "500"))
+CLOUD_LOGGING_GRACE_PERIOD = float(os.environ.get("CLOUD_LOGGING_GRACE_PERIOD", "5.0")) # 關閉時等待剩餘條目送出的秒數
+cloud_log_handler = CloudLoggingHandler(
+    cloud_logger_client,
+    name="trading-bot-logs", # 設定日誌名稱
+    transport=functools.partial(BackgroundThreadTransport, batch_size=CLOUD_LOGGING_BATCH_SIZE, grace_period=CLOUD_LOGGING_GRACE_PERIOD),
+)
+logger = logging.getLogger("trading-bot-logs")
+logger.setLevel(logging.DEBUG)
+logger.addHandler(cloud_log_handler)
+logger.propagate = False # 事件只寫入 Cloud Logging，不重複輸出到本地日誌
 
 # 初始化 Pub/Sub 客戶端
 subscriber = pubsub_v1.SubscriberClient()
+publisher = pubsub_v1.PublisherClient() # 只用於組出 Topic 路徑
+
+# 訂閱端並行度：每個訂閱開啟多條 streaming pull (各自使用獨立的 SubscriberClient / gRPC 通道)
+SUBSCRIBER_STREAMS = int(os.environ.get("SUBSCRIBER_STREAMS", str(os.cpu_count() or 1)))
+SUBSCRIBER_MAX_WORKERS = 2 * (os.cpu_count() or 1) # 每條 streaming pull 處理回調的線程數
+SUBSCRIBER_FLOW_CONTROL = pubsub_v1.types.FlowControl(max_messages=1000, max_bytes=50_000_000)
+stream_clients = [] # 所有 streaming pull 使用的 SubscriberClient，停止時統一關閉
+SUBSCRIPTION_SENTINEL_FILE = os.environ.get("SUBSCRIPTION_SENTINEL_FILE", "/tmp/.sub_ok") # 已確認存在的訂閱路徑，每行一個
 
 # 初始化 Secret Manager 客戶端
 secret_client = secretmanager.SecretManagerServiceClient()
@@ -34,63 +64,311 @@ secret_client = secretmanager.SecretManagerServiceClient()
 # 獲取 Telegram 憑證
 TELEGRAM_BOT_TOKEN = None
 TELEGRAM_CHAT_ID = None
+TELEGRAM_SEND_URL = None # 由 initialize_telegram_creds 依 Bot Token 組出
+
+# 共用的 HTTP Session：保持與 api.telegram.org 的長連接，避免每則訊息都重新建立 TCP+TLS 連線
+telegram_session = requests.Session()
+telegram_session.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=32,
+    # sendMessage 是 POST，需明確允許重試；遇到 429 時會遵循 Retry-After
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=frozenset(["POST"])),
+))
+TELEGRAM_TIMEOUT = (3, 5) # (連線, 讀取) 逾時秒數
+
+# 多個聊天並行發送；整體等待時間約等於最慢的一次發送，而不是所有發送時間之和
+telegram_pool = ThreadPoolExecutor(max_workers=8)
+TELEGRAM_SEND_WAIT_TIMEOUT = 10 # 秒，超過後記錄警告並繼續等待 (不放棄仍在進行中的發送)
+# 單一聊天的發送結果：暫時性失敗 (逾時、連線錯誤、429、5xx) 才值得重新投遞；
+# 其他 4xx (例如 MarkdownV2 格式錯誤) 重新發送也一樣會被拒絕
+TELEGRAM_SENT = "sent"
+TELEGRAM_REJECTED = "rejected"
+TELEGRAM_RETRYABLE = "retryable"
+# Telegram 限制：同一聊天約每秒 1 則，全局約每秒 30 則
+TELEGRAM_PER_CHAT_INTERVAL = 1.0
+TELEGRAM_GLOBAL_RATE = 30
+telegram_rate_lock = threading.Lock()
+telegram_chat_next_send = {} # {chat_id: 下一次最早可發送的時間 (monotonic)}
+telegram_recent_sends = deque(maxlen=TELEGRAM_GLOBAL_RATE) # 最近預留的全局發送時間
+
+# 秘密值緩存：{secret_resource_name: (讀取時間, 秘密值)}
+secret_cache = {}
+SECRET_CACHE_TTL = int(os.environ.get("SECRET_CACHE_TTL", "300")) # 秒
 
 def get_secret(secret_name_env_var):
+    """
+    從 Secret Manager 獲取秘密值，結果在 SECRET_CACHE_TTL 秒內直接取自緩存。
+    讀取失敗時若有舊值則沿用舊值 (暫時性錯誤不應讓通知功能失效)。
+    """
     secret_resource_name = os.environ.get(secret_name_env_var)
     if not secret_resource_name:
         logging.warning(f"Environment variable '{secret_name_env_var}' for secret not set.")
         return None
+
+    cached = secret_cache.get(secret_resource_name)
+    if cached and time.monotonic() - cached[0] < SECRET_CACHE_TTL:
+        return cached[1]
     try:
         response = secret_client.access_secret_version(name=secret_resource_name)
-        return response.payload.data.decode("UTF-8")
+        secret_value = response.payload.data.decode("UTF-8")
+        secret_cache[secret_resource_name] = (time.monotonic(), secret_value)
+        return secret_value
     except Exception as e:
+        if cached:
+            logging.warning(f"Error refreshing secret '{secret_resource_name}' via '{secret_name_env_var}', using cached value: {e}")
+            return cached[1]
         logging.error(f"Error accessing secret '{secret_resource_name}' via '{secret_name_env_var}': {e}")
         return None
 
 def initialize_telegram_creds():
-    global TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID
+    """讀取 Telegram 憑證；秘密已有緩存，可定期重新調用以取得輪替後的值。"""
+    global TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, TELEGRAM_SEND_URL
     TELEGRAM_BOT_TOKEN = get_secret("TELEGRAM_BOT_TOKEN_SECRET_NAME")
+    if TELEGRAM_BOT_TOKEN:
+        TELEGRAM_SEND_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
     chat_ids_str = get_secret("TELEGRAM_CHAT_ID_SECRET_NAME")
     if chat_ids_str:
         try:
             # 如果是JSON字串，解析為列表；否則視為單個ID
-            TELEGRAM_CHAT_ID = json.loads(chat_ids_str)
-        except json.JSONDecodeError:
+            TELEGRAM_CHAT_ID = orjson.loads(chat_ids_str)
+        except orjson.JSONDecodeError:
             TELEGRAM_CHAT_ID = [chat_ids_str] # 視為單個ID的列表
     
     if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
         logging.warning("Telegram Bot Token or Chat ID(s) not configured. Telegram notifications will be disabled.")
 
+def reserve_telegram_slot(chat_id):
+    """按頻率限制為一次發送預留時間，返回發送前需要等待的秒數。"""
+    with telegram_rate_lock:
+        now = time.monotonic()
+        send_at = max(now, telegram_chat_next_send.get(chat_id, 0.0))
+        if len(telegram_recent_sends) == TELEGRAM_GLOBAL_RATE:
+            send_at = max(send_at, telegram_recent_sends[0] + 1.0)
+        telegram_chat_next_send[chat_id] = send_at + TELEGRAM_PER_CHAT_INTERVAL
+        telegram_recent_sends.append(send_at)
+        return send_at - now
+
+def send_telegram_message_to_chat(cid, message_text):
+    """發送訊息到單一 Telegram 聊天，返回 TELEGRAM_SENT / TELEGRAM_REJECTED / TELEGRAM_RETRYABLE。"""
+    delay = reserve_telegram_slot(cid)
+    if delay > 0:
+        time.sleep(delay)
+
+    payload = {
+        "chat_id": cid,
+        "text": message_text,
+        "parse_mode": "MarkdownV2" # 可以使用 Markdown 格式
+    }
+    try:
+        response = telegram_session.post(TELEGRAM_SEND_URL, json=payload, timeout=TELEGRAM_TIMEOUT)
+        response.raise_for_status() # 如果請求失敗，拋出 HTTPError
+        logging.info(f"Telegram message sent to chat ID {cid}.")
+        return TELEGRAM_SENT
+    except requests.exceptions.HTTPError as e:
+        # 429 / 5xx 在 HTTPAdapter 重試用盡後會以 RetryError 拋出；到這裡的通常是其他 4xx
+        logging.error(f"Error sending Telegram message to {cid}: {e}")
+        logging.error(f"Telegram response: {response.text}")
+        if response.status_code == 429 or response.status_code >= 500:
+            return TELEGRAM_RETRYABLE
+        return TELEGRAM_REJECTED
+    except requests.exceptions.RequestException as e: # 逾時、連線錯誤、重試用盡
+        logging.error(f"Error sending Telegram message to {cid}: {e}")
+        return TELEGRAM_RETRYABLE
+
 def send_telegram_message(message_text, chat_id=None):
-    """發送訊息到 Telegram。"""
+    """
+    發送訊息到 Telegram，返回是否應重新投遞 (True 表示需要重新投遞)。
+    只有沒有任何聊天收到、且至少一個聊天是暫時性失敗時才需要重新投遞：
+    已送達部分聊天時重新投遞會讓這些聊天收到重複通知，改為記錄未送達的聊天。
+    等待所有發送完成後才返回 (超過 TELEGRAM_SEND_WAIT_TIMEOUT 只記錄警告)，
+    避免放棄仍在進行中、稍後仍會送達的發送；等待期間訂閱端客戶端會持續延長訊息租約。
+    """
     if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
         logging.warning("Telegram notification not enabled due to missing configuration.")
-        return
+        return False
 
     target_chat_ids = TELEGRAM_CHAT_ID if chat_id is None else [chat_id]
 
-    for cid in target_chat_ids:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        payload = {
-            "chat_id": cid,
-            "text": message_text,
-            "parse_mode": "MarkdownV2" # 可以使用 Markdown 格式
-        }
+    futures = [telegram_pool.submit(send_telegram_message_to_chat, cid, message_text) for cid in target_chat_ids]
+    _, not_done = wait(futures, timeout=TELEGRAM_SEND_WAIT_TIMEOUT)
+    if not_done:
+        logging.warning(f"{len(not_done)} Telegram message(s) still pending after {TELEGRAM_SEND_WAIT_TIMEOUT}s. Waiting for them to finish.")
+        wait(not_done)
+    results = [future.result() for future in futures]
+    if TELEGRAM_RETRYABLE not in results:
+        return False
+    if TELEGRAM_SENT in results:
+        missed = [cid for cid, result in zip(target_chat_ids, results) if result == TELEGRAM_RETRYABLE]
+        logging.error(f"Telegram message delivered to some chats but not to {missed}. Not retrying to avoid duplicates.")
+        return False
+    return True
+
+
+# -------------------------------------------------------------------
+# Telegram 訊息模板：在模組載入時建立，每則訊息只需一次 str.format 調用
+# -------------------------------------------------------------------
+TRADE_REPORT_TEMPLATE = (
+    "**交易報告**\n"
+    "幣種: `{symbol}`\n"
+    "動作: `{action}`\n"
+    "數量: `{quantity}`\n"
+    "狀態: `{status}`\n"
+    "成交價: `{executed_price}`\n"
+    "錯誤: `{error_msg}`"
+).format
+RISK_ALERT_TEMPLATE = (
+    "🚨 **風險警報** 🚨\n"
+    "原因: `{reason}`\n"
+    "幣種: `{symbol}`"
+).format
+OPTIMIZATION_ALERT_TEMPLATE = (
+    "📈 **策略優化警報** 📊\n"
+    "P&L: `{pnl}`\n"
+    "勝率: `{win_rate}`\n"
+    "新配置:\n"
+    "  買入閾值: `{buy_threshold}`\n"
+    "  賣出閾值: `{sell_threshold}`\n"
+    "  單筆風險: `{risk_per_trade}`"
+).format
+DEFAULT_EVENT_TEMPLATE = "**Bot 事件 ({event_type}):**\n```json\n{payload}\n```".format
+
+def format_number(value, fmt):
+    """數值按 fmt 格式化；缺失值 (例如 'N/A' 或 None) 原樣轉為字串，避免格式化時拋出異常。"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return format(value, fmt)
+    return str(value)
+
+def build_trade_report_message(data):
+    return TRADE_REPORT_TEMPLATE(
+        symbol=data.get('symbol', 'N/A'),
+        action=data.get('action', 'N/A'),
+        quantity=format_number(data.get('quantity_requested', 'N/A'), '.6f'),
+        status=data.get('status', 'N/A'),
+        executed_price=format_number(data.get('executed_price', 'N/A'), '.4f'),
+        error_msg=data.get('error_message', ''),
+    )
+
+def build_risk_alert_message(data):
+    return RISK_ALERT_TEMPLATE(reason=data.get('reason', 'N/A'), symbol=data.get('symbol', 'N/A'))
+
+def build_optimization_alert_message(data):
+    new_config = data.get('new_config', {})
+    performance_metrics = data.get('performance_metrics', {})
+    return OPTIMIZATION_ALERT_TEMPLATE(
+        pnl=format_number(performance_metrics.get('total_profit_loss', 'N/A'), '.2f'),
+        win_rate=format_number(performance_metrics.get('win_rate', 'N/A'), '.2f'),
+        buy_threshold=new_config.get('BUY_SIGNAL_THRESHOLD', 'N/A'),
+        sell_threshold=new_config.get('SELL_SIGNAL_THRESHOLD', 'N/A'),
+        risk_per_trade=new_config.get('DEFAULT_RISK_PER_TRADE', 'N/A'),
+    )
+
+TELEGRAM_MESSAGE_BUILDERS = {
+    "TRADE_REPORT": build_trade_report_message,
+    "RISK_ALERT": build_risk_alert_message,
+    "OPTIMIZATION_ALERT": build_optimization_alert_message,
+}
+
+
+# 通知隊列：Pub/Sub 回調只負責解析並確認訊息，Cloud Logging 寫入與 Telegram 發送由背景線程處理，
+# 外部服務變慢時不會拖延 ack 而導致訊息被重新投遞
+NOTIFY_QUEUE_SIZE = int(os.environ.get("NOTIFY_QUEUE_SIZE", "10000"))
+NOTIFY_WORKERS = int(os.environ.get("NOTIFY_WORKERS", "4"))
+# 隊列積壓超過高水位時 (通常是 Telegram 變慢)，訊息改為延長確認期限、由背景線程發送成功後才確認：
+# 未確認的訊息佔用訂閱端流量控制額度，自然降低拉取速度，而不是繼續確認後在隊列滿時丟棄
+NOTIFY_QUEUE_HIGH_WATER = int(os.environ.get("NOTIFY_QUEUE_HIGH_WATER", str(NOTIFY_QUEUE_SIZE // 2)))
+NOTIFY_ACK_DEADLINE_SECONDS = 60
+notification_queue = queue.Queue(maxsize=NOTIFY_QUEUE_SIZE)
+# 隊列中已積壓的多則通知合併為一則 Telegram 訊息發送 (不額外等待)：同一聊天每秒只能發送約 1 則，
+# 合併後突發事件不會逐則排隊等待頻率限制
+NOTIFY_BATCH_MAX = int(os.environ.get("NOTIFY_BATCH_MAX", "20"))
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096 # Telegram 單則訊息的字元上限
+
+def take_notifications(first):
+    """從通知隊列取出最多 NOTIFY_BATCH_MAX 則事件 (first 為已取出的第一則)。"""
+    items = [first]
+    while len(items) < NOTIFY_BATCH_MAX:
         try:
-            response = requests.post(url, json=payload)
-            response.raise_for_status() # 如果請求失敗，拋出 HTTPError
-            logging.info(f"Telegram message sent to chat ID {cid}.")
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Error sending Telegram message to {cid}: {e}")
-            logging.error(f"Telegram response: {response.text if 'response' in locals() else 'No response'}")
+            items.append(notification_queue.get_nowait())
+        except queue.Empty:
+            break
+    return items
+
+def join_telegram_messages(entries):
+    """
+    以空行連接多則訊息，每則合併後的訊息不超過 TELEGRAM_MAX_MESSAGE_LENGTH 字元 (單則超長的訊息原樣保留)。
+    entries: [(text, pending_message)]；返回 [(合併後的訊息, [其中延後確認的訊息])]，
+    每則合併訊息的發送結果只決定它自己包含的訊息是否確認。
+    """
+    joined = []
+    current = ""
+    current_pending = []
+    for text, pending_message in entries:
+        if current and len(current) + 2 + len(text) > TELEGRAM_MAX_MESSAGE_LENGTH:
+            joined.append((current, current_pending))
+            current = text
+            current_pending = []
+        else:
+            current = f"{current}\n\n{text}" if current else text
+        if pending_message is not None:
+            current_pending.append(pending_message)
+    if current:
+        joined.append((current, current_pending))
+    return joined
+
+def notification_worker():
+    """從通知隊列取出一批事件，寫入 Cloud Logging，並合併為盡量少的 Telegram 訊息發送。"""
+    while True:
+        items = take_notifications(notification_queue.get())
+        entries = [] # [(text, pending_message)]
+        for log_entry, event_type, data, pending_message in items:
+            try:
+                # 只放入 Cloud Logging 背景傳輸隊列，實際寫入按批次進行
+                level = logging.getLevelName(log_entry["severity"])
+                logger.log(level if isinstance(level, int) else logging.INFO, log_entry, extra={"labels": log_entry["labels"]})
+                logging.debug("Queued %s event for Cloud Logging.", event_type)
 
+                # 依事件類型選擇 Telegram 訊息模板
+                build_message = TELEGRAM_MESSAGE_BUILDERS.get(event_type)
+                if build_message is not None:
+                    text = build_message(data)
+                else:
+                    text = DEFAULT_EVENT_TEMPLATE(event_type=event_type, payload=orjson.dumps(data, option=orjson.OPT_INDENT_2).decode())
+                entries.append((text, pending_message))
+            except Exception as e:
+                logging.error(f"Error preparing {event_type} notification: {e}", exc_info=True)
+                if pending_message is not None:
+                    pending_message.nack()
 
-def process_message(message: pubsub_v1.subscriber.message.Message):
+        try:
+            # 每則合併訊息獨立決定其中延後確認的訊息：只有需要重新投遞時才 nack，已送達的其他合併訊息照常確認
+            for telegram_message, chunk_pending in join_telegram_messages(entries):
+                try:
+                    retry = send_telegram_message(telegram_message)
+                except Exception as e:
+                    logging.error(f"Error sending Telegram notification: {e}", exc_info=True)
+                    retry = True
+                for pending_message in chunk_pending:
+                    if retry:
+                        pending_message.nack()
+                    else:
+                        pending_message.ack()
+            logging.info(f"Processed {len(entries)} event(s) and sent notification.")
+        except Exception as e:
+            logging.error(f"Error sending {len(entries)} notification(s): {e}", exc_info=True)
+            for _, pending_message in entries:
+                if pending_message is not None:
+                    pending_message.nack() # 已確認的訊息再次 nack 不會生效
+        finally:
+            for _ in items:
+                notification_queue.task_done()
+
+def process_message(message: pubsub_v1.subscriber.message.Message, source_topic):
     """
-    通用訊息處理函數，將訊息記錄到 Cloud Logging 並發送 Telegram 通知。
+    通用訊息處理函數：解析訊息後立即確認 (隊列積壓時改為發送完成後確認)，並交給通知隊列記錄到 Cloud Logging 及發送 Telegram 通知。
+    source_topic 為訊息來源的 Topic 名稱，在訂閱時綁定 (每個訂閱對應固定的 Topic)。
     """
     try:
-        data = json.loads(message.data.decode('utf-8'))
+        data = orjson.loads(message.data) # orjson 直接解析 bytes
         message_attributes = message.attributes
 
         event_type = message_attributes.get('eventType', 'UNKNOWN_EVENT')
@@ -101,61 +379,27 @@ def process_message(message: pubsub_v1.subscriber.message.Message):
             "jsonPayload": data,
             "labels": {
                 "event_type": event_type,
-                "source_topic": message.subscription.split('/')[-2] # 從訂閱路徑解析 Topic 名稱
+                "source_topic": source_topic
             }
         }
-        logger.log_struct(log_entry, severity=log_level.upper())
-        logging.info(f"Logged {event_type} event to Cloud Logging.")
-
-        # 發送 Telegram 通知
-        telegram_message = ""
-        if event_type == "TRADE_REPORT":
-            status = data.get('status', 'N/A')
-            symbol = data.get('symbol', 'N/A')
-            action = data.get('action', 'N/A')
-            quantity = data.get('quantity_requested', 'N/A')
-            executed_price = data.get('executed_price', 'N/A')
-            error_msg = data.get('error_message', '')
-            
-            telegram_message = (
-                f"**交易報告**\n"
-                f"幣種: `{symbol}`\n"
-                f"動作: `{action}`\n"
-                f"數量: `{quantity:.6f}`\n"
-                f"狀態: `{status}`\n"
-                f"成交價: `{executed_price:.4f}`\n"
-                f"錯誤: `{error_msg}`"
-            )
-        elif event_type == "RISK_ALERT":
-            reason = data.get('reason', 'N/A')
-            symbol = data.get('symbol', 'N/A')
-            telegram_message = (
-                f"🚨 **風險警報** 🚨\n"
-                f"原因: `{reason}`\n"
-                f"幣種: `{symbol}`"
-            )
-        elif event_type == "OPTIMIZATION_ALERT":
-            new_config = data.get('new_config', {})
-            pnl = data.get('performance_metrics', {}).get('total_profit_loss', 'N/A')
-            win_rate = data.get('performance_metrics', {}).get('win_rate', 'N/A')
-            telegram_message = (
-                f"📈 **策略優化警報** 📊\n"
-                f"P&L: `{pnl:.2f}`\n"
-                f"勝率: `{win_rate:.2f}`\n"
-                f"新配置:\n"
-                f"  買入閾值: `{new_config.get('BUY_SIGNAL_THRESHOLD', 'N/A')}`\n"
-                f"  賣出閾值: `{new_config.get('SELL_SIGNAL_THRESHOLD', 'N/A')}`\n"
-                f"  單筆風險: `{new_config.get('DEFAULT_RISK_PER_TRADE', 'N/A')}`"
-            )
-        else:
-            telegram_message = f"**Bot 事件 ({event_type}):**\n```json\n{json.dumps(data, indent=2)}\n```"
 
-        send_telegram_message(telegram_message)
-        
-        message.ack() # 確認訊息已處理
-        logging.info(f"Processed message from topic and sent notification.")
+        if notification_queue.qsize() > NOTIFY_QUEUE_HIGH_WATER:
+            # 積壓中：先延長確認期限，由背景線程發送完成後再確認
+            message.modify_ack_deadline(NOTIFY_ACK_DEADLINE_SECONDS)
+            pending_message = message
+        else:
+            message.ack() # 確認訊息已接收，後續處理不再阻塞 Pub/Sub
+            pending_message = None
+        try:
+            notification_queue.put_nowait((log_entry, event_type, data, pending_message))
+        except queue.Full:
+            if pending_message is not None:
+                logging.warning(f"Notification queue is full. Returning {event_type} event for redelivery.")
+                message.nack()
+            else:
+                logging.error(f"Notification queue is full. Dropping {event_type} event.")
 
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logging.error(f"Error decoding JSON message: {e} - Data: {message.data.decode('utf-8')}")
         message.nack()
     except Exception as e:
@@ -163,55 +407,102 @@ def process_message(message: pubsub_v1.subscriber.message.Message):
         message.nack()
 
 
+def ensure_subscription(sub_path, topic_path):
+    """
+    確保訂閱存在。先以 get_subscription 檢查 (一次輕量讀取)，只有 NotFound 時才創建；
+    確認成功後記錄在 SUBSCRIPTION_SENTINEL_FILE，同一容器內重啟時直接跳過管理 API 調用。
+    注意：在生產環境中，通常會透過 Terraform 或手動在 GCP 控制台創建訂閱。
+    """
+    try:
+        with open(SUBSCRIPTION_SENTINEL_FILE) as f:
+            if sub_path in f.read().splitlines():
+                return
+    except OSError:
+        pass
+
+    try:
+        subscriber.get_subscription(subscription=sub_path)
+        logging.info(f"Subscription {sub_path} already exists.")
+    except NotFound:
+        try:
+            subscriber.create_subscription(name=sub_path, topic=topic_path)
+            logging.info(f"Subscription {sub_path} created.")
+        except AlreadyExists: # 其他實例同時啟動並已創建
+            logging.info(f"Subscription {sub_path} already exists.")
+
+    try:
+        with open(SUBSCRIPTION_SENTINEL_FILE, "a") as f:
+            f.write(sub_path + "\n")
+    except OSError as e:
+        logging.warning(f"Could not record subscription in {SUBSCRIPTION_SENTINEL_FILE}: {e}")
+
+
+def subscribe_streams(sub_path, callback):
+    """
+    為一個訂閱開啟 SUBSCRIBER_STREAMS 條 streaming pull，每條使用獨立的客戶端與回調線程池，
+    並設定流量控制。不同訂閱各自擁有自己的 streams，避免互相阻塞。返回 streaming pull futures。
+    """
+    futures = []
+    for _ in range(SUBSCRIBER_STREAMS):
+        client = pubsub_v1.SubscriberClient()
+        stream_clients.append(client)
+        scheduler = pubsub_v1.subscriber.scheduler.ThreadScheduler(executor=ThreadPoolExecutor(max_workers=SUBSCRIBER_MAX_WORKERS))
+        # await_callbacks_on_shutdown：cancel() 會等待進行中的回調完成後才返回
+        futures.append(client.subscribe(sub_path, callback=callback, flow_control=SUBSCRIBER_FLOW_CONTROL, scheduler=scheduler, await_callbacks_on_shutdown=True))
+    return futures
+
+
 def main():
     logging.info("Starting Logging & Notification Module...")
     
     initialize_telegram_creds() # 初始化 Telegram 憑證
 
-    # 設置多個訂閱路徑
-    subscriptions = []
-    subscriptions.append(subscriber.subscription_path(GCP_PROJECT_ID, f"{PUBSUB_TOPIC_TRADE_REPORTS}-sub-notifier"))
-    subscriptions.append(subscriber.subscription_path(GCP_PROJECT_ID, f"{PUBSUB_TOPIC_RISK_ALERTS}-sub-notifier"))
-    subscriptions.append(subscriber.subscription_path(GCP_PROJECT_ID, f"{PUBSUB_TOPIC_OPTIMIZATION_ALERTS}-sub-notifier"))
-    
+    # 啟動通知背景線程
+    for _ in range(NOTIFY_WORKERS):
+        threading.Thread(target=notification_worker, daemon=True).start()
+
+    # 設置多個訂閱路徑：{訂閱路徑: Topic 名稱}，啟動時建立一次
+    subscription_topics = {
+        subscriber.subscription_path(GCP_PROJECT_ID, f"{topic_name}-sub-notifier"): topic_name
+        for topic_name in (PUBSUB_TOPIC_TRADE_REPORTS, PUBSUB_TOPIC_RISK_ALERTS, PUBSUB_TOPIC_OPTIMIZATION_ALERTS)
+    }
+
     # 創建訂閱 (如果不存在)
-    for sub_path, topic_name in [
-        (subscriptions[0], PUBSUB_TOPIC_TRADE_REPORTS),
-        (subscriptions[1], PUBSUB_TOPIC_RISK_ALERTS),
-        (subscriptions[2], PUBSUB_TOPIC_OPTIMIZATION_ALERTS)
-    ]:
+    for sub_path, topic_name in subscription_topics.items():
         try:
-            subscriber.create_subscription(name=sub_path, topic=publisher.topic_path(GCP_PROJECT_ID, topic_name))
-            logging.info(f"Subscription {sub_path} created (if it didn't exist).")
+            ensure_subscription(sub_path, publisher.topic_path(GCP_PROJECT_ID, topic_name))
         except Exception as e:
-            if "AlreadyExists" in str(e):
-                logging.info(f"Subscription {sub_path} already exists.")
-            else:
-                logging.error(f"Error creating subscription {sub_path}: {e}")
-                exit(1)
+            logging.error(f"Error ensuring subscription {sub_path}: {e}")
+            exit(1)
 
     # 啟動多個訂閱監聽
     futures = []
-    for sub_path in subscriptions:
-        futures.append(subscriber.subscribe(sub_path, callback=process_message))
+    for sub_path, topic_name in subscription_topics.items():
+        # 來源 Topic 綁定到回調，不必每則訊息再從訂閱路徑解析
+        futures.extend(subscribe_streams(sub_path, functools.partial(process_message, source_topic=topic_name)))
         logging.info(f"Listening for messages on {sub_path}...")
 
     try:
-        # 阻塞主線程，直到所有訂閱結束（實際上是永遠運行）
-        for future in futures:
-            future.result()
+        # 等待任一 streaming pull 結束或失敗，而不是逐個 future.result() 串行阻塞；
+        # 一條失敗時立即停止其餘的，讓服務盡快退出並由平台重啟
+        done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+        for future in done:
+            future.result() # 拋出導致訂閱結束的異常
     except TimeoutError:
         for future in futures:
             future.cancel()
-            future.result()
         logging.warning("Pub/Sub subscription timed out.")
     except Exception as e:
         for future in futures:
             future.cancel()
-            future.result()
         logging.error(f"Error in Pub/Sub subscription for logging/notification: {e}", exc_info=True)
     finally:
         subscriber.close()
+        for client in stream_clients:
+            client.close()
+        cloud_log_handler.flush() # 送出尚在批次隊列中的日誌條目
         logging.info("Logging & Notification Module stopped.")
 
 if __name__ == '__main__':
@@ -1,8 +1,18 @@
 import os
-import json
+import orjson
+import msgpack
 import logging
+import time
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
 from google.cloud import pubsub_v1
-from concurrent.futures import TimeoutError
+from google.api_core.exceptions import AlreadyExists, NotFound
+from concurrent.futures import TimeoutError, ThreadPoolExecutor, wait, FIRST_EXCEPTION
+try:
+    import redis
+except ImportError: # redis 為選用依賴；未安裝時只使用進程內緩存
+    redis = None
 
 # 配置日誌
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -12,6 +22,29 @@ GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID")
 PUBSUB_TOPIC_COIN_SELECTION_SIGNALS = os.environ.get("PUBSUB_TOPIC_COIN_SELECTION_SIGNALS", "coin-selection-signals")
 PUBSUB_TOPIC_ORDER_BOOK_SIGNALS = os.environ.get("PUBSUB_TOPIC_ORDER_BOOK_SIGNALS", "order-book-signals")
 PUBSUB_TOPIC_TRADE_COMMANDS = os.environ.get("PUBSUB_TOPIC_TRADE_COMMANDS", "trade-commands") # 發布交易指令
+# 設定 REDIS_HOST 後，最新信號保存在 Redis，多個實例共享並可在任一實例上決策
+REDIS_HOST = os.environ.get("REDIS_HOST")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", "6379"))
+SIGNAL_TTL_SECONDS = int(os.environ.get("SIGNAL_TTL_SECONDS", "300")) # 信號的有效期，過期視為沒有信號
+TRADE_COMMAND_LOCK_MS = int(os.environ.get("TRADE_COMMAND_LOCK_MS", "1000")) # 同一交易對在此時間內只允許一個實例發布交易指令
+SIGNAL_CACHE_MAX_SYMBOLS = int(os.environ.get("SIGNAL_CACHE_MAX_SYMBOLS", "2048")) # 進程內信號緩存最多保留的交易對數量
+# 觸發交易的閾值 (這些可以從配置模組或自動學習模組動態獲取)；在載入時讀取一次，而不是每則信號都解析環境變數
+BUY_THRESHOLD = float(os.environ.get("BUY_SIGNAL_THRESHOLD", "0.5"))
+SELL_THRESHOLD = float(os.environ.get("SELL_SIGNAL_THRESHOLD", "-0.5")) # 賣出閾值通常為負值
+DEFAULT_TRADE_QUANTITY_PERCENT = float(os.environ.get("DEFAULT_TRADE_QUANTITY_PERCENT", "0.001")) # 投資組合的千分之一作為範例
+
+# 訂單簿信號與交易指令以固定欄位順序的 msgpack 陣列傳送，以訊息屬性 'encoding' 標示；
+# 欄位順序須分別與 module_order_book_analysis 及 module_risk_money_management 保持一致
+OB_SIGNAL_ENCODING = "ob-signal-msgpack-v1" # 欄位順序即 OrderBookSignal 的欄位順序
+TRADE_COMMAND_ENCODING = "trade-command-msgpack-v1"
+TRADE_COMMAND_FIELDS = ("symbol", "action", "signal_score", "timestamp", "order_type", "quantity_type", "quantity_value")
+
+# 決策表：{推薦動作: (閾值, 方向, 加強信號的鯨魚訂單欄位)}；
+# 方向為 +1 時要求分數高於閾值，-1 時要求低於閾值
+DECISION_RULES = {
+    "BUY": (BUY_THRESHOLD, 1.0, 'large_bid_detected'),
+    "SELL": (SELL_THRESHOLD, -1.0, 'large_ask_detected'),
+}
 
 if not GCP_PROJECT_ID:
     logging.error("GCP_PROJECT_ID environment variable not set. Exiting.")
@@ -19,13 +52,23 @@ if not GCP_PROJECT_ID:
 
 # 初始化 Pub/Sub 客戶端
 subscriber = pubsub_v1.SubscriberClient()
-publisher = pubsub_v1.PublisherClient()
+# 信號訊息很小且頻繁，放大批次讓多則信號合併為一次發布 RPC (最多延遲 50ms)
+publisher = pubsub_v1.PublisherClient(
+    batch_settings=pubsub_v1.types.BatchSettings(max_messages=1000, max_bytes=1_000_000, max_latency=0.05)
+)
 
 # 訂閱路徑 (注意：為每個消費者創建不同的訂閱)
 coin_selection_sub_path = subscriber.subscription_path(GCP_PROJECT_ID, f"{PUBSUB_TOPIC_COIN_SELECTION_SIGNALS}-sub-strategy")
 order_book_sub_path = subscriber.subscription_path(GCP_PROJECT_ID, f"{PUBSUB_TOPIC_ORDER_BOOK_SIGNALS}-sub-strategy")
 trade_commands_topic_path = publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_TRADE_COMMANDS)
 
+# 訂閱端並行度：每個訂閱開啟多條 streaming pull (各自使用獨立的 SubscriberClient / gRPC 通道)
+SUBSCRIBER_STREAMS = int(os.environ.get("SUBSCRIBER_STREAMS", str(os.cpu_count() or 1)))
+SUBSCRIBER_MAX_WORKERS = 2 * (os.cpu_count() or 1) # 每條 streaming pull 處理回調的線程數
+SUBSCRIBER_FLOW_CONTROL = pubsub_v1.types.FlowControl(max_messages=1000, max_bytes=50_000_000)
+stream_clients = [] # 所有 streaming pull 使用的 SubscriberClient，停止時統一關閉
+SUBSCRIPTION_SENTINEL_FILE = os.environ.get("SUBSCRIPTION_SENTINEL_FILE", "/tmp/.sub_ok") # 已確認存在的訂閱路徑，每行一個
+
 
 # -------------------------------------------------------------------
 # 策略狀態與信號緩存
@@ -33,21 +76,90 @@ trade_commands_topic_path = publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_TR
 # -------------------------------------------------------------------
 # 這裡使用簡單的字典來模擬實時狀態，但多個實例運行時會不一致
 # 需要引入一個共享狀態層 (e.g., Redis, Firestore)
-last_coin_selection_signals = {} # {symbol: signal_data}
-last_order_book_signals = {}    # {symbol: signal_data}
+# 兩種信號存放在同一個 LRU 中，make_decision 只需一次查找；交易對輪替時淘汰最久未更新的，內存不會無限增長
+latest_signals = OrderedDict() # {symbol: [coin_selection_signal, order_book_signal]}
+latest_signals_lock = threading.Lock() # 回調在多個線程上執行，OrderedDict 的更新需要加鎖
+
+# 信號在解析時即轉為帶 __slots__ 的 dataclass：決策路徑使用屬性存取而不是字串鍵查找，
+# 欄位缺失時在解析處立即報錯。orjson 可直接序列化 dataclass (寫入 Redis)
+@dataclass(slots=True)
+class CoinSelectionSignal:
+    symbol: str
+    recommendation: str # BUY, SELL, NEUTRAL
+    signal_strength: float
+    timestamp: int
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['symbol'], data['recommendation'], data['signal_strength'], data['timestamp'])
+
+@dataclass(slots=True)
+class OrderBookSignal:
+    symbol: str
+    timestamp: int
+    order_book_imbalance: float
+    large_bid_detected: bool
+    large_ask_detected: bool
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['symbol'], data['timestamp'], data['order_book_imbalance'], data['large_bid_detected'], data['large_ask_detected'])
+
+# 初始化 Redis 客戶端 (可選)；redis.Redis 內建連接池，可在多個回調線程間共用
+redis_client = None
+if REDIS_HOST:
+    if redis is None:
+        logging.error("REDIS_HOST is set but the redis package is not installed. Exiting.")
+        exit(1)
+    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+
+def store_signal(signal_kind, symbol, signal_data):
+    """
+    保存最新信號。signal_kind 為 'coin' (CoinSelectionSignal) 或 'ob' (OrderBookSignal)。
+    Redis 中每種信號使用獨立的鍵並各自設定有效期：頻繁的訂單簿信號不會延長舊選幣信號的有效期。
+    """
+    if redis_client is not None:
+        redis_client.set(f"strategy_signals:{symbol}:{signal_kind}", orjson.dumps(signal_data), ex=SIGNAL_TTL_SECONDS)
+    else:
+        with latest_signals_lock:
+            entry = latest_signals.get(symbol)
+            if entry is None:
+                entry = latest_signals[symbol] = [None, None]
+                if len(latest_signals) > SIGNAL_CACHE_MAX_SYMBOLS:
+                    latest_signals.popitem(last=False)
+            else:
+                latest_signals.move_to_end(symbol)
+            entry[0 if signal_kind == 'coin' else 1] = signal_data
+
+def load_signals(symbol):
+    """一次讀取某交易對最新的 (選幣信號, 訂單簿信號)，不存在時為 None。"""
+    if redis_client is not None:
+        coin_raw, ob_raw = redis_client.mget(f"strategy_signals:{symbol}:coin", f"strategy_signals:{symbol}:ob")
+        return (CoinSelectionSignal.from_dict(orjson.loads(coin_raw)) if coin_raw else None,
+                OrderBookSignal.from_dict(orjson.loads(ob_raw)) if ob_raw else None)
+    entry = latest_signals.get(symbol)
+    if entry is None:
+        return None, None
+    return entry[0], entry[1]
+
+def acquire_trade_command_lock(symbol):
+    """多實例部署時，確保同一交易對短時間內只有一個實例發布交易指令，避免重複下單。"""
+    if redis_client is None:
+        return True
+    return bool(redis_client.set(f"strategy_lock:{symbol}", 1, nx=True, px=TRADE_COMMAND_LOCK_MS))
 
 
 def process_coin_selection_signal(message: pubsub_v1.subscriber.message.Message):
     """處理接收到的幣種分析與選幣信號"""
     try:
-        signal_data = json.loads(message.data.decode('utf-8'))
-        symbol = signal_data['symbol']
-        last_coin_selection_signals[symbol] = signal_data
-        logging.info(f"Received coin selection signal for {symbol}: {signal_data['recommendation']}")
+        signal = CoinSelectionSignal.from_dict(orjson.loads(message.data)) # orjson 直接解析 bytes
+        symbol = signal.symbol
+        store_signal('coin', symbol, signal)
+        logging.debug("Received coin selection signal for %s: %s", symbol, signal.recommendation)
         message.ack()
         # 收到信號後，立即嘗試決策
         make_decision(symbol)
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logging.error(f"Error decoding JSON message from coin selection: {e}")
         message.nack()
     except Exception as e:
@@ -55,87 +167,134 @@ def process_coin_selection_signal(message: pubsub_v1.subscriber.message.Message)
         message.nack()
 
 def process_order_book_signal(message: pubsub_v1.subscriber.message.Message):
-    """處理接收到的訂單簿分析信號"""
+    """處理接收到的訂單簿分析信號 (msgpack 陣列；沒有 encoding 屬性時按 JSON 解析)"""
     try:
-        signal_data = json.loads(message.data.decode('utf-8'))
-        symbol = signal_data['symbol']
-        last_order_book_signals[symbol] = signal_data
-        logging.info(f"Received order book signal for {symbol}: OBI={signal_data['order_book_imbalance']:.2f}")
+        if message.attributes.get("encoding") == OB_SIGNAL_ENCODING:
+            signal = OrderBookSignal(*msgpack.unpackb(message.data))
+        else:
+            signal = OrderBookSignal.from_dict(orjson.loads(message.data)) # orjson 直接解析 bytes
+        symbol = signal.symbol
+        store_signal('ob', symbol, signal)
+        logging.debug("Received order book signal for %s: OBI=%.2f", symbol, signal.order_book_imbalance) # 每則信號一條，使用 DEBUG 與延遲格式化
         message.ack()
         # 收到信號後，立即嘗試決策
         make_decision(symbol)
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logging.error(f"Error decoding JSON message from order book: {e}")
         message.nack()
     except Exception as e:
         logging.error(f"Error processing order book signal: {e}", exc_info=True)
         message.nack()
 
+def log_publish_failure(future):
+    """Pub/Sub 發布完成的回調函數，只在發布失敗時記錄日誌"""
+    e = future.exception()
+    if e is not None:
+        logging.error(f"Failed to publish message: {e}")
+
 def make_decision(symbol):
     """
     根據各種信號和策略邏輯，生成交易指令。
     這是一個簡化的多策略整合邏輯。
     """
-    coin_signal = last_coin_selection_signals.get(symbol)
-    ob_signal = last_order_book_signals.get(symbol)
+    coin_signal, ob_signal = load_signals(symbol)
 
-    if not coin_signal:
+    if coin_signal is None:
         logging.debug(f"No coin selection signal for {symbol} yet.")
         return
 
     # --- 策略組合邏輯範例 ---
     # 策略 1: 基於 AI 選幣的基礎推薦
-    primary_recommendation = coin_signal['recommendation']
-    primary_strength = coin_signal['signal_strength']
+    primary_recommendation = coin_signal.recommendation
+    primary_strength = coin_signal.signal_strength
 
-    # 策略 2: 結合訂單簿信號進行確認或增強
+    rule = DECISION_RULES.get(primary_recommendation)
+    if rule is None: # 非 BUY/SELL 推薦 (例如 HOLD) 不會產生交易
+        logging.debug("No strong enough trade signal for %s. Score: %.2f", symbol, primary_strength)
+        return
+    threshold, sign, whale_field = rule
+
+    # 策略 2: 結合訂單簿信號進行確認或增強 (sign 統一買賣兩個方向的比較)
     confirmation_strength = 0.0
-    if ob_signal:
-        if primary_recommendation == "BUY" and ob_signal['order_book_imbalance'] > 0.1: # 買方力量較強
-            confirmation_strength += ob_signal['order_book_imbalance'] * 0.5 # 加強買入信號
-            logging.info(f"Order book confirms BUY for {symbol} with OBI {ob_signal['order_book_imbalance']:.2f}")
-        elif primary_recommendation == "SELL" and ob_signal['order_book_imbalance'] < -0.1: # 賣方力量較強
-            confirmation_strength += abs(ob_signal['order_book_imbalance']) * 0.5 # 加強賣出信號
-            logging.info(f"Order book confirms SELL for {symbol} with OBI {ob_signal['order_book_imbalance']:.2f}")
-
-        # 考慮鯨魚訂單影響
-        if primary_recommendation == "BUY" and ob_signal['large_bid_detected']:
-            confirmation_strength += 0.1 # 大型買單加強信號
-            logging.info(f"Large bid detected for {symbol}, strengthening BUY signal.")
-        elif primary_recommendation == "SELL" and ob_signal['large_ask_detected']:
-            confirmation_strength += 0.1 # 大型賣單加強信號
-            logging.info(f"Large ask detected for {symbol}, strengthening SELL signal.")
-            
+    if ob_signal is not None:
+        directed_obi = sign * ob_signal.order_book_imbalance
+        if directed_obi > 0.1: # 買入時買方力量較強 / 賣出時賣方力量較強
+            confirmation_strength += directed_obi * 0.5 # 加強信號
+            logging.info(f"Order book confirms {primary_recommendation} for {symbol} with OBI {ob_signal.order_book_imbalance:.2f}")
+
+        # 考慮鯨魚訂單影響 (買入看大型買單，賣出看大型賣單)
+        if getattr(ob_signal, whale_field):
+            confirmation_strength += 0.1 # 大型掛單加強信號
+            logging.info(f"Whale order ({whale_field}) for {symbol}, strengthening {primary_recommendation} signal.")
+
     final_signal_score = primary_strength + confirmation_strength
-    
-    # 設置觸發交易的閾值 (這些可以從配置模組或自動學習模組動態獲取)
-    BUY_THRESHOLD = float(os.environ.get("BUY_SIGNAL_THRESHOLD", "0.5"))
-    SELL_THRESHOLD = float(os.environ.get("SELL_SIGNAL_THRESHOLD", "-0.5")) # 賣出閾值通常為負值
-
-    trade_action = "NONE"
-    if primary_recommendation == "BUY" and final_signal_score > BUY_THRESHOLD:
-        trade_action = "BUY"
-    elif primary_recommendation == "SELL" and final_signal_score < SELL_THRESHOLD:
-        trade_action = "SELL"
-    
-    if trade_action != "NONE":
-        trade_command = {
-            "symbol": symbol,
-            "action": trade_action, # BUY / SELL
-            "signal_score": final_signal_score,
-            "timestamp": int(pd.Timestamp.now().timestamp() * 1000), # 當前時間戳
-            "order_type": "MARKET", # 簡化為市價單，未來可以更靈活
-            "quantity_type": "PERCENT_BALANCE", # 這裡可以指定數量類型 (例如：固定金額、百分比)
-            "quantity_value": float(os.environ.get("DEFAULT_TRADE_QUANTITY_PERCENT", "0.001")) # 投資組合的千分之一作為範例
-        }
-        logging.info(f"Generated trade command for {symbol}: {trade_command['action']}")
-        
-        # 發布交易指令到 Pub/Sub
-        message_data = json.dumps(trade_command).encode('utf-8')
-        future = publisher.publish(trade_commands_topic_path, message_data)
-        future.add_done_callback(lambda f: logging.debug(f"Trade command published with ID: {f.result()}"))
+
+    if sign * final_signal_score <= sign * threshold:
+        logging.debug("No strong enough trade signal for %s. Score: %.2f", symbol, final_signal_score)
+    elif not acquire_trade_command_lock(symbol):
+        logging.info(f"Trade command for {symbol} is already being published by another instance. Skipping.")
     else:
-        logging.info(f"No strong enough trade signal for {symbol}. Score: {final_signal_score:.2f}")
+        # 交易指令欄位依 TRADE_COMMAND_FIELDS 順序
+        trade_command = (
+            symbol,
+            primary_recommendation, # BUY / SELL
+            final_signal_score,
+            time.time_ns() // 1_000_000, # 當前時間戳 (毫秒)
+            "MARKET", # 簡化為市價單，未來可以更靈活
+            "PERCENT_BALANCE", # 這裡可以指定數量類型 (例如：固定金額、百分比)
+            DEFAULT_TRADE_QUANTITY_PERCENT,
+        )
+        logging.info(f"Generated trade command for {symbol}: {primary_recommendation}")
+
+        # 發布交易指令到 Pub/Sub (非阻塞：不等待 future.result()，發布結果由回調記錄)
+        message_data = msgpack.packb(trade_command)
+        future = publisher.publish(trade_commands_topic_path, message_data, encoding=TRADE_COMMAND_ENCODING)
+        future.add_done_callback(log_publish_failure)
+
+
+def ensure_subscription(sub_path, topic_path):
+    """
+    確保訂閱存在。先以 get_subscription 檢查 (一次輕量讀取)，只有 NotFound 時才創建；
+    確認成功後記錄在 SUBSCRIPTION_SENTINEL_FILE，同一容器內重啟時直接跳過管理 API 調用。
+    注意：在生產環境中，通常會透過 Terraform 或手動在 GCP 控制台創建訂閱。
+    """
+    try:
+        with open(SUBSCRIPTION_SENTINEL_FILE) as f:
+            if sub_path in f.read().splitlines():
+                return
+    except OSError:
+        pass
+
+    try:
+        subscriber.get_subscription(subscription=sub_path)
+        logging.info(f"Subscription {sub_path} already exists.")
+    except NotFound:
+        try:
+            subscriber.create_subscription(name=sub_path, topic=topic_path)
+            logging.info(f"Subscription {sub_path} created.")
+        except AlreadyExists: # 其他實例同時啟動並已創建
+            logging.info(f"Subscription {sub_path} already exists.")
+
+    try:
+        with open(SUBSCRIPTION_SENTINEL_FILE, "a") as f:
+            f.write(sub_path + "\n")
+    except OSError as e:
+        logging.warning(f"Could not record subscription in {SUBSCRIPTION_SENTINEL_FILE}: {e}")
+
+
+def subscribe_streams(sub_path, callback):
+    """
+    為一個訂閱開啟 SUBSCRIBER_STREAMS 條 streaming pull，每條使用獨立的客戶端與回調線程池，
+    並設定流量控制。不同訂閱各自擁有自己的 streams，避免互相阻塞。返回 streaming pull futures。
+    """
+    futures = []
+    for _ in range(SUBSCRIBER_STREAMS):
+        client = pubsub_v1.SubscriberClient()
+        stream_clients.append(client)
+        scheduler = pubsub_v1.subscriber.scheduler.ThreadScheduler(executor=ThreadPoolExecutor(max_workers=SUBSCRIBER_MAX_WORKERS))
+        # await_callbacks_on_shutdown：cancel() 會等待進行中的回調完成後才返回
+        futures.append(client.subscribe(sub_path, callback=callback, flow_control=SUBSCRIBER_FLOW_CONTROL, scheduler=scheduler, await_callbacks_on_shutdown=True))
+    return futures
 
 
 def main():
@@ -147,40 +306,38 @@ def main():
         (order_book_sub_path, PUBSUB_TOPIC_ORDER_BOOK_SIGNALS)
     ]:
         try:
-            subscriber.create_subscription(name=sub_path, topic=publisher.topic_path(GCP_PROJECT_ID, topic_name))
-            logging.info(f"Subscription {sub_path} created (if it didn't exist).")
+            ensure_subscription(sub_path, publisher.topic_path(GCP_PROJECT_ID, topic_name))
         except Exception as e:
-            if "AlreadyExists" in str(e):
-                logging.info(f"Subscription {sub_path} already exists.")
-            else:
-                logging.error(f"Error creating subscription {sub_path}: {e}")
-                exit(1)
+            logging.error(f"Error ensuring subscription {sub_path}: {e}")
+            exit(1)
 
     # 同時訂閱兩個 Topic
     futures = []
-    futures.append(subscriber.subscribe(coin_selection_sub_path, callback=process_coin_selection_signal))
-    futures.append(subscriber.subscribe(order_book_sub_path, callback=process_order_book_signal))
+    futures.extend(subscribe_streams(coin_selection_sub_path, process_coin_selection_signal))
+    futures.extend(subscribe_streams(order_book_sub_path, process_order_book_signal))
     
     logging.info(f"Listening for signals on {PUBSUB_TOPIC_COIN_SELECTION_SIGNALS} and {PUBSUB_TOPIC_ORDER_BOOK_SIGNALS}...")
 
     try:
-        # 阻塞主線程直到訂閱結束，或者可以設置一個循環來保持服務運行
-        for future in futures:
-            future.result() # 這裡可能會阻塞，如果一個訂閱結束，其他也會受影響
-        # 更健壯的方式是使用 threading.Thread 來處理多個訂閱，並在主線程中保持服務運行
-        # 或者 Cloud Run 會自動處理多個 Pub/Sub 觸發器
+        # 等待任一 streaming pull 結束或失敗，而不是逐個 future.result() 串行阻塞；
+        # 一條失敗時立即停止其餘的，讓服務盡快退出並由平台重啟
+        done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+        for future in done:
+            future.result() # 拋出導致訂閱結束的異常
     except TimeoutError:
         for future in futures:
             future.cancel()
-            future.result()
         logging.warning("Pub/Sub subscription timed out.")
     except Exception as e:
         for future in futures:
             future.cancel()
-            future.result()
         logging.error(f"Error in Pub/Sub subscription for strategy module: {e}", exc_info=True)
     finally:
         subscriber.close()
+        for client in stream_clients:
+            client.close()
         logging.info("Multi-Strategy Decision Module stopped.")
 
 if __name__ == '__main__':
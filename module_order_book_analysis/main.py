@@ -1,8 +1,21 @@
 import os
-import json
+import orjson
+import msgpack
 import logging
+import threading
+import time
+import struct
+import numpy as np
 from google.cloud import pubsub_v1
-from concurrent.futures import TimeoutError
+from google.api_core.exceptions import AlreadyExists, NotFound
+from concurrent.futures import TimeoutError, ThreadPoolExecutor, wait, FIRST_EXCEPTION
+try:
+    from numba import njit
+except ImportError: # numba 為選用依賴；未安裝時以純 Python 執行相同的函式
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
 
 # 配置日誌
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -11,6 +24,7 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID")
 PUBSUB_TOPIC_ORDER_BOOK_UPDATES = os.environ.get("PUBSUB_TOPIC_ORDER_BOOK_UPDATES", "order-book-updates") # 訂閱的 Topic
 PUBSUB_TOPIC_ORDER_BOOK_SIGNALS = os.environ.get("PUBSUB_TOPIC_ORDER_BOOK_SIGNALS", "order-book-signals") # 發布的 Topic
+WHALE_THRESHOLD_QTY = float(os.environ.get("WHALE_THRESHOLD_QTY", "100.0")) # 大額買賣單（鯨魚訂單）的數量閾值
 
 if not GCP_PROJECT_ID:
     logging.error("GCP_PROJECT_ID environment variable not set. Exiting.")
@@ -18,73 +32,189 @@ if not GCP_PROJECT_ID:
 
 # 初始化 Pub/Sub 客戶端
 subscriber = pubsub_v1.SubscriberClient()
-publisher = pubsub_v1.PublisherClient()
+# 信號訊息很小且頻繁，放大批次讓多則信號合併為一次發布 RPC (最多延遲 50ms)
+publisher = pubsub_v1.PublisherClient(
+    batch_settings=pubsub_v1.types.BatchSettings(max_messages=1000, max_bytes=1_000_000, max_latency=0.05)
+)
 
 subscription_path = subscriber.subscription_path(GCP_PROJECT_ID, f"{PUBSUB_TOPIC_ORDER_BOOK_UPDATES}-sub-analyzer") # 建議為每個消費者創建不同的訂閱
 signals_topic_path = publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_ORDER_BOOK_SIGNALS)
 
+# 訂閱端並行度：每個訂閱開啟多條 streaming pull (各自使用獨立的 SubscriberClient / gRPC 通道)
+SUBSCRIBER_STREAMS = int(os.environ.get("SUBSCRIBER_STREAMS", str(os.cpu_count() or 1)))
+SUBSCRIBER_MAX_WORKERS = 2 * (os.cpu_count() or 1) # 每條 streaming pull 處理回調的線程數
+SUBSCRIBER_FLOW_CONTROL = pubsub_v1.types.FlowControl(max_messages=1000, max_bytes=50_000_000)
+stream_clients = [] # 所有 streaming pull 使用的 SubscriberClient，停止時統一關閉
+SUBSCRIPTION_SENTINEL_FILE = os.environ.get("SUBSCRIPTION_SENTINEL_FILE", "/tmp/.sub_ok") # 已確認存在的訂閱路徑，每行一個
+
+# 數據採集模組發布的二進制深度幀 (須與 module_data_acquisition_websocket 的打包保持一致)：
+# 標頭 <QHHB3x> (事件時間, 買單層數, 賣單層數, 交易對長度, 3 位元組填充)
+# | float64[2*買單層數] | float64[2*賣單層數] | 交易對 (ASCII)
+DEPTH_FRAME_ENCODING = "depth-f64-v1"
+DEPTH_FRAME_HEADER = struct.Struct("<QHHB3x")
+
+# 訂單簿信號以固定欄位順序的 msgpack 陣列發布 (不重複傳送欄位名稱)，以訊息屬性 'encoding' 標示；
+# 欄位順序須與 module_multi_strategy_decision 的 OB_SIGNAL_FIELDS 一致
+OB_SIGNAL_ENCODING = "ob-signal-msgpack-v1"
+
+
+# fastmath 不含 nnan / ninf：calculate_order_book_imbalance 以 np.inf 作為閾值 (不偵測大額單)，
+# 在 fastmath=True 下編譯器可假設不存在無窮大，使比較結果未定義
+ORDER_BOOK_FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+@njit(cache=True, fastmath=ORDER_BOOK_FASTMATH)
+def order_book_features(bids, asks, depth, threshold_qty):
+    """
+    單次掃描買賣掛單，同時計算訂單簿不平衡 (OBI) 與是否存在大額買賣單。
+    bids / asks: 形狀 (n, 2) 的 float64 陣列，每行為 [price, quantity]
+    返回 (obi, large_bid_found, large_ask_found)
+    """
+    total_bid_qty = 0.0
+    large_bid_found = False
+    for i in range(bids.shape[0]):
+        qty = bids[i, 1]
+        if i < depth:
+            total_bid_qty += qty
+        if qty >= threshold_qty:
+            large_bid_found = True
+
+    total_ask_qty = 0.0
+    large_ask_found = False
+    for i in range(asks.shape[0]):
+        qty = asks[i, 1]
+        if i < depth:
+            total_ask_qty += qty
+        if qty >= threshold_qty:
+            large_ask_found = True
+
+    obi = 0.0
+    if bids.shape[0] > 0 and asks.shape[0] > 0 and (total_bid_qty + total_ask_qty) != 0:
+        obi = (total_bid_qty - total_ask_qty) / (total_bid_qty + total_ask_qty)
+    return obi, large_bid_found, large_ask_found
+
+# 模組載入時先編譯 (或從 cache 載入)，避免第一則訊息承擔 JIT 延遲；
+# 二進制幀解析出的是唯讀陣列，numba 視為另一種型別，一併預先編譯
+order_book_features(np.zeros((1, 2)), np.zeros((1, 2)), 5, WHALE_THRESHOLD_QTY)
+_readonly_levels = np.frombuffer(bytes(16)).reshape(-1, 2)
+order_book_features(_readonly_levels, _readonly_levels, 5, WHALE_THRESHOLD_QTY)
 
 def calculate_order_book_imbalance(bids, asks, depth=5):
     """
     計算訂單簿不平衡 (OBI)。
     考慮最上面的 'depth' 層級的買賣掛單。
-    bids: list of [price, quantity]
-    asks: list of [price, quantity]
+    bids: list of [price, quantity] (價格與數量可為字串)，或形狀 (n, 2) 的 NumPy 陣列
+    asks: list of [price, quantity] (價格與數量可為字串)，或形狀 (n, 2) 的 NumPy 陣列
     """
-    if not bids or not asks:
-        return 0.0
+    bids = np.asarray(bids, dtype=np.float64).reshape(-1, 2)
+    asks = np.asarray(asks, dtype=np.float64).reshape(-1, 2)
+    return order_book_features(bids, asks, depth, np.inf)[0]
 
-    total_bid_qty = sum(float(b[1]) for b in bids[:depth])
-    total_ask_qty = sum(float(a[1]) for a in asks[:depth])
+# -------------------------------------------------------------------
+# 合併短時間內的連續更新：每則更新都在回調中計算特徵，同一交易對在一個時間窗口內只發布一則信號，
+# 使用事件時間最新的 OBI，大額買賣單標記取窗口內所有更新的 OR (窗口內出現過的鯨魚訂單不會被覆蓋)
+# -------------------------------------------------------------------
+ORDER_BOOK_COALESCE_INTERVAL = float(os.environ.get("ORDER_BOOK_COALESCE_MS", "50")) / 1000.0
+pending_updates = {} # {symbol: ((symbol, event_time, obi, large_bid_found, large_ask_found), message)}，每個交易對尚未發布的信號
+pending_updates_lock = threading.Lock()
 
-    if (total_bid_qty + total_ask_qty) == 0:
-        return 0.0
-    
-    obi = (total_bid_qty - total_ask_qty) / (total_bid_qty + total_ask_qty)
-    return obi
+def parse_depth_frame(buf):
+    """
+    解析數據採集模組發布的二進制深度幀 (格式見 DEPTH_FRAME_HEADER)。
+    買賣掛單直接以 np.frombuffer 映射到訊息內容上 (唯讀、零拷貝)，返回 (symbol, event_time, bids, asks)。
+    """
+    event_time, n_bids, n_asks, symbol_len = DEPTH_FRAME_HEADER.unpack_from(buf)
+    offset = DEPTH_FRAME_HEADER.size
+    bids = np.frombuffer(buf, dtype='<f8', count=2 * n_bids, offset=offset).reshape(-1, 2)
+    offset += 16 * n_bids
+    asks = np.frombuffer(buf, dtype='<f8', count=2 * n_asks, offset=offset).reshape(-1, 2)
+    offset += 16 * n_asks
+    symbol = buf[offset:offset + symbol_len].decode("ascii")
+    return symbol, event_time, bids, asks
+
+def log_publish_failure(future):
+    """Pub/Sub 發布完成的回調函數，只在發布失敗時記錄日誌"""
+    e = future.exception()
+    if e is not None:
+        logging.error(f"Failed to publish message: {e}")
+
+def analyze_order_book_update(symbol, event_time, bids, asks):
+    """
+    分析一則訂單簿更新，返回信號 (symbol, event_time, obi, large_bid_found, large_ask_found)。
+    bids / asks: (n, 2) 的 float64 陣列，或幣安 JSON 中的 [[price, quantity], ...] (價格與數量為字串)
+    """
+    # 一次轉換為 (n, 2) 的浮點陣列 (二進制幀已是 float64 陣列，不會複製)，之後的計算都在 NumPy 中完成
+    bids = np.asarray(bids, dtype=np.float64).reshape(-1, 2)
+    asks = np.asarray(asks, dtype=np.float64).reshape(-1, 2)
+    # 在實際應用中，您需要維護一個完整的訂單簿狀態，並應用這些更新（增量更新）
+    # 由於此範例只計算 OBI，我們假設這裡的數據是某個時間點的快照或足夠的增量更新。
+
+    # 範例：計算訂單簿不平衡 (OBI)，並偵測大額買賣單（鯨魚訂單）
+    obi, large_bid_found, large_ask_found = order_book_features(bids, asks, 5, WHALE_THRESHOLD_QTY)
+    logging.debug("Symbol: %s, OBI: %.4f", symbol, obi) # 每則更新一條，使用 DEBUG 與延遲格式化
+    return symbol, event_time, obi, large_bid_found, large_ask_found
+
+def merge_order_book_signals(current, signal):
+    """合併同一交易對的兩則信號：取事件時間較新的一則，大額買賣單標記取 OR。返回 (合併後的信號, 是否取 signal)。"""
+    newer = signal[1] >= current[1]
+    latest = signal if newer else current
+    merged = (latest[0], latest[1], latest[2], bool(current[3] or signal[3]), bool(current[4] or signal[4]))
+    return merged, newer
+
+def publish_order_book_signal(signal):
+    """發布一則訂單簿信號。"""
+    # 信號欄位順序：交易對, 事件時間, OBI, 大額買單, 大額賣單
+    message_data = msgpack.packb(signal)
+
+    # 發布分析結果到新的 Pub/Sub Topic
+    future = publisher.publish(signals_topic_path, message_data, encoding=OB_SIGNAL_ENCODING)
+    future.add_done_callback(log_publish_failure)
+
+def flush_pending_updates():
+    """背景線程：每個合併窗口結束時，發布每個交易對合併後的一則信號。"""
+    global pending_updates
+    while True:
+        time.sleep(ORDER_BOOK_COALESCE_INTERVAL)
+        with pending_updates_lock:
+            batch, pending_updates = pending_updates, {}
+
+        for symbol, (signal, message) in batch.items():
+            try:
+                publish_order_book_signal(signal)
+                message.ack() # 確認訊息已處理，從訂閱隊列中移除
+                logging.debug("Processed order book update for %s and published signal.", symbol)
+            except Exception as e:
+                logging.error(f"Error processing order book update: {e}", exc_info=True)
+                message.nack()
 
 def process_order_book_update(message: pubsub_v1.subscriber.message.Message):
     """
-    處理接收到的訂單簿更新訊息。
+    處理接收到的訂單簿更新訊息：解析並計算特徵後放入合併緩衝區，由 flush_pending_updates 發布。
+    支援二進制深度幀 (屬性 encoding=depth-f64-v1) 與原始 JSON 兩種格式。
     """
     try:
-        data = json.loads(message.data.decode('utf-8'))
-        symbol = data['s']
-        # 幣安深度更新的 'b' 是買單 ('bids')，'a' 是賣單 ('asks')
-        bids = data['b']
-        asks = data['a']
-
-        # 這裡的 bids 和 asks 格式是 [[price, quantity], ...]
-        # 在實際應用中，您需要維護一個完整的訂單簿狀態，並應用這些更新（增量更新）
-        # 由於此範例只計算 OBI，我們假設這裡的數據是某個時間點的快照或足夠的增量更新。
-
-        # 範例：計算訂單簿不平衡 (OBI)
-        obi = calculate_order_book_imbalance(bids, asks)
-        logging.info(f"Symbol: {symbol}, OBI: {obi:.4f}")
-
-        # 範例：偵測大額買賣單（鯨魚訂單）
-        threshold_qty = float(os.environ.get("WHALE_THRESHOLD_QTY", "100.0")) # 設定一個閾值
-        large_bid_found = any(float(b[1]) >= threshold_qty for b in bids)
-        large_ask_found = any(float(a[1]) >= threshold_qty for a in asks)
-
-        signal = {
-            "symbol": symbol,
-            "timestamp": data['E'], # 事件時間
-            "order_book_imbalance": obi,
-            "large_bid_detected": large_bid_found,
-            "large_ask_detected": large_ask_found,
-            "signal_type": "order_book_analysis"
-        }
-
-        # 發布分析結果到新的 Pub/Sub Topic
-        message_data = json.dumps(signal).encode('utf-8')
-        future = publisher.publish(signals_topic_path, message_data)
-        future.add_done_callback(lambda f: logging.debug(f"Signal published with ID: {f.result()}"))
-
-        message.ack() # 確認訊息已處理，從訂閱隊列中移除
-        logging.info(f"Processed order book update for {symbol} and published signal.")
-
-    except json.JSONDecodeError as e:
+        if message.attributes.get("encoding") == DEPTH_FRAME_ENCODING:
+            update = parse_depth_frame(message.data)
+        else:
+            data = orjson.loads(message.data) # orjson 直接解析 bytes
+            # 幣安深度更新的 'b' 是買單 ('bids')，'a' 是賣單 ('asks')
+            update = (data['s'], data['E'], data['b'], data['a'])
+        signal = analyze_order_book_update(*update)
+        symbol = signal[0]
+
+        superseded = None
+        with pending_updates_lock:
+            current = pending_updates.get(symbol)
+            if current is None:
+                pending_updates[symbol] = (signal, message)
+            else:
+                merged, newer = merge_order_book_signals(current[0], signal)
+                # 保留事件時間較新一則的訊息，較舊的一則已合併進信號 (亂序到達的舊更新不會覆蓋新數據)
+                pending_updates[symbol] = (merged, message if newer else current[1])
+                superseded = current[1] if newer else message
+        if superseded is not None:
+            superseded.ack() # 已合併到同一交易對的信號中，不需要再單獨發布
+
+    except orjson.JSONDecodeError as e:
         logging.error(f"Error decoding JSON message: {e} - Data: {message.data.decode('utf-8')}")
         message.nack() # 負確認訊息，稍後會重新投遞
     except Exception as e:
@@ -92,40 +222,86 @@ def process_order_book_update(message: pubsub_v1.subscriber.message.Message):
         message.nack()
 
 
+def ensure_subscription(sub_path, topic_path):
+    """
+    確保訂閱存在。先以 get_subscription 檢查 (一次輕量讀取)，只有 NotFound 時才創建；
+    確認成功後記錄在 SUBSCRIPTION_SENTINEL_FILE，同一容器內重啟時直接跳過管理 API 調用。
+    注意：在生產環境中，通常會透過 Terraform 或手動在 GCP 控制台創建訂閱。
+    """
+    try:
+        with open(SUBSCRIPTION_SENTINEL_FILE) as f:
+            if sub_path in f.read().splitlines():
+                return
+    except OSError:
+        pass
+
+    try:
+        subscriber.get_subscription(subscription=sub_path)
+        logging.info(f"Subscription {sub_path} already exists.")
+    except NotFound:
+        try:
+            subscriber.create_subscription(name=sub_path, topic=topic_path)
+            logging.info(f"Subscription {sub_path} created.")
+        except AlreadyExists: # 其他實例同時啟動並已創建
+            logging.info(f"Subscription {sub_path} already exists.")
+
+    try:
+        with open(SUBSCRIPTION_SENTINEL_FILE, "a") as f:
+            f.write(sub_path + "\n")
+    except OSError as e:
+        logging.warning(f"Could not record subscription in {SUBSCRIPTION_SENTINEL_FILE}: {e}")
+
+
+def subscribe_streams(sub_path, callback):
+    """
+    為一個訂閱開啟 SUBSCRIBER_STREAMS 條 streaming pull，每條使用獨立的客戶端與回調線程池，
+    並設定流量控制。不同訂閱各自擁有自己的 streams，避免互相阻塞。返回 streaming pull futures。
+    """
+    futures = []
+    for _ in range(SUBSCRIBER_STREAMS):
+        client = pubsub_v1.SubscriberClient()
+        stream_clients.append(client)
+        scheduler = pubsub_v1.subscriber.scheduler.ThreadScheduler(executor=ThreadPoolExecutor(max_workers=SUBSCRIBER_MAX_WORKERS))
+        # await_callbacks_on_shutdown：cancel() 會等待進行中的回調完成後才返回
+        futures.append(client.subscribe(sub_path, callback=callback, flow_control=SUBSCRIBER_FLOW_CONTROL, scheduler=scheduler, await_callbacks_on_shutdown=True))
+    return futures
+
+
 def main():
     logging.info("Starting Order Book Analysis Module...")
     
-    # 創建訂閱（如果不存在）
-    # 注意：在生產環境中，通常會透過 Terraform 或手動在 GCP 控制台創建訂閱，
-    # 這裡僅為範例演示。
+    # 確保訂閱存在（如果不存在則創建）
     try:
-        subscriber.create_subscription(name=subscription_path, topic=publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_ORDER_BOOK_UPDATES))
-        logging.info(f"Subscription {subscription_path} created (if it didn't exist).")
+        ensure_subscription(subscription_path, publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_ORDER_BOOK_UPDATES))
     except Exception as e:
-        # 如果訂閱已存在，會拋出 AlreadyExists 錯誤，可以忽略
-        if "AlreadyExists" in str(e):
-            logging.info(f"Subscription {subscription_path} already exists.")
-        else:
-            logging.error(f"Error creating subscription {subscription_path}: {e}")
-            exit(1)
-
+        logging.error(f"Error ensuring subscription {subscription_path}: {e}")
+        exit(1)
 
-    streaming_pull_future = subscriber.subscribe(subscription_path, callback=process_order_book_update)
-    logging.info(f"Listening for messages on {subscription_path}...")
+    threading.Thread(target=flush_pending_updates, daemon=True).start()
+    futures = subscribe_streams(subscription_path, process_order_book_update)
+    logging.info(f"Listening for messages on {subscription_path} with {len(futures)} stream(s)...")
 
     # Cloud Run 服務需要保持運行來持續接收 Pub/Sub 訊息
     try:
-        streaming_pull_future.result()  # 阻塞主線程直到訂閱結束
+        # 等待任一 streaming pull 結束或失敗，而不是逐個 future.result() 串行阻塞；
+        # 一條失敗時立即停止其餘的，讓服務盡快退出並由平台重啟
+        done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+        for future in done:
+            future.result() # 拋出導致訂閱結束的異常
     except TimeoutError:
-        streaming_pull_future.cancel()
-        streaming_pull_future.result()
+        for future in futures:
+            future.cancel()
         logging.warning("Pub/Sub subscription timed out.")
     except Exception as e:
-        streaming_pull_future.cancel()
-        streaming_pull_future.result()
+        for future in futures:
+            future.cancel()
         logging.error(f"Error in Pub/Sub subscription: {e}", exc_info=True)
     finally:
         subscriber.close()
+        for client in stream_clients:
+            client.close()
         logging.info("Order Book Analysis Module stopped.")
 
 if __name__ == '__main__':
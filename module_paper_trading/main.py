@@ -1,10 +1,18 @@
 import os
-import json
+import orjson
 import logging
+import functools
 from google.cloud import pubsub_v1
+from google.api_core.exceptions import AlreadyExists, NotFound
 from google.cloud import firestore
-from concurrent.futures import TimeoutError
-import datetime
+from concurrent.futures import TimeoutError, ThreadPoolExecutor
+import threading
+import time
+import queue
+from dataclasses import dataclass
+from typing import Optional
+from google.api_core import exceptions as api_exceptions
+from google.api_core.retry import Retry, if_exception_type
 
 # 配置日誌
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -20,66 +28,187 @@ if not GCP_PROJECT_ID:
 
 # 初始化 Pub/Sub 客戶端
 subscriber = pubsub_v1.SubscriberClient()
-publisher = pubsub_v1.PublisherClient()
+# 合併多則發布為一次 RPC (最多延遲 50ms)
+publisher = pubsub_v1.PublisherClient(
+    batch_settings=pubsub_v1.types.BatchSettings(max_messages=100, max_bytes=1024 * 1024, max_latency=0.05)
+)
 
 # 訂閱路徑
 final_trade_execution_sub_path = subscriber.subscription_path(GCP_PROJECT_ID, f"{PUBSUB_TOPIC_FINAL_TRADE_EXECUTION}-sub-paper-trader")
 paper_trade_reports_topic_path = publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_PAPER_TRADE_REPORTS)
 
+# 訂閱端流量控制與回調線程數：回調中以阻塞 I/O 為主 (Firestore)，線程數取 CPU 核心數的 8 倍
+SUBSCRIBER_MAX_WORKERS = 8 * (os.cpu_count() or 1)
+SUBSCRIBER_FLOW_CONTROL = pubsub_v1.types.FlowControl(max_messages=1000, max_bytes=100 * 1024 * 1024)
+# 訂閱已由 Terraform / gcloud 預先建立時，設 CREATE_SUBSCRIPTIONS_ON_START=0 跳過啟動時的管理 API 調用
+CREATE_SUBSCRIPTIONS_ON_START = os.environ.get("CREATE_SUBSCRIPTIONS_ON_START", "1") == "1"
+SUBSCRIPTION_SENTINEL_FILE = os.environ.get("SUBSCRIPTION_SENTINEL_FILE", "/tmp/.sub_ok") # 已確認存在的訂閱路徑，每行一個
+
 # 初始化 Firestore 客戶端 (用於儲存模擬賬戶狀態)
 db = firestore.Client(project=GCP_PROJECT_ID)
 PAPER_ACCOUNT_COLLECTION = os.environ.get("PAPER_ACCOUNT_COLLECTION", "paper_trading_accounts")
 PAPER_TRADES_COLLECTION = os.environ.get("PAPER_TRADES_COLLECTION", "paper_trading_history")
 
+# 模擬賬戶狀態緩存：賬戶只由本模組修改，載入一次後在內存中更新，定期批次寫回 Firestore
+# (注意：僅適用於單一實例運行；多實例需改用 Firestore 交易或 Redis 等共享狀態)
+ACCOUNT_FLUSH_INTERVAL = float(os.environ.get("ACCOUNT_FLUSH_INTERVAL_SECONDS", "1.0"))
+account_cache = {} # {account_id: state}
+dirty_accounts = set() # 有變更、尚未寫回 Firestore 的賬戶
+pending_account_acks = [] # 變更已套用到緩存、等待寫回成功後才確認的訊息
+account_lock = threading.RLock()
+
+# 模擬交易記錄寫入隊列：回調只負責入隊，多個寫入線程各自以 WriteBatch (每批最多 500 筆) 寫入 Firestore
+FIRESTORE_BATCH_LIMIT = 500 # Firestore 單次批次寫入的文檔上限
+TRADE_RECORD_WRITERS = int(os.environ.get("TRADE_RECORD_WRITERS", "4"))
+trade_record_queue = queue.Queue(maxsize=int(os.environ.get("TRADE_RECORD_QUEUE_SIZE", "10000")))
+TRADE_RECORD_COMMIT_RETRY = Retry(
+    predicate=if_exception_type(api_exceptions.Aborted, api_exceptions.ServiceUnavailable, api_exceptions.DeadlineExceeded),
+    deadline=30.0,
+)
+
+
+# 最終交易指令在解析時即轉為帶 __slots__ 的 dataclass：之後使用屬性存取而不是字串鍵查找，
+# 欄位缺失時在解析處立即報錯
+@dataclass(slots=True)
+class FinalTradeCommand:
+    symbol: str
+    action: str # BUY, SELL
+    quantity: float
+    order_type: str
+    stop_loss_price: Optional[float] = None
+    take_profit_price: Optional[float] = None
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['symbol'], data['action'], data['quantity'], data['order_type'],
+                   data.get('stop_loss_price'), data.get('take_profit_price'))
+
 
 def get_paper_account_state(account_id="default_paper_account"):
-    """從 Firestore 獲取模擬賬戶狀態。"""
-    try:
-        doc_ref = db.collection(PAPER_ACCOUNT_COLLECTION).document(account_id)
-        doc = doc_ref.get()
-        if doc.exists:
-            state = doc.to_dict()
-            logging.info(f"Loaded paper account state: {state}")
+    """
+    獲取模擬賬戶狀態。首次從 Firestore 載入 (或初始化) 後保存在內存緩存中，之後直接返回緩存；
+    調用者需持有 account_lock 才能修改返回的狀態。
+    """
+    with account_lock:
+        state = account_cache.get(account_id)
+        if state is not None:
             return state
-        else:
-            # 初始化新賬戶
-            initial_balance = float(os.environ.get("PAPER_TRADING_INITIAL_BALANCE", "10000.0"))
-            new_state = {
-                "balance_usd": initial_balance,
-                "positions": {}, # {symbol: quantity}
-                "last_update_timestamp": firestore.SERVER_TIMESTAMP
-            }
-            doc_ref.set(new_state)
-            logging.info(f"Initialized new paper account with balance: {initial_balance}")
-            return new_state
-    except Exception as e:
-        logging.error(f"Error getting paper account state: {e}", exc_info=True)
-        return None
+        try:
+            doc_ref = db.collection(PAPER_ACCOUNT_COLLECTION).document(account_id)
+            doc = doc_ref.get()
+            if doc.exists:
+                state = doc.to_dict()
+                logging.info(f"Loaded paper account state: {state}")
+            else:
+                # 初始化新賬戶
+                initial_balance = float(os.environ.get("PAPER_TRADING_INITIAL_BALANCE", "10000.0"))
+                state = {
+                    "balance_usd": initial_balance,
+                    "positions": {}, # {symbol: quantity}
+                    "last_update_timestamp": firestore.SERVER_TIMESTAMP
+                }
+                doc_ref.set(state)
+                logging.info(f"Initialized new paper account with balance: {initial_balance}")
+            account_cache[account_id] = state
+            return state
+        except Exception as e:
+            logging.error(f"Error getting paper account state: {e}", exc_info=True)
+            return None
 
-def update_paper_account_state(account_id, new_balance, new_positions):
-    """更新模擬賬戶狀態到 Firestore。"""
+def flush_paper_account_states():
+    """
+    將有變更的賬戶狀態以一次 WriteBatch 寫回 Firestore，成功後才確認對應的訊息；
+    寫入失敗時保留待寫回標記與待確認訊息，下次重試。
+    """
+    global pending_account_acks
+    with account_lock:
+        acks, pending_account_acks = pending_account_acks, []
+        snapshot = {
+            account_id: (account_cache[account_id]["balance_usd"], dict(account_cache[account_id]["positions"]))
+            for account_id in dirty_accounts
+        }
+        dirty_accounts.clear()
+    if not snapshot:
+        for message in acks:
+            message.ack()
+        return
     try:
-        doc_ref = db.collection(PAPER_ACCOUNT_COLLECTION).document(account_id)
-        doc_ref.update({
-            "balance_usd": new_balance,
-            "positions": new_positions,
-            "last_update_timestamp": firestore.SERVER_TIMESTAMP
-        })
-        logging.info(f"Paper account state updated. Balance: {new_balance:.2f}")
+        batch = db.batch()
+        for account_id, (balance, positions) in snapshot.items():
+            batch.update(db.collection(PAPER_ACCOUNT_COLLECTION).document(account_id), {
+                "balance_usd": balance,
+                "positions": positions,
+                "last_update_timestamp": firestore.SERVER_TIMESTAMP
+            })
+        batch.commit()
+        logging.debug(f"Flushed {len(snapshot)} paper account state(s) to Firestore.")
     except Exception as e:
         logging.error(f"Error updating paper account state: {e}", exc_info=True)
+        with account_lock:
+            dirty_accounts.update(snapshot)
+            pending_account_acks.extend(acks)
+        return
+    for message in acks:
+        message.ack() # 賬戶變更已持久化，確認訊息
+
+def account_flush_loop():
+    """背景線程：每 ACCOUNT_FLUSH_INTERVAL 秒寫回一次賬戶狀態。"""
+    while True:
+        time.sleep(ACCOUNT_FLUSH_INTERVAL)
+        flush_paper_account_states()
 
 def record_paper_trade(trade_record):
-    """記錄模擬交易到 Firestore。"""
+    """將模擬交易記錄放入寫入隊列 (非阻塞)，由 trade_record_writer 線程批次寫入 Firestore。"""
     try:
-        db.collection(PAPER_TRADES_COLLECTION).add(trade_record)
-        logging.info("Paper trade record added to Firestore.")
+        trade_record_queue.put_nowait(trade_record)
+    except queue.Full:
+        logging.error("Paper trade record queue is full. Dropping trade record.")
+
+def write_trade_records(records):
+    """以一次 WriteBatch 寫入多筆模擬交易記錄；Aborted 等暫時性錯誤自動重試。"""
+    try:
+        batch = db.batch()
+        collection = db.collection(PAPER_TRADES_COLLECTION)
+        for record in records:
+            batch.set(collection.document(), record)
+        batch.commit(retry=TRADE_RECORD_COMMIT_RETRY)
+        logging.info(f"{len(records)} paper trade record(s) added to Firestore.")
     except Exception as e:
-        logging.error(f"Error recording paper trade: {e}", exc_info=True)
+        logging.error(f"Error recording {len(records)} paper trade(s): {e}", exc_info=True)
+
+def take_trade_records(first=None):
+    """從隊列取出最多 FIRESTORE_BATCH_LIMIT 筆記錄 (first 為已取出的第一筆)。"""
+    records = [] if first is None else [first]
+    while len(records) < FIRESTORE_BATCH_LIMIT:
+        try:
+            records.append(trade_record_queue.get_nowait())
+        except queue.Empty:
+            break
+    return records
+
+def trade_record_writer():
+    """背景線程：等待記錄到達後，把當下隊列中累積的記錄一次批次寫入。"""
+    while True:
+        write_trade_records(take_trade_records(trade_record_queue.get()))
+
+def drain_trade_records():
+    """停止前同步寫入隊列中剩餘的記錄。"""
+    records = take_trade_records()
+    while records:
+        write_trade_records(records)
+        records = take_trade_records()
+
+def log_publish_failure(future):
+    """Pub/Sub 發布完成的回調函數，只在發布失敗時記錄日誌"""
+    e = future.exception()
+    if e is not None:
+        logging.error(f"Failed to publish message: {e}")
 
+@functools.lru_cache(maxsize=256)
 def get_mock_asset_price(symbol):
     """
     獲取模擬資產價格。
+    環境變數在容器運行期間不會改變，每個交易對只讀取並解析一次。
     在實際情況中，這應該從數據獲取模組的實時數據流中獲取最新價格。
     這裡簡化為從環境變數獲取，或者您也可以模擬一個隨機波動。
     """
@@ -91,75 +220,85 @@ def process_paper_trade_command(message: pubsub_v1.subscriber.message.Message):
     """
     處理接收到的最終交易指令，並在模擬環境中執行。
     """
+    ack_queued = False # 賬戶變更已套用、訊息已排入延後確認後，不可再 nack (重新投遞會重複套用交易)
     try:
-        command_data = json.loads(message.data.decode('utf-8'))
-        symbol = command_data['symbol']
-        action = command_data['action']
-        quantity_requested = command_data['quantity']
-        order_type = command_data['order_type']
+        command = FinalTradeCommand.from_dict(orjson.loads(message.data)) # orjson 直接解析 bytes
+        symbol = command.symbol
+        action = command.action
+        quantity_requested = command.quantity
+        order_type = command.order_type
         
         logging.info(f"Processing paper trade: {action} {quantity_requested:.6f} {symbol} (Order Type: {order_type})")
 
-        account_state = get_paper_account_state()
-        if not account_state:
-            logging.error("Failed to load paper account state. Cannot process paper trade.")
-            message.nack()
-            return
-
-        balance = account_state['balance_usd']
-        positions = account_state['positions']
-        
         mock_price = get_mock_asset_price(symbol)
         if mock_price <= 0:
             logging.error(f"Invalid mock price for {symbol}: {mock_price}. Cannot execute paper trade.")
             message.nack()
             return
 
-        executed_quantity = 0.0
-        executed_price = mock_price
-        status = "FAILED"
-        error_message = ""
-        pnl = 0.0
-
-        if order_type == "MARKET":
-            if action == "BUY":
-                cost = quantity_requested * mock_price
-                if balance >= cost:
-                    balance -= cost
-                    positions[symbol] = positions.get(symbol, 0) + quantity_requested
-                    executed_quantity = quantity_requested
-                    status = "FILLED"
-                    logging.info(f"Paper BUY: {quantity_requested:.6f} {symbol} at {mock_price:.2f}. New balance: {balance:.2f}")
-                else:
-                    status = "REJECTED"
-                    error_message = "Insufficient balance for paper BUY."
-                    logging.warning(f"Paper BUY rejected: {error_message} (Needed: {cost:.2f}, Have: {balance:.2f})")
-            elif action == "SELL":
-                held_quantity = positions.get(symbol, 0)
-                if held_quantity >= quantity_requested:
-                    revenue = quantity_requested * mock_price
-                    balance += revenue
-                    positions[symbol] -= quantity_requested
-                    # 假設這裡計算平倉盈虧，需要之前的買入價格
-                    # 這裡簡化為不計算 PnL，或者 PnL 在後續報告中根據平均成本計算
-                    executed_quantity = quantity_requested
-                    status = "FILLED"
-                    logging.info(f"Paper SELL: {quantity_requested:.6f} {symbol} at {mock_price:.2f}. New balance: {balance:.2f}")
+        # 讀取、計算與更新賬戶狀態需在同一把鎖內完成，避免並行回調互相覆蓋
+        with account_lock:
+            account_state = get_paper_account_state()
+            if not account_state:
+                logging.error("Failed to load paper account state. Cannot process paper trade.")
+                message.nack()
+                return
+
+            balance = account_state['balance_usd']
+            positions = account_state['positions']
+
+            executed_quantity = 0.0
+            executed_price = mock_price
+            status = "FAILED"
+            error_message = ""
+            pnl = 0.0
+
+            if order_type == "MARKET":
+                if action == "BUY":
+                    cost = quantity_requested * mock_price
+                    if balance >= cost:
+                        balance -= cost
+                        positions[symbol] = positions.get(symbol, 0) + quantity_requested
+                        executed_quantity = quantity_requested
+                        status = "FILLED"
+                        logging.info(f"Paper BUY: {quantity_requested:.6f} {symbol} at {mock_price:.2f}. New balance: {balance:.2f}")
+                    else:
+                        status = "REJECTED"
+                        error_message = "Insufficient balance for paper BUY."
+                        logging.warning(f"Paper BUY rejected: {error_message} (Needed: {cost:.2f}, Have: {balance:.2f})")
+                elif action == "SELL":
+                    held_quantity = positions.get(symbol, 0)
+                    if held_quantity >= quantity_requested:
+                        revenue = quantity_requested * mock_price
+                        balance += revenue
+                        positions[symbol] -= quantity_requested
+                        # 假設這裡計算平倉盈虧，需要之前的買入價格
+                        # 這裡簡化為不計算 PnL，或者 PnL 在後續報告中根據平均成本計算
+                        executed_quantity = quantity_requested
+                        status = "FILLED"
+                        logging.info(f"Paper SELL: {quantity_requested:.6f} {symbol} at {mock_price:.2f}. New balance: {balance:.2f}")
+                    else:
+                        status = "REJECTED"
+                        error_message = "Insufficient position for paper SELL."
+                        logging.warning(f"Paper SELL rejected: {error_message} (Needed: {quantity_requested:.6f}, Have: {held_quantity:.6f})")
                 else:
-                    status = "REJECTED"
-                    error_message = "Insufficient position for paper SELL."
-                    logging.warning(f"Paper SELL rejected: {error_message} (Needed: {quantity_requested:.6f}, Have: {held_quantity:.6f})")
+                    error_message = f"Unsupported action for paper trade: {action}"
+                    logging.error(error_message)
             else:
-                error_message = f"Unsupported action for paper trade: {action}"
+                error_message = f"Unsupported order type for paper trade: {order_type}"
                 logging.error(error_message)
-        else:
-            error_message = f"Unsupported order type for paper trade: {order_type}"
-            logging.error(error_message)
 
-        # 更新賬戶狀態
-        update_paper_account_state(account_id="default_paper_account", new_balance=balance, new_positions=positions)
+            # 更新賬戶狀態：positions 已在緩存的字典上原地修改，這裡只寫回餘額並標記待寫回
+            # (只更新內存緩存，由背景線程定期寫回 Firestore)；未成交時狀態沒有變化，不需要寫回
+            if status == "FILLED":
+                account_state['balance_usd'] = balance
+                dirty_accounts.add("default_paper_account")
+            positions = dict(positions) # 報告與交易記錄異步寫出，需使用當下的持倉快照，之後的交易不會改變它
+            # 訊息在賬戶狀態寫回 Firestore 後才確認 (見 flush_paper_account_states)，實例中途停止時會重新投遞
+            pending_account_acks.append(message)
+            ack_queued = True
 
-        # 記錄模擬交易報告
+        # 記錄模擬交易報告：同一個字典既是 Firestore 交易記錄，也是發布到 Pub/Sub 的報告
         paper_trade_report = {
             "symbol": symbol,
             "action": action,
@@ -167,7 +306,7 @@ def process_paper_trade_command(message: pubsub_v1.subscriber.message.Message):
             "order_type": order_type,
             "status": status,
             "error_message": error_message,
-            "timestamp": int(datetime.datetime.now().timestamp() * 1000),
+            "timestamp": time.time_ns() // 1_000_000, # 當前時間戳 (毫秒)
             "executed_price": executed_price,
             "executed_quantity": executed_quantity,
             "mock_account_balance": balance,
@@ -178,36 +317,71 @@ def process_paper_trade_command(message: pubsub_v1.subscriber.message.Message):
         record_paper_trade(paper_trade_report)
         
         # 發布模擬交易報告到 Pub/Sub (讓日誌/通知模組也能收到)
-        message_data = json.dumps(paper_trade_report).encode('utf-8')
+        message_data = orjson.dumps(paper_trade_report) # orjson 直接輸出 bytes
         future = publisher.publish(paper_trade_reports_topic_path, message_data)
-        future.add_done_callback(lambda f: logging.debug(f"Paper trade report published with ID: {f.result()}"))
+        future.add_done_callback(log_publish_failure)
 
-        message.ack() # 確認訊息已處理
         logging.info(f"Processed paper trade command for {symbol} and recorded report.")
 
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logging.error(f"Error decoding JSON message from final trade command (paper): {e}")
         message.nack()
     except Exception as e:
-        logging.error(f"Error processing paper trade command: {e}", exc_info=True)
-        message.nack()
+        if ack_queued:
+            # 賬戶變更已套用，訊息會在寫回 Firestore 後確認；只有報告/交易記錄未能送出
+            logging.error(f"Error reporting paper trade after account update: {e}", exc_info=True)
+        else:
+            logging.error(f"Error processing paper trade command: {e}", exc_info=True)
+            message.nack()
+
+
+def ensure_subscription(sub_path, topic_path):
+    """
+    確保訂閱存在。先以 get_subscription 檢查 (一次輕量讀取)，只有 NotFound 時才創建；
+    確認成功後記錄在 SUBSCRIPTION_SENTINEL_FILE，同一容器內重啟時直接跳過管理 API 調用。
+    注意：在生產環境中，通常會透過 Terraform 或手動在 GCP 控制台創建訂閱。
+    """
+    try:
+        with open(SUBSCRIPTION_SENTINEL_FILE) as f:
+            if sub_path in f.read().splitlines():
+                return
+    except OSError:
+        pass
+
+    try:
+        subscriber.get_subscription(subscription=sub_path)
+        logging.info(f"Subscription {sub_path} already exists.")
+    except NotFound:
+        try:
+            subscriber.create_subscription(name=sub_path, topic=topic_path)
+            logging.info(f"Subscription {sub_path} created.")
+        except AlreadyExists: # 其他實例同時啟動並已創建
+            logging.info(f"Subscription {sub_path} already exists.")
+
+    try:
+        with open(SUBSCRIPTION_SENTINEL_FILE, "a") as f:
+            f.write(sub_path + "\n")
+    except OSError as e:
+        logging.warning(f"Could not record subscription in {SUBSCRIPTION_SENTINEL_FILE}: {e}")
 
 
 def main():
     logging.info("Starting Paper Trading Module...")
+
+    threading.Thread(target=account_flush_loop, daemon=True).start()
+    for _ in range(TRADE_RECORD_WRITERS):
+        threading.Thread(target=trade_record_writer, daemon=True).start()
     
-    # 創建訂閱 (如果不存在)
-    try:
-        subscriber.create_subscription(name=final_trade_execution_sub_path, topic=publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_FINAL_TRADE_EXECUTION))
-        logging.info(f"Subscription {final_trade_execution_sub_path} created (if it didn't exist).")
-    except Exception as e:
-        if "AlreadyExists" in str(e):
-            logging.info(f"Subscription {final_trade_execution_sub_path} already exists.")
-        else:
-            logging.error(f"Error creating subscription {final_trade_execution_sub_path}: {e}")
+    # 確保訂閱存在（如果不存在則創建）；訂閱必須在開始拉取前存在，因此同步完成
+    if CREATE_SUBSCRIPTIONS_ON_START:
+        try:
+            ensure_subscription(final_trade_execution_sub_path, publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_FINAL_TRADE_EXECUTION))
+        except Exception as e:
+            logging.error(f"Error ensuring subscription {final_trade_execution_sub_path}: {e}")
             exit(1)
 
-    streaming_pull_future = subscriber.subscribe(final_trade_execution_sub_path, callback=process_paper_trade_command)
+    scheduler = pubsub_v1.subscriber.scheduler.ThreadScheduler(executor=ThreadPoolExecutor(max_workers=SUBSCRIBER_MAX_WORKERS))
+    streaming_pull_future = subscriber.subscribe(final_trade_execution_sub_path, callback=process_paper_trade_command, flow_control=SUBSCRIBER_FLOW_CONTROL, scheduler=scheduler)
     logging.info(f"Listening for final trade execution commands on {PUBSUB_TOPIC_FINAL_TRADE_EXECUTION} for paper trading...")
 
     try:
@@ -222,6 +396,8 @@ def main():
         logging.error(f"Error in Pub/Sub subscription for paper trader: {e}", exc_info=True)
     finally:
         subscriber.close()
+        flush_paper_account_states() # 寫回最後一次變更
+        drain_trade_records()
         logging.info("Paper Trading Module stopped.")
 
 if __name__ == '__main__':
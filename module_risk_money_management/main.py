@@ -1,8 +1,18 @@
 import os
-import json
+import orjson
+import msgpack
+import time
 import logging
+import functools
+import threading
+import numpy as np
 from google.cloud import pubsub_v1
-from concurrent.futures import TimeoutError
+from google.api_core.exceptions import AlreadyExists, NotFound
+from concurrent.futures import TimeoutError, ThreadPoolExecutor
+try:
+    import redis
+except ImportError: # redis 為選用依賴；未安裝時使用進程內狀態 (僅適用單一實例)
+    redis = None
 # from binance.client import Client # 如果需要查詢實時資產，則需要引入幣安客戶端
 # from google.cloud import secretmanager_v1beta1 as secretmanager # 如果需要從Secret Manager獲取幣安Key
 
@@ -14,6 +24,9 @@ GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID")
 PUBSUB_TOPIC_TRADE_COMMANDS = os.environ.get("PUBSUB_TOPIC_TRADE_COMMANDS", "trade-commands") # 訂閱的 Topic
 PUBSUB_TOPIC_FINAL_TRADE_EXECUTION = os.environ.get("PUBSUB_TOPIC_FINAL_TRADE_EXECUTION", "final-trade-execution") # 發布的 Topic
 PUBSUB_TOPIC_RISK_ALERTS = os.environ.get("PUBSUB_TOPIC_RISK_ALERTS", "risk-alerts") # 風險警報 Topic
+# 設定 REDIS_HOST 後，模擬資金與倉位保存在 Redis，以原子增量更新，多個實例共享同一份狀態
+REDIS_HOST = os.environ.get("REDIS_HOST")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", "6379"))
 
 if not GCP_PROJECT_ID:
     logging.error("GCP_PROJECT_ID environment variable not set. Exiting.")
@@ -21,31 +34,139 @@ if not GCP_PROJECT_ID:
 
 # 初始化 Pub/Sub 客戶端
 subscriber = pubsub_v1.SubscriberClient()
-publisher = pubsub_v1.PublisherClient()
+# 合併多則發布為一次 RPC (最多延遲 50ms)
+publisher = pubsub_v1.PublisherClient(
+    batch_settings=pubsub_v1.types.BatchSettings(max_messages=100, max_bytes=1024 * 1024, max_latency=0.05)
+)
+# 風險警報量少但需要盡快送達，使用獨立的低延遲客戶端 (最多延遲 10ms)
+alerts_publisher = pubsub_v1.PublisherClient(
+    batch_settings=pubsub_v1.types.BatchSettings(max_messages=100, max_bytes=1024 * 1024, max_latency=0.01)
+)
 
 # 訂閱路徑
 trade_commands_sub_path = subscriber.subscription_path(GCP_PROJECT_ID, f"{PUBSUB_TOPIC_TRADE_COMMANDS}-sub-risk-manager")
 final_trade_execution_topic_path = publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_FINAL_TRADE_EXECUTION)
 risk_alerts_topic_path = publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_RISK_ALERTS)
 
+# 訂閱端流量控制與回調線程數：回調中以阻塞 I/O 為主，線程數取 CPU 核心數的 8 倍
+SUBSCRIBER_MAX_WORKERS = 8 * (os.cpu_count() or 1)
+SUBSCRIBER_FLOW_CONTROL = pubsub_v1.types.FlowControl(max_messages=1000, max_bytes=100 * 1024 * 1024)
+# 訂閱已由 Terraform / gcloud 預先建立時，設 CREATE_SUBSCRIPTIONS_ON_START=0 跳過啟動時的管理 API 調用
+CREATE_SUBSCRIPTIONS_ON_START = os.environ.get("CREATE_SUBSCRIPTIONS_ON_START", "1") == "1"
+SUBSCRIPTION_SENTINEL_FILE = os.environ.get("SUBSCRIPTION_SENTINEL_FILE", "/tmp/.sub_ok") # 已確認存在的訂閱路徑，每行一個
+
+# 策略模組以固定欄位順序的 msgpack 陣列發布交易指令 (訊息屬性 encoding 標示)；
+# 欄位順序須與 module_multi_strategy_decision 的 TRADE_COMMAND_FIELDS 一致
+TRADE_COMMAND_ENCODING = "trade-command-msgpack-v1"
+TRADE_COMMAND_FIELDS = ("symbol", "action", "signal_score", "timestamp", "order_type", "quantity_type", "quantity_value")
+
 
 # --- 模擬資產管理 (實際情況應從交易所API獲取或資料庫中獲取) ---
-# 注意：在生產環境中，這種狀態變量會導致多個 Cloud Run 實例之間的狀態不一致。
-# 必須使用共享的、持久化的儲存（例如 Firestore 或 Redis）來維護資產和倉位狀態。
-# 這裡僅為範例目的。
-current_portfolio_value = float(os.environ.get("INITIAL_PORTFOLIO_VALUE", "1000.0")) # 初始模擬資金
+# 未設定 REDIS_HOST 時使用下列進程內狀態；多個 Cloud Run 實例之間的狀態會不一致，僅適用於單一實例。
+INITIAL_PORTFOLIO_VALUE = float(os.environ.get("INITIAL_PORTFOLIO_VALUE", "1000.0")) # 初始模擬資金
+current_portfolio_value = INITIAL_PORTFOLIO_VALUE
 current_positions = {} # {symbol: quantity}
+portfolio_lock = threading.Lock() # 回調在多個線程上執行，進程內狀態的更新需要加鎖
+
+PORTFOLIO_VALUE_KEY = "risk:portfolio_value"
+POSITIONS_KEY = "risk:positions" # Redis hash {symbol: quantity}
+
+# 初始化 Redis 客戶端 (可選)；redis.Redis 內建連接池，可在多個回調線程間共用
+redis_client = None
+if REDIS_HOST:
+    if redis is None:
+        logging.error("REDIS_HOST is set but the redis package is not installed. Exiting.")
+        exit(1)
+    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+    redis_client.set(PORTFOLIO_VALUE_KEY, INITIAL_PORTFOLIO_VALUE, nx=True) # 只在尚未初始化時寫入初始資金
+
+# 以 Lua 腳本在 Redis 端原子地套用一筆交易：資金鍵缺失 (例如被驅逐或清空) 時先以初始資金補回，
+# 倉位出現負值時在同一腳本內歸零，其他實例不會讀到中間狀態。
+# 返回 [新的資金, 新的倉位, 是否歸零]；Lua 數字會被截斷為整數，浮點值以字串返回
+APPLY_TRADE_SCRIPT = """
+redis.call('SET', KEYS[1], ARGV[4], 'NX')
+local value = redis.call('INCRBYFLOAT', KEYS[1], ARGV[1])
+local position = redis.call('HINCRBYFLOAT', KEYS[2], ARGV[2], ARGV[3])
+if tonumber(position) < 0 then
+    redis.call('HSET', KEYS[2], ARGV[2], 0)
+    return {value, '0', 1}
+end
+return {value, position, 0}
+"""
+apply_trade_script = redis_client.register_script(APPLY_TRADE_SCRIPT) if redis_client is not None else None
 
 # 假設的單筆交易風險比例 (例如 0.01 = 1%)
 DEFAULT_RISK_PER_TRADE = float(os.environ.get("DEFAULT_RISK_PER_TRADE", "0.01"))
 # 假設的總風險限制 (例如 0.05 = 5%)
 MAX_PORTFOLIO_RISK = float(os.environ.get("MAX_PORTFOLIO_RISK", "0.05"))
-
-
+# 簡單止損止盈：例如，買入後跌 1% 止損，漲 2% 止盈；賣出後價格上漲止損，下跌止盈
+STOP_LOSS_PERCENTAGE_BUY = float(os.environ.get("STOP_LOSS_PERCENTAGE_BUY", "0.01")) # 1%
+TAKE_PROFIT_PERCENTAGE_BUY = float(os.environ.get("TAKE_PROFIT_PERCENTAGE_BUY", "0.02")) # 2%
+STOP_LOSS_PERCENTAGE_SELL = float(os.environ.get("STOP_LOSS_PERCENTAGE_SELL", "0.01"))
+TAKE_PROFIT_PERCENTAGE_SELL = float(os.environ.get("TAKE_PROFIT_PERCENTAGE_SELL", "0.02"))
+# 止損/止盈價格相對當前價格的乘數 {action: (止損乘數, 止盈乘數)}
+SL_TP_MULTIPLIERS = {
+    "BUY": (1 - STOP_LOSS_PERCENTAGE_BUY, 1 + TAKE_PROFIT_PERCENTAGE_BUY),
+    "SELL": (1 + STOP_LOSS_PERCENTAGE_SELL, 1 - TAKE_PROFIT_PERCENTAGE_SELL), # 賣空邏輯，或止盈平倉
+}
+
+# -------------------------------------------------------------------
+# 微批次：回調只解碼並放入緩衝區，背景線程每個窗口以 NumPy 一次計算整批指令的數量與風險檢查
+# -------------------------------------------------------------------
+RISK_BATCH_INTERVAL = float(os.environ.get("RISK_BATCH_MS", "20")) / 1000.0
+pending_commands = [] # [(command_data, message)]，尚未處理的交易指令
+pending_commands_lock = threading.Lock()
+
+
+def log_publish_failure(future):
+    """Pub/Sub 發布完成的回調函數，只在發布失敗時記錄日誌"""
+    e = future.exception()
+    if e is not None:
+        logging.error(f"Failed to publish message: {e}")
+
+
+def get_portfolio_value():
+    """讀取當前模擬資金 (USD)。Redis 中的資金鍵缺失時以初始資金補回 (SET NX，不覆蓋其他實例剛寫入的值)。"""
+    if redis_client is not None:
+        value = redis_client.get(PORTFOLIO_VALUE_KEY)
+        if value is None:
+            logging.warning(f"{PORTFOLIO_VALUE_KEY} is missing in Redis. Re-seeding with initial portfolio value {INITIAL_PORTFOLIO_VALUE}.")
+            redis_client.set(PORTFOLIO_VALUE_KEY, INITIAL_PORTFOLIO_VALUE, nx=True)
+            value = redis_client.get(PORTFOLIO_VALUE_KEY)
+        return float(value) if value is not None else INITIAL_PORTFOLIO_VALUE
+    return current_portfolio_value
+
+def apply_trade_to_portfolio(symbol, value_delta, quantity_delta):
+    """
+    以原子增量更新模擬資金與倉位，返回 (新的資金, 新的倉位)。
+    倉位出現負值 (賣出多於持有) 時記錄警告並歸零。
+    """
+    global current_portfolio_value
+    if redis_client is not None:
+        new_value, new_position, clamped = apply_trade_script(
+            keys=[PORTFOLIO_VALUE_KEY, POSITIONS_KEY],
+            args=[value_delta, symbol, quantity_delta, INITIAL_PORTFOLIO_VALUE],
+        )
+        if clamped:
+            logging.warning(f"Selling more than held for {symbol}. Check logic.")
+        return float(new_value), float(new_position)
+
+    with portfolio_lock:
+        current_portfolio_value += value_delta
+        new_position = current_positions.get(symbol, 0) + quantity_delta
+        if new_position < 0:
+            logging.warning(f"Selling more than held for {symbol}. Check logic.")
+            new_position = 0 # 避免負值
+        current_positions[symbol] = new_position
+        return current_portfolio_value, new_position
+
+
+@functools.lru_cache(maxsize=256)
 def get_current_asset_price(symbol):
     """
     獲取實時資產價格。在生產環境中，這應從數據獲取模組的數據庫或交易所 API 獲取。
-    這裡簡化為從環境變數獲取一個模擬價格。
+    這裡簡化為從環境變數獲取一個模擬價格；環境變數在容器運行期間不會改變，每個交易對只讀取並解析一次。
+    (改為查詢即時價格時需移除緩存)
     """
     # 實際應該查詢即時價格，例如：
     # from binance.client import Client
@@ -57,154 +178,199 @@ def get_current_asset_price(symbol):
     return float(os.environ.get(f"{symbol}_PRICE", "1000.0"))
 
 
-def calculate_trade_quantity(action, symbol, current_price, risk_percentage=DEFAULT_RISK_PER_TRADE):
+def calculate_trade_quantities(current_prices, portfolio_value, risk_percentage=DEFAULT_RISK_PER_TRADE):
     """
-    根據風險管理規則計算交易數量。
+    根據風險管理規則計算一批交易的數量。
+    current_prices: float64 陣列；價格無效 (<= 0) 的指令數量為 0。
     這裡採用簡單的基於資金百分比的計算。
     更複雜的包括倉位大小、Kelly Criterion 等。
     """
-    if current_portfolio_value <= 0:
+    if portfolio_value <= 0:
         logging.warning("Portfolio value is zero or negative. Cannot calculate trade quantity.")
-        return 0.0
+        return np.zeros_like(current_prices)
 
     # 假設每次交易投入資金的百分比，再根據當前幣種價格換算數量
     # 這只是一個非常簡化的例子，實際的倉位管理會更複雜
-    target_usd_value = current_portfolio_value * risk_percentage # 投資資金的百分比
-    
-    if current_price <= 0:
-        logging.error(f"Current price for {symbol} is invalid: {current_price}")
-        return 0.0
+    target_usd_value = portfolio_value * risk_percentage # 投資資金的百分比
 
-    quantity = target_usd_value / current_price
-    
     # 這裡可以根據交易所的最小交易量、最小步長等進行調整
     # 例如：quantity = round(quantity, binance_precision)
-    
-    logging.info(f"Calculated trade quantity for {symbol} ({action}): {quantity:.6f} at {current_price:.2f} (USD value: {target_usd_value:.2f})")
-    return quantity
+    valid = current_prices > 0
+    return np.divide(target_usd_value, current_prices, out=np.zeros_like(current_prices), where=valid)
 
 
-def check_overall_portfolio_risk(trade_value_usd):
+def check_overall_portfolio_risk(trade_values_usd, portfolio_value):
     """
-    檢查整體投資組合風險是否超過限制。
+    檢查整體投資組合風險是否超過限制，返回交易是否通過 (傳入陣列時返回布林陣列)。
     這需要實時查詢所有持倉和其盈虧。
     這裡僅為概念演示。
     """
     # 假設我們有一個簡單的總風險閾值
     # 在實際應用中，會計算 VaR (Value at Risk) 或其他更複雜的指標
-    current_total_risk_exposure = 0.0 # 這是需要從資料庫獲取或實時計算的
-    
     # 這裡的邏輯需要您根據實際定義的總風險指標來實現
     # 例如：如果當前浮虧佔總資產的百分比超過 MAX_PORTFOLIO_RISK
-    
-    # 簡化：如果當前這筆交易會導致模擬總價值低於某個預警線
-    if current_portfolio_value - trade_value_usd < current_portfolio_value * (1 - MAX_PORTFOLIO_RISK):
-        logging.warning(f"Potential trade of {trade_value_usd:.2f} USD might exceed portfolio risk limit.")
-        # 可以選擇不執行這筆交易或發出警報
-        return False
-    return True
 
+    # 簡化：如果這筆交易會導致模擬總價值低於某個預警線則不通過
+    return portfolio_value - trade_values_usd >= portfolio_value * (1 - MAX_PORTFOLIO_RISK)
 
-def process_trade_command(message: pubsub_v1.subscriber.message.Message):
+
+def finalize_trade_command(command_data, current_price, quantity, trade_usd_value, within_risk_limit):
     """
-    處理接收到的交易指令，進行風險和資金管理。
+    根據計算出的數量與風險檢查結果，完成單筆交易指令：發布警報，或計算止損止盈、
+    更新投資組合狀態並發布最終交易指令。訊息的確認由調用方負責。
+    返回已套用到投資組合資金的變化量 (USD，未更新時為 0.0)。
+    投資組合更新之後的失敗只記錄日誌、不拋出：調用方 nack 後重新投遞會重複套用同一筆交易。
     """
-    global current_portfolio_value, current_positions # 允許修改全局變量，但在生產環境應避免
+    symbol = command_data['symbol']
+    action = command_data['action']
+
+    # 1. 資金管理：數量已由 process_command_batch 按當前資金計算
+    if quantity <= 0:
+        logging.warning(f"Calculated quantity for {symbol} is zero or negative. Skipping trade.")
+        return 0.0
+    logging.info(f"Calculated trade quantity for {symbol} ({action}): {quantity:.6f} at {current_price:.2f} (USD value: {trade_usd_value:.2f})")
+
+    # 2. 檢查整體風險
+    if not within_risk_limit:
+        logging.warning(f"Potential trade of {trade_usd_value:.2f} USD might exceed portfolio risk limit.")
+        alert_message = {
+            "type": "RISK_EXCEEDED",
+            "symbol": symbol,
+            "action": action,
+            "reason": "Portfolio risk limit might be exceeded.",
+            "timestamp": command_data['timestamp']
+        }
+        alerts_publisher.publish(risk_alerts_topic_path, orjson.dumps(alert_message)).add_done_callback(log_publish_failure)
+        logging.warning(f"Trade for {symbol} ({action}) aborted due to overall portfolio risk.")
+        return 0.0 # 認為已處理，但沒有執行交易
+
+    # 3. 計算止損止盈價格 (簡化範例，乘數在模組載入時計算，見 SL_TP_MULTIPLIERS)
+    stop_loss_price = None
+    take_profit_price = None
+    multipliers = SL_TP_MULTIPLIERS.get(action)
+    if multipliers is not None:
+        stop_loss_price = current_price * multipliers[0]
+        take_profit_price = current_price * multipliers[1]
+
+    # 4. 更新模擬的投資組合狀態 (Redis 或進程內狀態，以原子增量更新)
+    # 這是一個非常簡化的更新，實際需要考慮交易費用、成交價格等
+    value_delta = 0.0
+    applied = action in ("BUY", "SELL")
+    if applied:
+        # SELL 假設是平倉操作，或賣空操作
+        sign = 1.0 if action == "BUY" else -1.0
+        value_delta = -sign * trade_usd_value
+        new_portfolio_value, new_position = apply_trade_to_portfolio(symbol, value_delta, sign * quantity)
+        logging.info(f"Updated simulated portfolio value: {new_portfolio_value:.2f} USD")
+        logging.info(f"Current position for {symbol}: {new_position}")
 
     try:
-        command_data = json.loads(message.data.decode('utf-8'))
-        symbol = command_data['symbol']
-        action = command_data['action']
-        original_signal_score = command_data['signal_score']
+        publish_final_trade_command(command_data, current_price, quantity, stop_loss_price, take_profit_price)
+    except Exception as e:
+        if not applied:
+            raise
+        logging.error(f"Error publishing final trade command for {symbol} after updating the portfolio: {e}", exc_info=True)
+    return value_delta
+
+
+def publish_final_trade_command(command_data, current_price, quantity, stop_loss_price, take_profit_price):
+    """構建並發布最終交易指令。"""
+    symbol = command_data['symbol']
+    final_trade_command = {
+        "symbol": symbol,
+        "action": command_data['action'],
+        "quantity": quantity,
+        "order_type": command_data['order_type'], # 從上一個模組繼承
+        "price": current_price, # 市價單時，這個價格用於參考
+        "stop_loss_price": stop_loss_price,
+        "take_profit_price": take_profit_price,
+        "timestamp": command_data['timestamp'],
+        "source_signal_score": command_data['signal_score'],
+        "risk_managed": True
+    }
+    
+    # 發布最終交易指令到 Pub/Sub
+    message_data = orjson.dumps(final_trade_command) # orjson 直接輸出 bytes
+    future = publisher.publish(final_trade_execution_topic_path, message_data)
+    future.add_done_callback(log_publish_failure)
+    
+    logging.info(f"Processed trade command for {symbol} and published final execution command.")
 
-        logging.info(f"Received trade command for {symbol}: {action} (Score: {original_signal_score:.2f})")
 
-        current_price = get_current_asset_price(symbol)
+def process_command_batch(batch):
+    """
+    處理一個窗口內的交易指令：以 NumPy 一次計算每單位資金對應的交易數量，再逐筆按當前資金
+    確定數量、進行風險檢查、完成並確認訊息。
+    數量與風險檢查都使用隨同批次中先前已套用交易遞減/遞增的資金，結果與逐則處理相同；
+    否則同一窗口內的多筆交易合計可能超過總風險限制。
+    """
+    priced = []
+    for command_data, message in batch:
+        current_price = get_current_asset_price(command_data['symbol'])
         if current_price is None:
-            logging.error(f"Could not get current price for {symbol}. Skipping risk management.")
+            logging.error(f"Could not get current price for {command_data['symbol']}. Skipping risk management.")
+            message.nack()
+            continue
+        priced.append((command_data, message, current_price))
+    if not priced:
+        return
+
+    # 每 1 USD 資金對應的交易數量 (risk / price)，價格無效時為 0
+    current_prices = np.fromiter((p[2] for p in priced), dtype=np.float64, count=len(priced))
+    quantities_per_usd = calculate_trade_quantities(current_prices, 1.0)
+
+    running_value = get_portfolio_value()
+    for (command_data, message, _), current_price, quantity_per_usd in zip(
+            priced, current_prices.tolist(), quantities_per_usd.tolist()):
+        if running_value <= 0:
+            logging.warning("Portfolio value is zero or negative. Cannot calculate trade quantity.")
+            quantity = 0.0
+        else:
+            quantity = quantity_per_usd * running_value
+        trade_usd_value = quantity * current_price
+        ok = check_overall_portfolio_risk(trade_usd_value, running_value)
+        try:
+            # 只有實際套用到投資組合的交易計入後續指令的資金
+            running_value += finalize_trade_command(command_data, current_price, quantity, trade_usd_value, ok)
+            message.ack() # 確認訊息已處理
+        except Exception as e: # 只會發生在投資組合更新之前，nack 重新投遞不會重複套用
+            logging.error(f"Error processing trade command in risk manager: {e}", exc_info=True)
             message.nack()
-            return
 
-        # 1. 計算交易數量並進行資金管理
-        quantity = calculate_trade_quantity(action, symbol, current_price)
-        if quantity <= 0:
-            logging.warning(f"Calculated quantity for {symbol} is zero or negative. Skipping trade.")
-            message.ack()
-            return
 
-        trade_usd_value = quantity * current_price
+def flush_pending_commands():
+    """背景線程：每個微批次窗口結束時，處理緩衝區中的所有交易指令。"""
+    global pending_commands
+    while True:
+        time.sleep(RISK_BATCH_INTERVAL)
+        with pending_commands_lock:
+            batch, pending_commands = pending_commands, []
+        if not batch:
+            continue
+        try:
+            process_command_batch(batch)
+        except Exception as e:
+            logging.error(f"Error processing trade command batch in risk manager: {e}", exc_info=True)
+            for _, message in batch:
+                message.nack() # 已確認的訊息再次 nack 不會生效
 
-        # 2. 檢查整體風險
-        if not check_overall_portfolio_risk(trade_usd_value):
-            alert_message = {
-                "type": "RISK_EXCEEDED",
-                "symbol": symbol,
-                "action": action,
-                "reason": "Portfolio risk limit might be exceeded.",
-                "timestamp": command_data['timestamp']
-            }
-            publisher.publish(risk_alerts_topic_path, json.dumps(alert_message).encode('utf-8'))
-            logging.warning(f"Trade for {symbol} ({action}) aborted due to overall portfolio risk.")
-            message.ack() # 認為已處理，但沒有執行交易
-            return
-        
-        # 3. 計算止損止盈價格 (簡化範例)
-        stop_loss_price = None
-        take_profit_price = None
-        
-        # 簡單止損止盈：例如，買入後跌 1% 止損，漲 2% 止盈
-        if action == "BUY":
-            stop_loss_percentage = float(os.environ.get("STOP_LOSS_PERCENTAGE_BUY", "0.01")) # 1%
-            take_profit_percentage = float(os.environ.get("TAKE_PROFIT_PERCENTAGE_BUY", "0.02")) # 2%
-            stop_loss_price = current_price * (1 - stop_loss_percentage)
-            take_profit_price = current_price * (1 + take_profit_percentage)
-        elif action == "SELL":
-            # 賣空邏輯，或止盈平倉
-            stop_loss_percentage = float(os.environ.get("STOP_LOSS_PERCENTAGE_SELL", "0.01"))
-            take_profit_percentage = float(os.environ.get("TAKE_PROFIT_PERCENTAGE_SELL", "0.02"))
-            stop_loss_price = current_price * (1 + stop_loss_percentage) # 賣出後價格上漲止損
-            take_profit_price = current_price * (1 - take_profit_percentage) # 賣出後價格下跌止盈
-
-        # 4. 更新模擬的投資組合狀態 (生產環境中這些操作會寫入資料庫)
-        # 這是一個非常簡化的更新，實際需要考慮交易費用、成交價格等
-        if action == "BUY":
-            current_portfolio_value -= trade_usd_value
-            current_positions[symbol] = current_positions.get(symbol, 0) + quantity
-        elif action == "SELL":
-            # 這裡假設是平倉操作，或賣空操作
-            current_portfolio_value += trade_usd_value
-            current_positions[symbol] = current_positions.get(symbol, 0) - quantity
-            if current_positions[symbol] < 0:
-                logging.warning(f"Selling more than held for {symbol}. Check logic.")
-                current_positions[symbol] = 0 # 避免負值
-
-        logging.info(f"Updated simulated portfolio value: {current_portfolio_value:.2f} USD")
-        logging.info(f"Current positions: {current_positions}")
-
-
-        # 構建最終交易指令
-        final_trade_command = {
-            "symbol": symbol,
-            "action": action,
-            "quantity": quantity,
-            "order_type": command_data['order_type'], # 從上一個模組繼承
-            "price": current_price, # 市價單時，這個價格用於參考
-            "stop_loss_price": stop_loss_price,
-            "take_profit_price": take_profit_price,
-            "timestamp": command_data['timestamp'],
-            "source_signal_score": original_signal_score,
-            "risk_managed": True
-        }
-        
-        # 發布最終交易指令到 Pub/Sub
-        message_data = json.dumps(final_trade_command).encode('utf-8')
-        future = publisher.publish(final_trade_execution_topic_path, message_data)
-        future.add_done_callback(lambda f: logging.debug(f"Final trade command published with ID: {f.result()}"))
-        
-        message.ack() # 確認訊息已處理
-        logging.info(f"Processed trade command for {symbol} and published final execution command.")
-
-    except json.JSONDecodeError as e:
+
+def process_trade_command(message: pubsub_v1.subscriber.message.Message):
+    """
+    處理接收到的交易指令：只解碼並放入微批次緩衝區，由 flush_pending_commands 進行風險和資金管理。
+    """
+    try:
+        if message.attributes.get("encoding") == TRADE_COMMAND_ENCODING:
+            command_data = dict(zip(TRADE_COMMAND_FIELDS, msgpack.unpackb(message.data)))
+        else:
+            command_data = orjson.loads(message.data) # orjson 直接解析 bytes
+
+        logging.info(f"Received trade command for {command_data['symbol']}: {command_data['action']} (Score: {command_data['signal_score']:.2f})")
+
+        with pending_commands_lock:
+            pending_commands.append((command_data, message))
+
+    except orjson.JSONDecodeError as e:
         logging.error(f"Error decoding JSON message from trade command: {e}")
         message.nack()
     except Exception as e:
@@ -212,21 +378,51 @@ def process_trade_command(message: pubsub_v1.subscriber.message.Message):
         message.nack()
 
 
+def ensure_subscription(sub_path, topic_path):
+    """
+    確保訂閱存在。先以 get_subscription 檢查 (一次輕量讀取)，只有 NotFound 時才創建；
+    確認成功後記錄在 SUBSCRIPTION_SENTINEL_FILE，同一容器內重啟時直接跳過管理 API 調用。
+    注意：在生產環境中，通常會透過 Terraform 或手動在 GCP 控制台創建訂閱。
+    """
+    try:
+        with open(SUBSCRIPTION_SENTINEL_FILE) as f:
+            if sub_path in f.read().splitlines():
+                return
+    except OSError:
+        pass
+
+    try:
+        subscriber.get_subscription(subscription=sub_path)
+        logging.info(f"Subscription {sub_path} already exists.")
+    except NotFound:
+        try:
+            subscriber.create_subscription(name=sub_path, topic=topic_path)
+            logging.info(f"Subscription {sub_path} created.")
+        except AlreadyExists: # 其他實例同時啟動並已創建
+            logging.info(f"Subscription {sub_path} already exists.")
+
+    try:
+        with open(SUBSCRIPTION_SENTINEL_FILE, "a") as f:
+            f.write(sub_path + "\n")
+    except OSError as e:
+        logging.warning(f"Could not record subscription in {SUBSCRIPTION_SENTINEL_FILE}: {e}")
+
+
 def main():
     logging.info("Starting Risk & Money Management Module...")
     
-    # 創建訂閱 (如果不存在)
-    try:
-        subscriber.create_subscription(name=trade_commands_sub_path, topic=publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_TRADE_COMMANDS))
-        logging.info(f"Subscription {trade_commands_sub_path} created (if it didn't exist).")
-    except Exception as e:
-        if "AlreadyExists" in str(e):
-            logging.info(f"Subscription {trade_commands_sub_path} already exists.")
-        else:
-            logging.error(f"Error creating subscription {trade_commands_sub_path}: {e}")
+    # 確保訂閱存在（如果不存在則創建）；訂閱必須在開始拉取前存在，因此同步完成
+    if CREATE_SUBSCRIPTIONS_ON_START:
+        try:
+            ensure_subscription(trade_commands_sub_path, publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_TRADE_COMMANDS))
+        except Exception as e:
+            logging.error(f"Error ensuring subscription {trade_commands_sub_path}: {e}")
             exit(1)
 
-    streaming_pull_future = subscriber.subscribe(trade_commands_sub_path, callback=process_trade_command)
+    threading.Thread(target=flush_pending_commands, daemon=True).start()
+
+    scheduler = pubsub_v1.subscriber.scheduler.ThreadScheduler(executor=ThreadPoolExecutor(max_workers=SUBSCRIBER_MAX_WORKERS))
+    streaming_pull_future = subscriber.subscribe(trade_commands_sub_path, callback=process_trade_command, flow_control=SUBSCRIBER_FLOW_CONTROL, scheduler=scheduler)
     logging.info(f"Listening for trade commands on {PUBSUB_TOPIC_TRADE_COMMANDS}...")
 
     try:
@@ -1,11 +1,23 @@
 import os
-import json
+import base64
+import orjson
 import logging
+import functools
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
 from binance.client import Client
 from binance.exceptions import BinanceAPIException, BinanceRequestException
+from requests.adapters import HTTPAdapter
 from google.cloud import pubsub_v1
+from google.api_core.exceptions import AlreadyExists, NotFound
 from google.cloud import secretmanager_v1beta1 as secretmanager
-from concurrent.futures import TimeoutError
+from concurrent.futures import TimeoutError, ThreadPoolExecutor
+try:
+    from flask import Flask, request
+except ImportError: # flask 僅在以 Pub/Sub 推送 (HTTP) 方式部署時需要；串流拉取模式 (python main.py) 不依賴它
+    Flask = None
 
 # 配置日誌
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -21,16 +33,32 @@ if not GCP_PROJECT_ID:
 
 # 初始化 Pub/Sub 客戶端
 subscriber = pubsub_v1.SubscriberClient()
-publisher = pubsub_v1.PublisherClient()
+# 合併多則發布為一次 RPC (最多延遲 50ms)
+publisher = pubsub_v1.PublisherClient(
+    batch_settings=pubsub_v1.types.BatchSettings(max_messages=100, max_bytes=1024 * 1024, max_latency=0.05)
+)
 
 # 訂閱路徑
 final_trade_execution_sub_path = subscriber.subscription_path(GCP_PROJECT_ID, f"{PUBSUB_TOPIC_FINAL_TRADE_EXECUTION}-sub-executor")
 trade_reports_topic_path = publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_TRADE_REPORTS)
 
+# 訂閱端流量控制與回調線程數：回調中以阻塞 I/O 為主 (交易所 API)，線程數取 CPU 核心數的 8 倍
+SUBSCRIBER_MAX_WORKERS = 8 * (os.cpu_count() or 1)
+SUBSCRIBER_FLOW_CONTROL = pubsub_v1.types.FlowControl(max_messages=1000, max_bytes=100 * 1024 * 1024)
+# 訂閱已由 Terraform / gcloud 預先建立時，設 CREATE_SUBSCRIPTIONS_ON_START=0 跳過啟動時的管理 API 調用
+CREATE_SUBSCRIPTIONS_ON_START = os.environ.get("CREATE_SUBSCRIPTIONS_ON_START", "1") == "1"
+SUBSCRIPTION_SENTINEL_FILE = os.environ.get("SUBSCRIPTION_SENTINEL_FILE", "/tmp/.sub_ok") # 已確認存在的訂閱路徑，每行一個
+
 
 # 初始化 Secret Manager 客戶端
 secret_client = secretmanager.SecretManagerServiceClient()
 
+@functools.lru_cache(maxsize=32)
+def _access_secret(secret_resource_name):
+    """讀取秘密版本並緩存結果；失敗時拋出異常 (異常不會被 lru_cache 緩存，下次會重試)。"""
+    response = secret_client.access_secret_version(name=secret_resource_name)
+    return response.payload.data.decode("UTF-8")
+
 def get_secret(secret_name_env_var):
     """從 Secret Manager 獲取秘密值。"""
     secret_resource_name = os.environ.get(secret_name_env_var)
@@ -38,25 +66,83 @@ def get_secret(secret_name_env_var):
         logging.warning(f"Environment variable '{secret_name_env_var}' for secret not set.")
         return None
     try:
-        response = secret_client.access_secret_version(name=secret_resource_name)
-        return response.payload.data.decode("UTF-8")
+        return _access_secret(secret_resource_name)
     except Exception as e:
         logging.error(f"Error accessing secret '{secret_resource_name}' via '{secret_name_env_var}': {e}")
         return None
 
+# 幣安客戶端在第一次使用時建立，之後所有回調共用 (內部的 requests.Session 會保持連線)
+BINANCE_REQUEST_TIMEOUT = float(os.environ.get("BINANCE_REQUEST_TIMEOUT", "5")) # 秒
+binance_client = None
+binance_client_lock = threading.Lock()
+
 def get_binance_client():
-    """獲取幣安 API 客戶端"""
-    api_key = get_secret("BINANCE_API_KEY_SECRET_NAME")
-    secret_key = get_secret("BINANCE_SECRET_KEY_SECRET_NAME")
-    if not api_key or not secret_key:
-        logging.error("Binance API keys not available. Cannot initialize Binance client.")
+    """獲取共用的幣安 API 客戶端；金鑰不可用時返回 None (下次調用會再嘗試)。"""
+    global binance_client
+    if binance_client is None:
+        with binance_client_lock:
+            if binance_client is None:
+                api_key = get_secret("BINANCE_API_KEY_SECRET_NAME")
+                secret_key = get_secret("BINANCE_SECRET_KEY_SECRET_NAME")
+                if not api_key or not secret_key:
+                    logging.error("Binance API keys not available. Cannot initialize Binance client.")
+                    return None
+                client = Client(api_key, secret_key, requests_params={"timeout": BINANCE_REQUEST_TIMEOUT})
+                # 回調線程共用同一個 Session，連接池大小與回調線程數一致，避免連線被丟棄後重建
+                client.session.mount("https://", HTTPAdapter(pool_maxsize=SUBSCRIBER_MAX_WORKERS))
+                binance_client = client
+    return binance_client
+
+
+# 最終交易指令在解析時即轉為帶 __slots__ 的 dataclass：之後使用屬性存取而不是字串鍵查找，
+# 欄位缺失時在解析處立即報錯
+@dataclass(slots=True)
+class FinalTradeCommand:
+    symbol: str
+    action: str # BUY, SELL
+    quantity: float
+    order_type: str
+    stop_loss_price: Optional[float] = None
+    take_profit_price: Optional[float] = None
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['symbol'], data['action'], data['quantity'], data['order_type'],
+                   data.get('stop_loss_price'), data.get('take_profit_price'))
+
+
+def log_publish_failure(future):
+    """Pub/Sub 發布完成的回調函數，只在發布失敗時記錄日誌"""
+    e = future.exception()
+    if e is not None:
+        logging.error(f"Failed to publish message: {e}")
+
+
+# 以 Pub/Sub messageId 作為訂單的 newClientOrderId：同一則訊息被重新投遞時，先查到已存在的訂單而不會重複下單
+CLIENT_ORDER_ID_PREFIX = "ps-"
+BINANCE_ORDER_NOT_FOUND = -2013 # 幣安錯誤碼：Order does not exist
+
+def client_order_id_for(message_id):
+    """由 Pub/Sub messageId 推導冪等的 newClientOrderId (幣安限制最長 36 字元)；沒有 messageId 時返回 None。"""
+    if not message_id:
         return None
-    return Client(api_key, secret_key)
+    return f"{CLIENT_ORDER_ID_PREFIX}{message_id}"[:36]
 
+def find_existing_order(client, symbol, client_order_id):
+    """查詢是否已用同一個 clientOrderId 下過單；不存在時返回 None。"""
+    try:
+        return client.get_order(symbol=symbol, origClientOrderId=client_order_id)
+    except BinanceAPIException as e:
+        if e.code == BINANCE_ORDER_NOT_FOUND:
+            return None
+        raise
 
-def execute_trade(client, symbol, action, quantity, order_type="MARKET", stop_loss_price=None, take_profit_price=None):
+def execute_trade(client, symbol, action, quantity, order_type="MARKET", stop_loss_price=None, take_profit_price=None, client_order_id=None, check_existing=True):
     """
     執行實際的交易操作。
+    client_order_id: 冪等鍵；已有同一 clientOrderId 的訂單時直接沿用該訂單，不再下單。
+    check_existing: 下單前是否查詢同一 clientOrderId 的訂單 (多一次簽名的 GET /api/v3/order)；
+    確定是第一次投遞時可跳過。
     """
     logging.info(f"Attempting to execute {action} {quantity:.6f} {symbol} (Order Type: {order_type})...")
     
@@ -67,7 +153,7 @@ def execute_trade(client, symbol, action, quantity, order_type="MARKET", stop_lo
         "order_type": order_type,
         "status": "FAILED",
         "error_message": "",
-        "timestamp": int(pd.Timestamp.now().timestamp() * 1000),
+        "timestamp": time.time_ns() // 1_000_000, # 當前時間戳 (毫秒)
         "executed_price": None,
         "executed_quantity": None,
         "order_id": None,
@@ -76,26 +162,39 @@ def execute_trade(client, symbol, action, quantity, order_type="MARKET", stop_lo
     }
 
     try:
-        if order_type == "MARKET":
+        order = find_existing_order(client, symbol, client_order_id) if client_order_id and check_existing else None
+        if order is not None:
+            logging.warning(f"Order {client_order_id} for {symbol} already exists (redelivered command). Not placing it again.")
+        elif order_type == "MARKET":
+            order_params = {"newClientOrderId": client_order_id} if client_order_id else {}
             if action == "BUY":
-                order = client.order_market_buy(symbol=symbol, quantity=quantity)
+                order = client.order_market_buy(symbol=symbol, quantity=quantity, **order_params)
             elif action == "SELL":
-                order = client.order_market_sell(symbol=symbol, quantity=quantity)
+                order = client.order_market_sell(symbol=symbol, quantity=quantity, **order_params)
             else:
                 raise ValueError(f"Unsupported action: {action}")
+            logging.info(f"Order placed successfully: {order}")
         # 未來可以添加 LIMIT, STOP_LOSS, TAKE_PROFIT 訂單類型
         else:
             raise ValueError(f"Unsupported order type: {order_type}")
 
-        logging.info(f"Order placed successfully: {order}")
-
         # 解析訂單結果
         trade_report["status"] = order['status']
         trade_report["order_id"] = order['orderId']
         
         # 對於市價單，實際成交價和數量可能分散在多個 fills 中
-        total_executed_qty = sum(float(f['qty']) for f in order['fills'])
-        total_executed_quote_qty = sum(float(f['qty']) * float(f['price']) for f in order['fills'])
+        # 單次遍歷同時累計成交數量與成交額
+        total_executed_qty = 0.0
+        total_executed_quote_qty = 0.0
+        fills = order.get('fills')
+        if fills:
+            for fill in fills:
+                fill_qty = float(fill['qty'])
+                total_executed_qty += fill_qty
+                total_executed_quote_qty += fill_qty * float(fill['price'])
+        else: # 查詢訂單 (get_order) 的返回沒有 fills，改用訂單的累計成交欄位
+            total_executed_qty = float(order.get('executedQty', 0.0))
+            total_executed_quote_qty = float(order.get('cummulativeQuoteQty', 0.0))
         
         trade_report["executed_quantity"] = total_executed_qty
         trade_report["executed_price"] = total_executed_quote_qty / total_executed_qty if total_executed_qty > 0 else None
@@ -137,9 +236,34 @@ def execute_trade(client, symbol, action, quantity, order_type="MARKET", stop_lo
 
     return trade_report
 
+def handle_final_trade_command(client, data, message_id=None, delivery_attempt=None):
+    """
+    執行一則最終交易指令 (data 為訊息內容 bytes) 並發布交易報告，返回 (交易對, 發布的 future 或 None)。
+    串流拉取回調與推送 (HTTP) 入口共用。只有下單之前的失敗 (例如解析錯誤) 會拋出異常；
+    下單之後發布報告失敗只記錄日誌，不拋出，避免訊息被重新投遞。
+    delivery_attempt 只在訂閱設定了死信策略時才有值；為 1 時是第一次投遞，跳過已存在訂單的查詢。
+    """
+    command = FinalTradeCommand.from_dict(orjson.loads(data)) # orjson 直接解析 bytes
+
+    logging.info(f"Executing final trade: {command.action} {command.quantity:.6f} {command.symbol}")
+
+    trade_report = execute_trade(client, command.symbol, command.action, command.quantity, command.order_type,
+                                 command.stop_loss_price, command.take_profit_price, client_order_id_for(message_id),
+                                 check_existing=delivery_attempt != 1)
+
+    # 發布交易報告到 Pub/Sub
+    try:
+        message_data = orjson.dumps(trade_report) # orjson 直接輸出 bytes
+        future = publisher.publish(trade_reports_topic_path, message_data)
+    except Exception as e:
+        logging.error(f"Failed to publish trade report for {command.symbol}: {e}", exc_info=True)
+        return command.symbol, None
+    future.add_done_callback(log_publish_failure)
+    return command.symbol, future
+
 def process_final_trade_command(message: pubsub_v1.subscriber.message.Message):
     """
-    處理接收到的最終交易指令。
+    處理接收到的最終交易指令 (串流拉取回調)。
     """
     client = get_binance_client()
     if not client:
@@ -148,49 +272,102 @@ def process_final_trade_command(message: pubsub_v1.subscriber.message.Message):
         return
 
     try:
-        command_data = json.loads(message.data.decode('utf-8'))
-        symbol = command_data['symbol']
-        action = command_data['action']
-        quantity = command_data['quantity']
-        order_type = command_data['order_type']
-        stop_loss_price = command_data.get('stop_loss_price')
-        take_profit_price = command_data.get('take_profit_price')
-
-        logging.info(f"Executing final trade: {action} {quantity:.6f} {symbol}")
-
-        trade_report = execute_trade(client, symbol, action, quantity, order_type, stop_loss_price, take_profit_price)
-        
-        # 發布交易報告到 Pub/Sub
-        message_data = json.dumps(trade_report).encode('utf-8')
-        future = publisher.publish(trade_reports_topic_path, message_data)
-        future.add_done_callback(lambda f: logging.debug(f"Trade report published with ID: {f.result()}"))
-        
+        symbol, _ = handle_final_trade_command(client, message.data, message.message_id, message.delivery_attempt)
         message.ack() # 確認訊息已處理
         logging.info(f"Processed final trade command for {symbol} and published trade report.")
 
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logging.error(f"Error decoding JSON message from final trade command: {e}")
         message.nack()
     except Exception as e:
         logging.error(f"Error processing final trade command in executor: {e}", exc_info=True)
         message.nack()
 
+def handle_pubsub_push():
+    """
+    Pub/Sub 推送訂閱的 HTTP 入口 (POST /)。請求內容為推送信封：
+    {"message": {"data": <base64>, "messageId": ...}, "subscription": ..., "deliveryAttempt": ...}
+    返回 2xx 即確認訊息，其他狀態碼會讓 Pub/Sub 按訂閱的重試策略重新投遞。
+    只有下單之前的失敗返回錯誤；下單時以 messageId 作為冪等鍵，重新投遞也不會重複下單。
+    """
+    try:
+        envelope = orjson.loads(request.get_data())
+        message = envelope["message"]
+        data = base64.b64decode(message["data"])
+        message_id = message.get("messageId") or message.get("message_id")
+    except (orjson.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        logging.error(f"Invalid Pub/Sub push request: {e}")
+        return "Bad Request", 400
+
+    client = get_binance_client()
+    if not client:
+        logging.error("Binance client not initialized. Cannot process trade command.")
+        return "Service Unavailable", 503
+
+    try:
+        symbol, future = handle_final_trade_command(client, data, message_id, envelope.get("deliveryAttempt"))
+    except orjson.JSONDecodeError as e:
+        logging.error(f"Error decoding JSON message from final trade command: {e}")
+        return "Bad Request", 400
+    except Exception as e:
+        logging.error(f"Error processing final trade command in executor: {e}", exc_info=True)
+        return "Internal Server Error", 500
+    if future is not None:
+        # 返回後實例可能被凍結，需等待批次發布完成；訂單已送出，發布失敗只由 log_publish_failure 記錄，不影響確認
+        future.exception()
+    logging.info(f"Processed final trade command for {symbol} and published trade report.")
+    return "", 204
+
+# gunicorn 入口 (main:app)，見 Dockerfile；未安裝 flask 時只能以串流拉取模式運行
+app = None
+if Flask is not None:
+    app = Flask(__name__)
+    app.add_url_rule("/", view_func=handle_pubsub_push, methods=["POST"])
+
+
+def ensure_subscription(sub_path, topic_path):
+    """
+    確保訂閱存在。先以 get_subscription 檢查 (一次輕量讀取)，只有 NotFound 時才創建；
+    確認成功後記錄在 SUBSCRIPTION_SENTINEL_FILE，同一容器內重啟時直接跳過管理 API 調用。
+    注意：在生產環境中，通常會透過 Terraform 或手動在 GCP 控制台創建訂閱。
+    """
+    try:
+        with open(SUBSCRIPTION_SENTINEL_FILE) as f:
+            if sub_path in f.read().splitlines():
+                return
+    except OSError:
+        pass
+
+    try:
+        subscriber.get_subscription(subscription=sub_path)
+        logging.info(f"Subscription {sub_path} already exists.")
+    except NotFound:
+        try:
+            subscriber.create_subscription(name=sub_path, topic=topic_path)
+            logging.info(f"Subscription {sub_path} created.")
+        except AlreadyExists: # 其他實例同時啟動並已創建
+            logging.info(f"Subscription {sub_path} already exists.")
+
+    try:
+        with open(SUBSCRIPTION_SENTINEL_FILE, "a") as f:
+            f.write(sub_path + "\n")
+    except OSError as e:
+        logging.warning(f"Could not record subscription in {SUBSCRIPTION_SENTINEL_FILE}: {e}")
+
 
 def main():
     logging.info("Starting Trade Execution Module...")
     
-    # 創建訂閱 (如果不存在)
-    try:
-        subscriber.create_subscription(name=final_trade_execution_sub_path, topic=publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_FINAL_TRADE_EXECUTION))
-        logging.info(f"Subscription {final_trade_execution_sub_path} created (if it didn't exist).")
-    except Exception as e:
-        if "AlreadyExists" in str(e):
-            logging.info(f"Subscription {final_trade_execution_sub_path} already exists.")
-        else:
-            logging.error(f"Error creating subscription {final_trade_execution_sub_path}: {e}")
+    # 確保訂閱存在（如果不存在則創建）；訂閱必須在開始拉取前存在，因此同步完成
+    if CREATE_SUBSCRIPTIONS_ON_START:
+        try:
+            ensure_subscription(final_trade_execution_sub_path, publisher.topic_path(GCP_PROJECT_ID, PUBSUB_TOPIC_FINAL_TRADE_EXECUTION))
+        except Exception as e:
+            logging.error(f"Error ensuring subscription {final_trade_execution_sub_path}: {e}")
             exit(1)
 
-    streaming_pull_future = subscriber.subscribe(final_trade_execution_sub_path, callback=process_final_trade_command)
+    scheduler = pubsub_v1.subscriber.scheduler.ThreadScheduler(executor=ThreadPoolExecutor(max_workers=SUBSCRIBER_MAX_WORKERS))
+    streaming_pull_future = subscriber.subscribe(final_trade_execution_sub_path, callback=process_final_trade_command, flow_control=SUBSCRIBER_FLOW_CONTROL, scheduler=scheduler)
     logging.info(f"Listening for final trade execution commands on {PUBSUB_TOPIC_FINAL_TRADE_EXECUTION}...")
 
     try:
@@ -208,9 +385,8 @@ def main():
         logging.info("Trade Execution Module stopped.")
 
 if __name__ == '__main__':
-    # 由於 Cloud Run 觸發器是針對單個事件處理的，
-    # 在實際部署時，Cloud Run 會為每個收到的 Pub/Sub 訊息啟動一個新的實例。
-    # 這裡的 `main` 函數主要用於定義服務行為，而不是無限循環。
+    # 以常駐進程運行時使用串流拉取 (main)，實例需保持運行並持續接收多則訊息；
+    # 容器默認以 gunicorn 運行 main:app，接收 Pub/Sub 推送請求 (見 Dockerfile)，不會運行 main。
     main()
 
 